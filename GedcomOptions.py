@@ -48,26 +48,38 @@ Names:
 from __future__ import unicode_literals
 from __future__ import print_function
 
-from gi.repository import Gtk
+import time
+_import_started = time.perf_counter()
 
-from gramps.plugins.export import exportgedcom
 from gramps.gen.const import GRAMPS_LOCALE as glocale
-from gramps.gen.lib import (AttributeType, ChildRefType, Citation, Date,
-                            EventRoleType, EventType, LdsOrd, NameType,
-                            PlaceType, NoteType, Person, UrlType,
-                            SrcAttributeType, NameOriginType)
+from gramps.gen.lib import PlaceType
 
 from gramps.gen.errors import DatabaseError
-from gramps.gui.plug.export import WriterOptionBox
-from gramps.gen.utils.place import conv_lat_lon
-from gramps.gen.utils.location import get_main_location
-from gramps.gen.display.place import displayer as place_displayer
-from gramps.gen.lib.date import Today
-import gramps.plugins.lib.libgedcom as libgedcom
+from array import array
+from collections import OrderedDict
+import concurrent.futures
+import copy
+import csv
+import hashlib
+import heapq
+import importlib.util
+import io
+import json
+import logging
 import math
+import mmap
+import os
+import queue
+import random
+import re
+import struct
+import sys
+import threading
 
 __version__ = "0.5.10"
 
+LOG = logging.getLogger(".GedcomOptions")
+
 try:
     _trans = glocale.get_addon_translator(__file__)
 except ValueError:
@@ -77,867 +89,1858 @@ _ = _trans.gettext
 
 #------------------------------------------------------------
 #
-# GedcomWriterWithOptions
+# AnomalyLog
 #
 #------------------------------------------------------------
 
-class GedcomWriterWithOptions(exportgedcom.GedcomWriter):
+class AnomalyLog():
     """
-    GedcomWriter with Extra Options
+    Log of data quality findings, such as events or children that are not in date order, written as
+    CSV, or as JSON lines if the file name ends with .jsonl.
+
+    Rows are buffered and written in a background thread. At most max_rate rows per second are
+    logged (with bursts up to the same amount); the rest are counted as dropped.
     """
 
-    __fuzzy_debug = False
-
-    _address_format = ["%street, %custom, %unknown, %building, %department, %farm, %neighborhood",
-                       "%hamlet, %village, %borough, %locality",
-                       "[%CODE ]+-[%town, %city, %municipality], %parish",
-                       "%district, %region, %province, %county, %state",
-                       "%country",
-                       ""]
-
-    _def_address_format = ["%street",
-                           "%locality",
-                           "%city",
-                           "%state",
-                           "%country",
-                           "%code"]
-
-    _place_keys = ['street', 'department', 'building', 'farm', 'neighborhood', 'hamlet', 'village',
-                   'borough', 'locality', 'town', 'city', 'municipality', 'parish', 'district',
-                   'region', 'province', 'county', 'state', 'country', 'custom', 'unknown', 'code']
-
-    _place_types = dict(street=PlaceType.STREET,
-                        department=PlaceType.DEPARTMENT,
-                        building=PlaceType.BUILDING,
-                        farm=PlaceType.FARM,
-                        neighborhood=PlaceType.NEIGHBORHOOD,
-                        hamlet=PlaceType.HAMLET,
-                        village=PlaceType.VILLAGE,
-                        borough=PlaceType.BOROUGH,
-                        locality=PlaceType.LOCALITY,
-                        town=PlaceType.TOWN,
-                        city=PlaceType.CITY,
-                        municipality=PlaceType.MUNICIPALITY,
-                        parish=PlaceType.PARISH,
-                        district=PlaceType.DISTRICT,
-                        province=PlaceType.PROVINCE,
-                        region=PlaceType.REGION,
-                        county=PlaceType.COUNTY,
-                        state=PlaceType.STATE,
-                        country=PlaceType.COUNTRY,
-                        custom=PlaceType.CUSTOM,
-                        unknown=PlaceType.UNKNOWN)
-
-    # 'accuracy' of coordinates will be determined by place types which are grouped as:
-    _address1_level_place_types = [PlaceType.STREET, PlaceType.DEPARTMENT, PlaceType.BUILDING,
-                                   PlaceType.FARM, PlaceType.NEIGHBORHOOD, PlaceType.HAMLET]
-    _address2_level_place_types = [PlaceType.VILLAGE, PlaceType.BOROUGH, PlaceType.LOCALITY]
-    _city_level_place_types = [PlaceType.TOWN, PlaceType.MUNICIPALITY, PlaceType.CITY, PlaceType.PARISH]
-    _county_level_place_types = [PlaceType.DISTRICT, PlaceType.COUNTY, PlaceType.REGION]
-    _state_level_place_types = [PlaceType.STATE]
-    _country_level_place_types = [PlaceType.COUNTRY]
-    _unknown_level_place_types = [PlaceType.UNKNOWN, PlaceType.CUSTOM]  # will be interpreted with highest accuracy
-
-    _days_in_month = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-
-    #parser = FormatStringParser()
-
-    def __init__(self, database, user, option_box=None):
-        super(GedcomWriterWithOptions, self).__init__(database, user, option_box)
-        if option_box:
-            self.sort_children = option_box.sort_children
-            self.sort_events = option_box.sort_events
-            self.reversed_places = option_box.reversed_places
-            self.get_coordinates = option_box.get_coordinates
-            self.export_only_useful_pe_addresses = option_box.export_only_useful_pe_addresses
-            self.extended_pe_addresses = option_box.extended_pe_addresses
-            self.avoid_repetition_in_places = option_box.avoid_repetition_in_places
-            self.include_tng_place_levels = option_box.include_tng_place_levels
-            self.omit_borough_from_address = option_box.omit_borough_from_address
-            self.move_patronymics = option_box.move_patronymics
-        else:
-            self.sort_children = 0
-            self.sort_events = 0
-            self.reversed_places = 0
-            self.get_coordinates = 0
-            self.export_only_useful_pe_addresses = 0
-            self.extended_pe_addresses = 0
-            self.avoid_repetition_in_places = 0
-            self.include_tng_place_levels = 0
-            self.omit_borough_from_address = 0
-            self.move_patronymics = 0
-
-        self.db = self.dbase  # some methods copied from other plugins use this. just avoiding renaming.
-
-        self.parser = FormatStringParser(self._place_keys)
-        print("Gedcom Options " + __version__ + " loaded")
-
-    def _person_name(self, name, attr_nick):
-        """
-        n NAME <NAME_PERSONAL> {1:1}
-        +1 NPFX <NAME_PIECE_PREFIX> {0:1}
-        +1 GIVN <NAME_PIECE_GIVEN> {0:1}
-        +1 NICK <NAME_PIECE_NICKNAME> {0:1}
-        +1 SPFX <NAME_PIECE_SURNAME_PREFIX {0:1}
-        +1 SURN <NAME_PIECE_SURNAME> {0:1}
-        +1 NSFX <NAME_PIECE_SUFFIX> {0:1}
-        +1 <<SOURCE_CITATION>> {0:M}
-        +1 <<NOTE_STRUCTURE>> {0:M}
-        """
-
-        if not self.move_patronymics:
-            super(GedcomWriterWithOptions, self)._person_name(name, attr_nick)
-        else:
-            firstname = name.get_first_name().strip()
-            surns = []
-            surprefs = []
-
-            for surn in name.get_surname_list():
-                if surn.get_origintype() == NameOriginType.PATRONYMIC \
-                        or surn.get_origintype() == NameOriginType.MATRONYMIC:
-                    firstname = firstname + " " + surn.get_surname().replace('/', '?')
-                else:
-                    surns.append(surn.get_surname().replace('/', '?'))
-
-                    if surn.get_connector():
-                        # we store connector with the surname
-                        surns[-1] = surns[-1] + ' ' + surn.get_connector()
-                    surprefs.append(surn.get_prefix().replace('/', '?'))
-            surname = ', '.join(surns)
-            surprefix = ', '.join(surprefs)
-            suffix = name.get_suffix()
-            title = name.get_title()
-            nick = name.get_nick_name().strip()
-            call = name.get_call_name().strip()
-            if call.strip() != '':
-                if nick != '' and nick.lower() != call.lower():
-                    nick = call + ', ' + nick
-                else:
-                    nick = call
-            if nick == '':
-                nick = attr_nick
-
-            #gedcom name
-            gedcom_surname = name.get_surname().replace('/', '?')
-            if suffix == "":
-                gedcom_name = '%s /%s/' % (firstname, gedcom_surname)
-            else:
-                gedcom_name = '%s /%s/ %s' % (firstname, gedcom_surname, suffix)
+    FIELDS = ("record", "gramps_id", "flags", "quality", "trend")
 
-            self._writeln(1, 'NAME', gedcom_name)
-            if int(name.get_type()) == NameType.BIRTH:
-                pass
-            elif int(name.get_type()) == NameType.MARRIED:
-                self._writeln(2, 'TYPE', 'married')
-            elif int(name.get_type()) == NameType.AKA:
-                self._writeln(2, 'TYPE', 'aka')
-            else:
-                self._writeln(2, 'TYPE', name.get_type().xml_str())
-
-            if firstname:
-                self._writeln(2, 'GIVN', firstname)
-            if surprefix:
-                self._writeln(2, 'SPFX', surprefix)
-            if surname:
-                self._writeln(2, 'SURN', surname)
-            if name.get_suffix():
-                self._writeln(2, 'NSFX', suffix)
-            if name.get_title():
-                self._writeln(2, 'NPFX', title)
-            if nick:
-                self._writeln(2, 'NICK', nick)
-
-            self._source_references(name.get_citation_list(), 2)
-        self._note_references(name.get_note_list(), 2)
-
-    def _person_event_ref(self, key, event_ref):
-        """
-        Write out the BIRTH and DEATH events for the person.
-        """
-        if event_ref:
-            event = self.dbase.get_event_from_handle(event_ref.ref)
-            ## if event_has_subordinate_data(event, event_ref):
-            self._writeln(1, key)
-            ## else:
-            ##    self._writeln(1, key, 'Y')
-            if event.get_description().strip() != "":
-                self._writeln(2, 'TYPE', event.get_description())
-            self._dump_event_stats(event, event_ref)
-
-    def _place(self, place, dateobj, level):
-        """
-        PLACE_STRUCTURE:=
-            n PLAC <PLACE_NAME> {1:1}
-            +1 FORM <PLACE_HIERARCHY> {0:1}
-            +1 FONE <PLACE_PHONETIC_VARIATION> {0:M}  # not used
-            +2 TYPE <PHONETIC_TYPE> {1:1}
-            +1 ROMN <PLACE_ROMANIZED_VARIATION> {0:M} # not used
-            +2 TYPE <ROMANIZED_TYPE> {1:1}
-            +1 MAP {0:1}
-            +2 LATI <PLACE_LATITUDE> {1:1}
-            +2 LONG <PLACE_LONGITUDE> {1:1}
-            +1 <<NOTE_STRUCTURE>> {0:M}
-
-        ADDRESS STRUCTURE;=
-            n ADDR <ADDR1>
-            +1 ADR1 <ADDR1>
-            +1 ADR2 <ADDR2>
-            +1 CITY <CITY>
-            +1 STAE <STATE>
-            +1 POST <POSTAL CODE>
-            +1 CTRY <COUNTRY>
-
-        Where
-            ADDR1 = street, unknown, custom, department, building, farm, neighborhood
-            ADDR2 = hamlet, village, borough, locality
-            CITY = municipality, town, city, parish
-            STATE = district, province, region, county, state
-            COUNTRY = country
-        """
-
-        if place is None:
+    def __init__(self, filename, max_rate=1000, buffer_size=500):
+        """
+        :param filename:    The log file
+        :param max_rate:    Maximum rows per second, None for no limit
+        :param buffer_size: Rows passed to the writing thread at a time
+        """
+        self.filename = filename
+        self.max_rate = max_rate
+        self.buffer_size = buffer_size
+        self.logged = 0
+        self.dropped = 0
+        self._jsonl = filename.lower().endswith(".jsonl")
+        self._buffer = []
+        self._queue = None
+        self._thread = None
+        self._tokens = float(max_rate or 0)
+        self._last_time = None
+        self._lock = threading.Lock()  # shard writers add rows from several threads
+
+    def open(self):
+        self._queue = queue.Queue()
+        self._last_time = time.perf_counter()
+        self._thread = threading.Thread(target=self._write, args=(open(self.filename, "w", newline=""),))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, record, gramps_id, flags, quality, trend):
+        """
+        :param record:      What was evaluated, e.g. 'events' or 'children'
+        :param gramps_id:   Gramps ID of the person or family
+        :param flags:       List of findings
+        :param quality:     Order quality from FuzzySort
+        :param trend:       Order trend from FuzzySort
+        """
+        with self._lock:
+            if self.max_rate:
+                now = time.perf_counter()
+                self._tokens = min(self.max_rate, self._tokens + (now - self._last_time) * self.max_rate)
+                self._last_time = now
+                if self._tokens < 1:
+                    self.dropped += 1
+                    return
+                self._tokens -= 1
+            self._buffer.append((record, gramps_id, "|".join(flags), quality, trend))
+            self.logged += 1
+            if len(self._buffer) >= self.buffer_size:
+                self._queue.put(self._buffer)
+                self._buffer = []
+
+    def close(self):
+        if self._thread is None:
             return
+        if self._buffer:
+            self._queue.put(self._buffer)
+            self._buffer = []
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        LOG.info("Anomaly log %s: %d rows written, %d dropped by rate limit", self.filename, self.logged, self.dropped)
+
+    def _write(self, log_file):
+        with log_file:
+            if self._jsonl:
+                while True:
+                    rows = self._queue.get()
+                    if rows is None:
+                        return
+                    log_file.write("".join(json.dumps(dict(zip(self.FIELDS, row))) + "\n" for row in rows))
+            else:
+                csv_writer = csv.writer(log_file)
+                csv_writer.writerow(self.FIELDS)
+                while True:
+                    rows = self._queue.get()
+                    if rows is None:
+                        return
+                    csv_writer.writerows(rows)
 
-        place_name = place_displayer.display(self.dbase, place, dateobj) #changed since 4.1
-        if self.avoid_repetition_in_places:
-            place_name = self.remove_repetitive_places_from_string(place_name)
-        if self.reversed_places:
-            place_name = self.reverse_order_places(place_name)
-
-        self._writeln(level, "PLAC", place_name.replace('\r', ' '), limit=120)
-        longitude = place.get_longitude()
-        latitude = place.get_latitude()
-        title = place_name.replace('\r', ' ')
-
-        # Get missing coordinates from place tree
-
-        max_place_level_difference = 4  # max diff to inherit coordinates to enclosed place
-
-        place_level = self._tng_place_level(place)[0]
-        zoom_level = self._tng_place_level(place)[1]
-
-        ### Inherit coordinates
-        if self.get_coordinates:
-
-            test_tng_place_level = place_level
-            inherited_place = None
-
-            place_level_diff = 999
-
-            if self.get_coordinates and not longitude and not latitude:
-                place_list = self.get_place_list(place, dateobj)
-                if len(place_list) > 1:
-                    for place_above in place_list:
-                        if place is not place_above:
-                            title_above = place_displayer.display(self.dbase, place_above, dateobj).replace('\r', ' ')
-                            test_longitude = place_above.get_longitude()
-                            test_latitude = place_above.get_latitude()
-                            if test_latitude and test_longitude:
-                                test_tng_place_level = self._tng_place_level(place_above)[0]
-                                test_place_level_diff = test_tng_place_level - place_level
-
-                                # negative differences means the place is even more accurate
-                                # (how to treat this?)
-                                if test_place_level_diff < 0:
-                                    test_place_level_diff = 0
-
-                                if test_place_level_diff < place_level_diff \
-                                        and test_place_level_diff <=  max_place_level_difference \
-                                        or title == title_above:
-                                    longitude = test_longitude
-                                    latitude = test_latitude
-                                    inherited_place = place_above
-                                    place_level_diff = test_place_level_diff
-                    if inherited_place:
-                        place_level = self._tng_place_level(inherited_place)[0]
-                        zoom_level = self._tng_place_level(inherited_place)[1]
-
-        if longitude and latitude:
-            (latitude, longitude) = conv_lat_lon(latitude, longitude, "GEDCOM")
-        if longitude and latitude:
-            self._writeln(level+1, "MAP")
-            self._writeln(level+2, 'LATI', latitude)
-            self._writeln(level+2, 'LONG', longitude)
-            if self.include_tng_place_levels:
-                self._writeln(level+2, 'PLEV', '%d' % place_level)
-                self._writeln(level+2, 'ZOOM', '%d' % zoom_level)
-
-        # The Gedcom standard shows that an optional address structure can
-        # be written out in the event detail.
-        # http://homepages.rootsweb.com/~pmcbride/gedcom/55gcch2.htm#EVENT_DETAIL
-        title = place_name.replace('\r', ' ')
-        location = get_main_location(self.dbase, place)
-        postal_code = place.get_code()
-
-        placetree = self.generate_place_dictionary(place, dateobj)
-
-        # Check if there is any piece of information in places that is not in place's title, and if is,
-        # will add address data in gedcom
-
-        if not self.export_only_useful_pe_addresses or self._is_extra_info_in_place_names(title, placetree):
-
-            # Don't show borough, when street and city is present (more like modern address)
-            if self.omit_borough_from_address and placetree['street'] and (placetree['city'] or placetree['town']):
-                placetree['borough'] = ""
-
-            # Generate Address field from all the place types given
-            if self.extended_pe_addresses:
-                #parser = FormatStringParser(self._place_keys)
-
-                if self.avoid_repetition_in_places:
-                    self._remove_repetitive_places(placetree, self._address_format)
-
-                address1 = self.parser.parse(placetree, self._address_format[0])
-                address2 = self.parser.parse(placetree, self._address_format[1])
-                city = self.parser.parse(placetree, self._address_format[2])
-                state = self.parser.parse(placetree, self._address_format[3])
-                country = self.parser.parse(placetree, self._address_format[4])
-                postal_code = self.parser.parse(placetree, self._address_format[5])
 
-            else:
-                address1 = self.parser.parse(placetree, self._def_address_format[0])
-                address2 = self.parser.parse(placetree, self._def_address_format[1])
-                city = self.parser.parse(placetree, self._def_address_format[2])
-                state = self.parser.parse(placetree, self._def_address_format[3])
-                country = self.parser.parse(placetree, self._def_address_format[4])
-                postal_code = self.parser.parse(placetree, self._def_address_format[5])
-
-            # Write Address For the Place
-            if address1 or address2 or state or postal_code:
-                self._writeln(level, "ADDR", address1)
-                if address1:
-                    self._writeln(level + 1, 'ADR1', address1)
-                if address2:
-                    self._writeln(level + 1, 'ADR2', address2)
-                if city:
-                    self._writeln(level + 1, 'CITY', city)
-                if state:
-                    self._writeln(level + 1, 'STAE', state)
-                if postal_code:
-                    self._writeln(level + 1, 'POST', postal_code)
-                if country:
-                    self._writeln(level + 1, 'CTRY', country)
-
-        self._note_references(place.get_note_list(), level+1)
-
-    def generate_place_dictionary(self, place, dateobj):
-        #db = self.dbstate.get_database() -- for addresspreview
-        db = self.dbase
-        location = get_main_location(db, place, dateobj)
-        place_dict = dict()
-
-        for key in self._place_keys:
-            place_type = self._place_types.get(key.lower())
+#------------------------------------------------------------
+#
+# PlaceComponents
+#
+#------------------------------------------------------------
+
+class PlaceComponents():
+    """
+    Names of the places in a place tree by place key.
+
+    Names are stored in a tuple in the order of the keys, and can be read like from a dictionary.
+    Names are not changed after creating, but omit() returns a copy with some names left empty.
+    """
+
+    __slots__ = ("_values",)
+
+    KEYS = ('street', 'department', 'building', 'farm', 'neighborhood', 'hamlet', 'village',
+            'borough', 'locality', 'town', 'city', 'municipality', 'parish', 'district',
+            'region', 'province', 'county', 'state', 'country', 'custom', 'unknown', 'code')
+
+    PLACE_TYPES = dict(street=PlaceType.STREET,
+                       department=PlaceType.DEPARTMENT,
+                       building=PlaceType.BUILDING,
+                       farm=PlaceType.FARM,
+                       neighborhood=PlaceType.NEIGHBORHOOD,
+                       hamlet=PlaceType.HAMLET,
+                       village=PlaceType.VILLAGE,
+                       borough=PlaceType.BOROUGH,
+                       locality=PlaceType.LOCALITY,
+                       town=PlaceType.TOWN,
+                       city=PlaceType.CITY,
+                       municipality=PlaceType.MUNICIPALITY,
+                       parish=PlaceType.PARISH,
+                       district=PlaceType.DISTRICT,
+                       province=PlaceType.PROVINCE,
+                       region=PlaceType.REGION,
+                       county=PlaceType.COUNTY,
+                       state=PlaceType.STATE,
+                       country=PlaceType.COUNTRY,
+                       custom=PlaceType.CUSTOM,
+                       unknown=PlaceType.UNKNOWN)
+
+    _INDEX = dict((key, index) for index, key in enumerate(KEYS))
+    _PLACE_TYPES = tuple(map(PLACE_TYPES.get, KEYS))
+    _EMPTY = ("",) * len(KEYS)
+
+    def __init__(self, values=None):
+        self._values = values if values is not None else self._EMPTY
+
+    @classmethod
+    def from_location(cls, location, code):
+        """
+        :param location:    Dictionary of place names by place type, as returned by get_main_location()
+        :param code:        Postal code
+        :return:            PlaceComponents
+        """
+        values = []
+        for key, place_type in zip(cls.KEYS, cls._PLACE_TYPES):
             if place_type:
                 value = location.get(place_type)
             elif key == "code":
-                value = place.get_code()
+                value = code
             else:
                 value = ""
-            if not value:
-                value = ""
+            values.append(sys.intern(value) if value else "")
+        return cls(tuple(values))
 
-            place_dict[key] = value
-        return place_dict
-
-    def remove_repetitive_places_from_string(self, place_title):
-        place_components = place_title.split(",")
-        result_list = []
-        result = ""
-        items_to_remove = []
-        for i in range(0, len(place_components)):
-            candidate = place_components[i].strip()
-            for j in range(0, len(place_components)):
-                if j == i or candidate in items_to_remove:
-                    continue
-                test = " " + candidate + " "
-                check_test = " " + place_components[j].strip() + " "
-                if test.find(check_test) >= 0:
-                    items_to_remove.append(place_components[j].strip())
-        for component in place_components:
-            if component.strip() not in items_to_remove:
-                result_list.append(component.strip())
-        for i in range(0, len(result_list)):
-            result += result_list[i]
-            if i != len(result_list) - 1:
-                result += ", "
-        return result
+    def omit(self, flags):
+        """
+        Returns a copy with names left empty for the keys which flags (1 << key index) are set,
+        or self if no flags are set
+        """
+        if not flags:
+            return self
+        return PlaceComponents(tuple("" if flags & (1 << index) else value
+                                     for index, value in enumerate(self._values)))
 
-    def reverse_order_places(self, place_title):
-        place_components = place_title.split(",")
-        result = ""
-        for i in reversed(range(0, len(place_components))):
-            result += place_components[i].strip()
-            if i != 0:
-                result += ", "
-        return result
+    def get(self, key, default=None):
+        index = self._INDEX.get(key)
+        if index is None:
+            return default
+        return self._values[index]
 
-    def _remove_repetitive_places(self, place_dictionary, address_format):
-        keys = dict()
-        keys_to_remove = []
-
-        for address_line in address_format:
-            keys.update(self.parser.get_parsed_keys(place_dictionary, address_line))
-
-        for key, value in keys.items():
-            if key not in keys_to_remove:
-                for check_key, check_value in keys.items():
-                    if key != check_key:
-                        if value and check_value:
-                            test = " " + value + " "
-                            check_test = " " + check_value + " "
-                            if test.find(check_test) >= 0:
-                                keys_to_remove.append(check_key)
-                                keys[check_key] = ""
-
-        if len(keys_to_remove) == 0:
-            return ""
-        else:
-            omit_string = ""
+    def __getitem__(self, key):
+        return self._values[self._INDEX[key]]
+
+    def __contains__(self, key):
+        return key in self._INDEX
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def keys(self):
+        return self.KEYS
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self.KEYS, self._values)
+
+
+#------------------------------------------------------------
+#
+# PersonIndex
+#
+#------------------------------------------------------------
 
-            for key in keys_to_remove:
-                omit_string = place_dictionary[key] if not omit_string else omit_string + ", " + place_dictionary[key]
-                place_dictionary[key] = ""
-            return omit_string  # returning anything is for debugging purpose only
+class PersonIndex():
+    """
+    Gramps IDs and birth sort values of all persons in a database by person handle.
+
+    Built in one pass over the person table, so that sorting children and writing their
+    references don't need to load persons and their birth events again and again.
+    """
 
-    def _is_extra_info_in_place_names(self, place_title, place_dictionary):
+    def __init__(self, db):
         """
-        Returns true if there is anything in place tree that does not exist in place title
+        :param db:  Database to index, None for an empty index
         """
-        ret = False
-        if place_title:
-            for key, place_name in place_dictionary.items():
-                if place_name:
-                    if place_title.find(place_name) < 0:
-                        ret = True
-                        break
+        self._positions = dict()  # handle -> position in the arrays
+        self._gramps_ids = []
+        self._birth_sort_values = array('q')  # 0 if not known
+        self._has_birth = bytearray()
 
-        return ret
+        if db is None:
+            return
+        for person in db.iter_people():
+            birth_ref = person.get_birth_ref()
+            sort_value = 0
+            if birth_ref is not None:
+                event = db.get_event_from_handle(birth_ref.ref)
+                if event is not None:
+                    sort_value = event.get_date_object().get_sort_value()
+            self._positions[person.get_handle()] = len(self._gramps_ids)
+            self._gramps_ids.append(person.get_gramps_id())
+            self._birth_sort_values.append(sort_value)
+            self._has_birth.append(birth_ref is not None)
+
+    def __contains__(self, handle):
+        return handle in self._positions
 
-    def get_place_list(self, place, date=None):
+    def __len__(self):
+        return len(self._gramps_ids)
+
+    def get(self, handle):
         """
-        Returns a list of all places in a place tree
+        Returns a tuple (gramps_id, birth sort value, has birth), or None if the person is unknown
         """
+        position = self._positions.get(handle)
+        if position is None:
+            return None
+        return (self._gramps_ids[position], self._birth_sort_values[position],
+                bool(self._has_birth[position]))
 
-        if date is None:
-            date = Today()
-        visited = [place.handle]
-        lines = [place]
-        while True:
-            handle = None
-            for placeref in place.get_placeref_list():
-                ref_date = placeref.get_date_object()
-                if ref_date.is_empty() or date.match(ref_date):
-                    handle = placeref.ref
-            if handle is None or handle in visited:
-                break
-            place = self.dbase.get_place_from_handle(handle)
-            if place is None:
-                break
-            visited.append(handle)
-            lines.append(place)
-        return lines
-
-    def _tng_place_level(self, place):
-        level = 6
-        zoom = 9
-        if place.get_type() in self._unknown_level_place_types:
-            level, zoom = 1, 13
-        if place.get_type() in self._address1_level_place_types:
-            level, zoom = 1, 13
-        if place.get_type() in self._address2_level_place_types:
-            level, zoom = 2, 11
-        if place.get_type() in self._city_level_place_types:
-            level, zoom = 3, 9
-        if place.get_type() in self._county_level_place_types:
-            level, zoom = 4, 7
-        if place.get_type() is PlaceType.STATE:
-            level, zoom = 5, 5
-        if place.get_type() is PlaceType.COUNTRY:
-            level, zoom = 6, 4
-        return level, zoom
-
-    #---------------
-    # Sort Children
-    # --------------
-
-    # SORT CHILDREN
-    def _family_child_list(self, child_ref_list):
-        """
-        Override of standard ExportGeccom plugin version
-        Write the child XREF values to the GEDCOM file.
-        """
-        if len(child_ref_list) == 0:
-            return
+    def get_gramps_id(self, handle):
+        return self._gramps_ids[self._positions[handle]]
 
-        #child_list = [
-        #    self.dbase.get_person_from_handle(cref.ref).get_gramps_id()
-        #    for cref in child_ref_list]
-
-        # Sort children
-
-        if self.sort_children:
-            child_sort_list = self.decorate_by_birth(child_ref_list)
-            sorter = FuzzySort(unsortables_last=True, max_deviation=20 * 365)
-            quality, trend, unsortables, exceed1, exceed2, eval_fail = sorter.get_info(child_sort_list)
-            need_sorting = True if trend < 1 else False
-            if self.__fuzzy_debug and (need_sorting and unsortables) or exceed1 or exceed2 or need_sorting:
-                #__id = family.get_gramps_id()
-                #print(__id + ": " + self.__get_family_print_name(family))
-                #self.__print_debug_flags(need_sorting, unsortables, exceed1 or exceed2, eval_fail)
-                #print("q: " + str(quality) + ", t: " + str(trend))
-                #print("----------------------------")
-                pass
+    def get_birth_sort_value(self, handle):
+        return self._birth_sort_values[self._positions[handle]]
+
+    def has_birth(self, handle):
+        return bool(self._has_birth[self._positions[handle]])
+
+
+#------------------------------------------------------------
+#
+# DatabaseSnapshot
+#
+#------------------------------------------------------------
 
-            child_sort_list = sorter.fuzzysorted(child_sort_list)
-            child_ref_list = sorter.unpack(child_sort_list, 0)
+class DatabaseSnapshot():
+    """
+    Read-only in-memory copy of database tables for the duration of an export.
+
+    The tables are loaded in cursor order when the snapshot is created, through any filter proxies
+    the database is wrapped in, so the proxies decide visibility and sanitize each object only once.
+    For a loaded table, objects, handles, counts and handle checks are served from memory. If the
+    estimated size of the loaded objects would exceed the memory limit, loading stops and objects
+    not loaded are fetched from the database through an LRU cache. Everything else is passed through
+    to the database.
+
+    Loaded tables are only read after loading, so they can be used from several threads. Fetches of
+    objects not loaded and the methods passed through go through a lock, which serializes the
+    database access and the LRU cache.
+    """
 
-        # Write to gedcom
-        for cref in child_ref_list:
-            gid = self.dbase.get_person_from_handle(cref.ref).get_gramps_id()
-            if gid is None:
+    # object type, database methods iterating objects and handles, counting objects and checking a handle
+    MAIN_TABLES = (("person", "iter_people", "iter_person_handles", "get_number_of_people", "has_person_handle"),
+                   ("family", "iter_families", "iter_family_handles", "get_number_of_families",
+                    "has_family_handle"),
+                   ("event", "iter_events", "iter_event_handles", "get_number_of_events", "has_event_handle"),
+                   ("place", "iter_places", "iter_place_handles", "get_number_of_places", "has_place_handle"))
+    ALL_TABLES = MAIN_TABLES + (
+        ("source", "iter_sources", "iter_source_handles", "get_number_of_sources", "has_source_handle"),
+        ("citation", "iter_citations", "iter_citation_handles", "get_number_of_citations", "has_citation_handle"),
+        ("repository", "iter_repositories", "iter_repository_handles", "get_number_of_repositories",
+         "has_repository_handle"),
+        ("note", "iter_notes", "iter_note_handles", "get_number_of_notes", "has_note_handle"),
+        ("media", "iter_media", "iter_media_handles", "get_number_of_media", "has_media_handle"),
+        ("object", "iter_media_objects", "iter_media_object_handles", "get_number_of_media_objects",
+         "has_object_handle"))  # media in Gramps 4.2
+
+    _size_sample = 50  # objects measured per table to estimate the size of a table
+
+    def __init__(self, database, tables=MAIN_TABLES, memory_limit=None, lru_size=10000):
+        """
+        :param database:        The database, possibly filtered
+        :param tables:          Tables to load, MAIN_TABLES or ALL_TABLES
+        :param memory_limit:    Maximum estimated size of loaded objects in bytes, None for no limit
+        :param lru_size:        Size of the cache used for objects not loaded
+        """
+        self.database = database
+        self.tables = tuple(table for table in tables if hasattr(database, table[1]))
+        self.memory_limit = memory_limit
+        self.lru_size = lru_size
+        self.load_time = 0.0
+        self.size = 0  # estimated size of loaded objects in bytes
+        self.hits = 0  # fetches served without the database
+        self.misses = 0
+        self._tables = dict()  # object type -> dict of handle -> object
+        self._complete = set()  # object types loaded completely
+        self._lru = OrderedDict()  # (object type, handle) -> object
+        self._lock = threading.Lock()  # for fetches from the database and the LRU cache
+        self._methods = dict()  # database method name -> method of the snapshot
+        self._load()
+
+    def _load(self):
+        start = time.perf_counter()
+        for kind, iter_method, iter_handles_method, count_method, has_handle_method in self.tables:
+            table = dict()
+            self._tables[kind] = table
+            fetch = getattr(self.database, "get_%s_from_handle" % kind)
+            self._methods["get_%s_from_handle" % kind] = self._get_method(kind, fetch)
+            if self.memory_limit is not None and self.size >= self.memory_limit:
                 continue
-            self._writeln(1, 'CHIL', '@%s@' % gid)
-
-    #---------------
-    # Sort Events
-    # --------------
-
-    # SORT PERSON EVENTS
-    def _remaining_events(self, person):
-        """
-        Output all events associated with the person that are not BIRTH or
-        DEATH events.
-
-        Because all we have are event references, we have to
-        extract the real event to discover the event type.
-
-        """
-        global adop_written
-        # adop_written is only shared between this function and
-        # _process_person_event. This is rather ugly code, but it is difficult
-        # to support an Adoption event without an Adopted relationship from the
-        # parent(s), an Adopted relationship from the parent(s) without an
-        # event, and both an event and a relationship. All these need to be
-        # supported without duplicating the output of the ADOP GEDCOM tag. See
-        # bug report 2370.
-        adop_written = False
-
-        event_ref_list = person.get_event_ref_list()
-
-        if self.sort_events:
-            birth_sv, death_sv = self.get_birth_and_death_sort_values(person)
-            if birth_sv is not None:
-                birth_sv -= 200  # 200 days earlier, because of date mofifier logic (between and eg.)
-            if death_sv is not None:
-                death_sv += 200  # 200 days later for funerals and such
-            sorter = FuzzySort(unsortables_last=False, max_deviation=50*365)
-
-            ## preliminary sorting, sort birth first and death based event last
-            event_sort_list = self.decorate_by_event_type(event_ref_list)
-            event_sort_list2 = sorted(event_sort_list, key=lambda x: x[1])
-            event_ref_list = sorter.unpack(event_sort_list2, 0)
-
-            event_sort_list = self.decorate_by_date(event_ref_list)
-            quality, trend, unsortables, exceed1, exceed2, eval_fail = sorter.get_info(event_sort_list,
-                                                                            low_value=birth_sv,
-                                                                            high_value=death_sv)
-            # debugging
-            need_sorting = True if trend < 1 else False
-            if self.__fuzzy_debug and (need_sorting and unsortables) or exceed1 or exceed2 or need_sorting:
-                __id = person.get_gramps_id()
-                print(__id + ": " + self.__get_person_print_name(person))
-                self.__print_debug_flags(need_sorting, unsortables, exceed1 or exceed2, eval_fail)
-                print("q: " + str(quality) + ", t: " + str(trend))
-                print("----------------------------")
-
-            # Main sorting
-            event_sort_list = sorter.fuzzysorted(event_sort_list,
-                                                 low_value=birth_sv,
-                                                 high_value=death_sv)
-            event_ref_list = sorter.unpack(event_sort_list, 0)
-
-            ## finally, sort birth first and death based event last again
-            event_sort_list = self.decorate_by_event_type(event_ref_list)
-            event_sort_list = sorted(event_sort_list, key=lambda x: x[1])
-            event_ref_list = sorter.unpack(event_sort_list, 0)
-
-        for event_ref in event_ref_list:
-            event = self.dbase.get_event_from_handle(event_ref.ref)
-            if not event: continue
-            self._process_person_event(person, event, event_ref)
-        if not adop_written:
-            self._adoption_records(person, adop_written)
-
-    # SORT FAMILY EVENTS
-    def _family_events(self, family):
-        """
-        Output the events associated with the family.
-
-        Because all we have are event references, we have to extract the real
-        event to discover the event type.
-
-        """
-        event_ref_list = family.get_event_ref_list()
-
-        if self.sort_events:
-            sorter = FuzzySort(unsortables_last=False, max_deviation=35)
-            event_sort_list = self.decorate_by_date(event_ref_list)
-            event_sort_list = sorter.fuzzysorted(event_sort_list)
-            event_ref_list = sorter.unpack(event_sort_list, 0)
-
-        for event_ref in event_ref_list:  ## orginally: family.get_event_ref_list():
-            event = self.dbase.get_event_from_handle(event_ref.ref)
-            if event is None:
+            complete = True
+            sample_size = 0
+            object_size = 0
+            for obj in getattr(self.database, iter_method)():
+                if len(table) < self._size_sample:
+                    sample_size += self._deep_sizeof(obj)
+                    object_size = sample_size // (len(table) + 1)
+                if self.memory_limit is not None and self.size + object_size > self.memory_limit:
+                    complete = False
+                    break
+                table[obj.get_handle()] = obj
+                self.size += object_size
+            if complete:
+                self._complete.add(kind)
+                self._methods[iter_method] = lambda table=table: iter(list(table.values()))
+                self._methods[iter_handles_method] = lambda table=table: iter(list(table))
+                self._methods[count_method] = table.__len__
+                self._methods[has_handle_method] = table.__contains__
+        self.load_time = time.perf_counter() - start
+
+    @staticmethod
+    def _deep_sizeof(obj):
+        """
+        Returns approximate size of the object with the objects, lists and dicts it contains
+        """
+        seen = set()
+        stack = [obj]
+        size = 0
+        while stack:
+            item = stack.pop()
+            if id(item) in seen:
                 continue
-            self._process_family_event(event, event_ref)
-            self._dump_event_stats(event, event_ref)
+            seen.add(id(item))
+            size += sys.getsizeof(item)
+            if isinstance(item, dict):
+                stack.extend(item.keys())
+                stack.extend(item.values())
+            elif isinstance(item, (list, tuple, set, frozenset)):
+                stack.extend(item)
+            elif hasattr(item, "__dict__"):
+                stack.append(item.__dict__)
+        return size
+
+    def _get_method(self, kind, fetch):
+        table = self._tables[kind]
+        complete = self._complete
+        lru = self._lru
+
+        def get_from_handle(handle):
+            obj = table.get(handle)
+            if obj is not None:
+                self.hits += 1
+                return obj
+            with self._lock:
+                if kind in complete:
+                    # not in the filtered database, let it decide between None and an error
+                    self.misses += 1
+                    return fetch(handle)
+                key = (kind, handle)
+                obj = lru.get(key)
+                if obj is not None:
+                    self.hits += 1
+                    lru.move_to_end(key)
+                    return obj
+                self.misses += 1
+                obj = fetch(handle)
+                if obj is not None:
+                    lru[key] = obj
+                    if len(lru) > self.lru_size:
+                        lru.popitem(last=False)
+                return obj
+        return get_from_handle
+
+    def is_complete(self, *kinds):
+        """
+        Returns True if the tables of all the given object types, or of all snapshot tables, are
+        loaded completely
+        """
+        return all(kind in self._complete for kind in kinds or (table[0] for table in self.tables))
+
+    def _get_locked_method(self, method):
+        def locked_method(*args, **kwargs):
+            with self._lock:
+                return method(*args, **kwargs)
+        return locked_method
+
+    def __getattr__(self, name):
+        method = self.__dict__.get("_methods", {}).get(name)
+        if method is None:
+            attribute = getattr(self.database, name)
+            if not callable(attribute):
+                return attribute
+            method = self._get_locked_method(attribute)
+        setattr(self, name, method)  # found directly next time
+        return method
+
+    def format_report(self):
+        tables = ", ".join("%s %d%s" % (table[0], len(self._tables[table[0]]),
+                                        "" if table[0] in self._complete else " (partial)")
+                           for table in self.tables)
+        return ("Database snapshot: %s; loaded in %.1f ms, about %.1f MB; %d fetches served from memory, "
+                "%d from database" % (tables, self.load_time * 1000, self.size / 1048576.0, self.hits, self.misses))
+
+    def print_report(self):
+        print(self.format_report())
 
-    def decorate_by_birth(self, child_ref_list):
-        child_sort_list = []
-        for cref in child_ref_list:
-            birth_ref = self.db.get_person_from_handle(cref.ref).get_birth_ref()
-            if birth_ref is not None:
-                event = self.db.get_event_from_handle(birth_ref.ref)
-                val = event.get_date_object().get_sort_value()
-                if val == 0:
-                    val = None
-            else:
-                val = None
-            child_sort_list.append((cref, val))
-        return child_sort_list
-
-    def decorate_by_date(self, event_ref_list):
-        event_sort_list = []
-        for event_ref in event_ref_list:
-            if event_ref is not None:
-                event = self.db.get_event_from_handle(event_ref.ref)
-                val = event.get_date_object().get_sort_value()
-                if val == 0:
-                    val = None
-            else:
-                val = None
-            event_sort_list.append((event_ref, val))
-        return event_sort_list
-
-    def decorate_by_event_type(self, event_ref_list):
-        event_sort_list = []
-        for event_ref in event_ref_list:
-            if event_ref is not None:
-                val = self.get_event_type_sort_modifier(event_ref)
+#------------------------------------------------------------
+#
+# IncrementalExport
+#
+#------------------------------------------------------------
+
+class IncrementalExport():
+    """
+    Reuses unchanged INDI and FAM records of the previous export.
+
+    A manifest next to the output file lists for every person and family record its byte range in
+    the output, a hash of its text and the change times of all objects fetched from the database
+    while the record was written: the person or family itself, events, places (also those whose
+    coordinates were inherited), families, children and so on. If none of them has changed, the
+    record is copied from the previous output; otherwise it is written again. Everything is written
+    again if the options or the plugin version have changed. Other records are always written.
+    """
+
+    MANIFEST_VERSION = 1
+
+    def __init__(self, settings):
+        """
+        :param settings:    JSON compatible export settings, the previous output is not used if they differ
+        """
+        self.settings = settings
+        self.database = None
+        self.reused = 0
+        self.written = 0
+        self._previous_records = dict()
+        self._previous_filename = None
+        self._previous_file = None
+        self._records = dict()
+        self._change_times = dict()  # (kind, handle) -> current change time, None if not found
+
+    @staticmethod
+    def get_manifest_filename(filename):
+        return filename + ".manifest.json"
+
+    def install(self, writer):
+        """
+        Replaces the database of the writer with one that records dependencies of the records
+        """
+        self.database = _DependencyTrackingDatabase(writer.dbase)
+        writer.dbase = self.database
+        writer.db = self.database
+
+    def begin(self, filename):
+        """
+        Loads the manifest of the previous export and moves the previous output aside to copy
+        records from
+        """
+        manifest_filename = self.get_manifest_filename(filename)
+        if not (os.path.exists(manifest_filename) and os.path.exists(filename)):
+            return
+        try:
+            with open(manifest_filename, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+        except ValueError:
+            return
+        if manifest.get("version") != self.MANIFEST_VERSION or manifest.get("settings") != self.settings:
+            return
+        self._previous_records = manifest["records"]
+        self._previous_filename = filename + ".previous"
+        os.replace(filename, self._previous_filename)
+        self._previous_file = open(self._previous_filename, "rb")
+
+    def finish(self, filename, success):
+        """
+        Writes the manifest of a successful export. The previous output is restored if the export failed.
+        """
+        if self._previous_file is not None:
+            self._previous_file.close()
+            self._previous_file = None
+        if success:
+            manifest = dict(version=self.MANIFEST_VERSION, settings=self.settings, records=self._records)
+            manifest_filename = self.get_manifest_filename(filename)
+            with open(manifest_filename + ".tmp", "w") as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.replace(manifest_filename + ".tmp", manifest_filename)
+            if self._previous_filename is not None:
+                os.remove(self._previous_filename)
+            LOG.info("Incremental export: %d records reused, %d written", self.reused, self.written)
+        elif self._previous_filename is not None:
+            os.replace(self._previous_filename, filename)
+        self._previous_filename = None
+
+    def write_record(self, writer, kind, obj, write, *args):
+        """
+        Copies the record of the object from the previous output if possible, otherwise writes it
+        by calling write(*args).
+
+        :param writer:  GedcomWriterWithOptions
+        :param kind:    Object type as in database methods, e.g. 'person'
+        :param obj:     The person or family
+        :param write:   The writer method writing the record
+        """
+        key = kind + ":" + obj.get_handle()
+        output = writer.gedcom_file
+        entry = self._previous_records.get(key)
+        text = None
+        if entry is not None and self._is_current(entry):
+            text = self._read_previous(entry)
+        if text is not None:
+            self.reused += 1
+        else:
+            # The record is written to a buffer first, its index entry is added when it is in the output
+            buffer = io.StringIO()
+            writer.gedcom_file = buffer
+            record_index = writer.record_index
+            writer.record_index = None
+            dependencies = self.database.start_tracking()
+            try:
+                write(*args)
+            finally:
+                self.database.stop_tracking()
+                writer.gedcom_file = output
+                writer.record_index = record_index
+            text = buffer.getvalue()
+            dependencies[(kind, obj.get_handle())] = obj.get_change_time()
+            entry = dict(hash=self._hash(text), change=obj.get_change_time(),
+                         deps=[[dep_kind, handle, change] for (dep_kind, handle), change in dependencies.items()])
+            self.written += 1
+        offset = output.tell()
+        if writer.record_index is not None and text:
+            writer.record_index.start_record(text.split(" ", 2)[1], offset)
+        output.write(text)
+        self._records[key] = dict(entry, offset=offset, length=output.tell() - offset)
+
+    def _is_current(self, entry):
+        for kind, handle, change in entry["deps"]:
+            if self._get_change_time(kind, handle) != change:
+                return False
+        return True
+
+    def _get_change_time(self, kind, handle):
+        key = (kind, handle)
+        if key in self._change_times:
+            return self._change_times[key]
+        try:
+            obj = getattr(self.database.untracked, "get_%s_from_handle" % kind)(handle)
+        except Exception:  # HandleError in newer Gramps versions
+            obj = None
+        change = obj.get_change_time() if obj is not None else None
+        self._change_times[key] = change
+        return change
+
+    def _read_previous(self, entry):
+        """
+        Returns text of the record in the previous output, None if it doesn't match the hash
+        """
+        self._previous_file.seek(entry["offset"])
+        try:
+            text = self._previous_file.read(entry["length"]).decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+        if os.linesep != "\n":
+            text = text.replace(os.linesep, "\n")
+        if self._hash(text) != entry["hash"]:
+            return None
+        return text
+
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class _DependencyTrackingDatabase():
+    """
+    Passes everything through to the database, recording objects returned by get_*_from_handle
+    methods with their change times while tracking
+    """
+
+    def __init__(self, database):
+        self.untracked = database
+        self._dependencies = None
+        self._wrapped = dict()
+
+    def start_tracking(self):
+        """
+        Starts recording, returns a dictionary of (kind, handle) -> change time, filled until
+        stop_tracking() is called
+        """
+        self._dependencies = dict()
+        return self._dependencies
+
+    def stop_tracking(self):
+        self._dependencies = None
+
+    def __getattr__(self, name):
+        attr = getattr(self.untracked, name)
+        if not (name.startswith("get_") and name.endswith("_from_handle")):
+            return attr
+        wrapped = self._wrapped.get(name)
+        if wrapped is None:
+            kind = name[len("get_"):-len("_from_handle")]
+
+            def wrapped(handle, *args, **kwargs):
+                obj = attr(handle, *args, **kwargs)
+                if self._dependencies is not None:
+                    self._dependencies[(kind, handle)] = obj.get_change_time() if obj is not None else None
+                return obj
+            self._wrapped[name] = wrapped
+        return wrapped
+
+
+#------------------------------------------------------------
+#
+# RecordIndex
+#
+#------------------------------------------------------------
+
+class RecordIndex():
+    """
+    Byte offsets and lengths of level 0 records by xref, collected while writing a GEDCOM file and
+    saved as a sorted binary index file next to it. Read with RecordIndexReader.
+
+    Index file format (little endian):
+        header:     magic (8 bytes), record count (uint64)
+        entries:    sorted by xref, each key position in key data (uint64), key length (uint32),
+                    record offset (uint64), record length (uint64)
+        key data:   xrefs without @ signs, UTF-8 encoded
+    """
+
+    MAGIC = b"GEDIDX1\0"
+    HEADER = struct.Struct("<8sQ")
+    ENTRY = struct.Struct("<QIQQ")
+
+    def __init__(self):
+        self._entries = []  # [xref, offset, length]
+        self._open_entry = None
+
+    @staticmethod
+    def get_index_filename(filename):
+        return filename + ".idx"
+
+    def start_record(self, token, offset):
+        """
+        Ends the previous record and starts a new one at the offset. Records without xref
+        (HEAD, TRLR) are not indexed.
+
+        :param token:   The token of the level 0 line, e.g. '@I1@'
+        :param offset:  Byte offset of the line in the output
+        """
+        if self._open_entry is not None:
+            self._open_entry[2] = offset - self._open_entry[1]
+            self._open_entry = None
+        if token.startswith("@") and token.endswith("@") and len(token) > 2:
+            self._open_entry = [token[1:-1], offset, 0]
+            self._entries.append(self._open_entry)
+
+    def finish(self, size):
+        """
+        Ends the last record at the end of the file
+
+        :param size:    Size of the file in bytes
+        """
+        self.start_record("", size)
+
+    def write(self, filename):
+        keys = bytearray()
+        entries = []
+        for xref, offset, length in sorted(self._entries):
+            key = xref.encode("utf-8")
+            entries.append(self.ENTRY.pack(len(keys), len(key), offset, length))
+            keys += key
+        with open(filename, "wb") as index_file:
+            index_file.write(self.HEADER.pack(self.MAGIC, len(entries)))
+            index_file.write(b"".join(entries))
+            index_file.write(keys)
+
+
+class RecordIndexReader():
+    """
+    Fetches records of an exported GEDCOM file by xref, using the index written with it. Both files
+    are memory mapped and a record is found with a binary search, without parsing the GEDCOM file.
+
+    Usage:
+        with RecordIndexReader("tree.ged") as reader:
+            text = reader.get("I123")
+    """
+
+    def __init__(self, filename, index_filename=None):
+        """
+        :param filename:        The GEDCOM file
+        :param index_filename:  The index file, by default the GEDCOM file name with .idx added
+        """
+        if index_filename is None:
+            index_filename = RecordIndex.get_index_filename(filename)
+        self._files = []
+        self._index = self._map(index_filename)
+        self._data = self._map(filename)
+        magic, self._count = RecordIndex.HEADER.unpack_from(self._index, 0)
+        if magic != RecordIndex.MAGIC:
+            self.close()
+            raise ValueError("Not a GEDCOM record index: %s" % index_filename)
+        self._entries_start = RecordIndex.HEADER.size
+        self._keys_start = self._entries_start + self._count * RecordIndex.ENTRY.size
+
+    def _map(self, filename):
+        f = open(filename, "rb")
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        for data in (getattr(self, "_index", None), getattr(self, "_data", None)):
+            if isinstance(data, mmap.mmap):
+                data.close()
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _get_entry(self, i):
+        key_position, key_length, offset, length = \
+            RecordIndex.ENTRY.unpack_from(self._index, self._entries_start + i * RecordIndex.ENTRY.size)
+        start = self._keys_start + key_position
+        return self._index[start:start + key_length], offset, length
+
+    def find(self, xref):
+        """
+        Returns (byte offset, length) of the record, or None if there is no such record
+
+        :param xref:    Record xref with or without @ signs, e.g. 'I123'
+        """
+        key = xref.strip("@").encode("utf-8")
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, offset, length = self._get_entry(mid)
+            if mid_key < key:
+                lo = mid + 1
+            elif mid_key > key:
+                hi = mid
             else:
-                val = 0
-            event_sort_list.append((event_ref, val))
-        return event_sort_list
-
-    def get_birth_and_death_sort_values(self, person):
-        birth_ref = person.get_birth_ref()
-        if birth_ref is not None:
-            birth = self.db.get_event_from_handle(birth_ref.ref)
-            birth_sv = birth.get_date_object().get_sort_value()
-            if birth_sv == 0:
-                birth_sv = None
+                return offset, length
+        return None
+
+    def get_bytes(self, xref):
+        """
+        Returns the record as bytes as it is in the file, or None
+        """
+        found = self.find(xref)
+        if found is None:
+            return None
+        offset, length = found
+        return self._data[offset:offset + length]
+
+    def get(self, xref):
+        """
+        Returns the record as text, or None
+        """
+        data = self.get_bytes(xref)
+        if data is None:
+            return None
+        return data.decode("utf-8")
+
+    def xrefs(self):
+        """
+        Returns an iterator over all indexed xrefs in sorted order
+        """
+        for i in range(self._count):
+            yield self._get_entry(i)[0].decode("utf-8")
+
+
+#------------------------------------------------------------
+#
+# ExportPipeline
+#
+#------------------------------------------------------------
+
+class ExportPipeline():
+    """
+    Writes individuals or families in three overlapping stages:
+
+        prefetch    a thread fetching the objects in gramps ID order in chunks
+        render      the calling thread writing the records of a chunk into a text block with the
+                    writer's own record methods
+        write       a thread writing the blocks to the output file
+
+    The stages are connected by bounded queues, so a fast stage waits for a slow one instead of
+    filling memory. Blocks are written in the order they were rendered, so the output is the same
+    as without the pipeline. The prefetch thread reads the objects from a DatabaseSnapshot with their
+    table loaded completely, so it does not touch the database the render thread is using.
+    """
+
+    STAGES = ("prefetch", "render", "write")
+    _end = None  # queue item ending a stage
+
+    def __init__(self, chunk_size=200, queue_size=8):
+        """
+        :param chunk_size:  Objects per chunk, one block is written for each chunk
+        :param queue_size:  Maximum number of chunks waiting in each queue
+        """
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.busy = dict((stage, 0.0) for stage in self.STAGES)
+        self.elapsed = 0.0
+        self.records = 0
+
+    def write_records(self, writer, kind, iter_objects, write):
+        """
+        Writes all records of one kind
+
+        :param writer:          GedcomWriterWithOptions, writing to its gedcom_file
+        :param kind:            Object type as in database methods, e.g. 'person'
+        :param iter_objects:    Snapshot method iterating the objects in memory
+        :param write:           write(obj, handle) writes a record
+        """
+        start = time.perf_counter()
+        chunks = queue.Queue(self.queue_size)
+        blocks = queue.Queue(self.queue_size)
+        errors = []
+        output = writer.gedcom_file
+
+        prefetch_thread = threading.Thread(target=self._prefetch, args=(iter_objects, chunks, errors))
+        write_thread = threading.Thread(target=self._write, args=(output, blocks, errors))
+        prefetch_thread.daemon = True
+        write_thread.daemon = True
+        prefetch_thread.start()
+        write_thread.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is self._end:
+                    break
+                render_start = time.perf_counter()
+                buffer = io.StringIO()
+                writer.gedcom_file = buffer
+                try:
+                    for handle, obj in chunk:
+                        writer.update()
+                        write(obj, handle)
+                finally:
+                    writer.gedcom_file = output
+                self.records += len(chunk)
+                self.busy["render"] += time.perf_counter() - render_start
+                blocks.put(buffer.getvalue())
+        finally:
+            # drain the prefetch queue so that the thread is not left blocked if rendering failed
+            while prefetch_thread.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            blocks.put(self._end)
+            write_thread.join()
+        if errors:
+            raise errors[0]
+        self.elapsed += time.perf_counter() - start
+
+    def _prefetch(self, iter_objects, chunks, errors):
+        try:
+            busy_start = time.perf_counter()
+            # sorted like GedcomWriter sorts handles by gramps ID, without fetching the objects again
+            sorted_list = sorted((obj.get_gramps_id(), obj.get_handle(), obj) for obj in iter_objects())
+            chunk = []
+            for gramps_id, handle, obj in sorted_list:
+                chunk.append((handle, obj))
+                if len(chunk) >= self.chunk_size:
+                    self.busy["prefetch"] += time.perf_counter() - busy_start
+                    chunks.put(chunk)
+                    busy_start = time.perf_counter()
+                    chunk = []
+            self.busy["prefetch"] += time.perf_counter() - busy_start
+            if chunk:
+                chunks.put(chunk)
+        except Exception as err:
+            errors.append(err)
+        finally:
+            chunks.put(self._end)
+
+    def _write(self, output, blocks, errors):
+        while True:
+            block = blocks.get()
+            if block is self._end:
+                return
+            if errors:
+                continue
+            write_start = time.perf_counter()
+            try:
+                output.write(block)
+            except Exception as err:
+                errors.append(err)
+            self.busy["write"] += time.perf_counter() - write_start
+
+    def format_report(self):
+        """
+        Returns busy time and utilization of each stage. The stage with the highest utilization is
+        the bottleneck.
+        """
+        lines = ["Export pipeline: %d records in %.1f ms" % (self.records, self.elapsed * 1000)]
+        for stage in self.STAGES:
+            utilization = self.busy[stage] / self.elapsed * 100 if self.elapsed else 0.0
+            lines.append("  %-10s busy %10.1f ms %6.1f %%" % (stage, self.busy[stage] * 1000, utilization))
+        return "\n".join(lines)
+
+    def print_report(self):
+        print(self.format_report())
+
+
+#-------------------------------------------------------------------------
+#
+# ExportEstimator
+#
+#-------------------------------------------------------------------------
+
+class ExportEstimator():
+    """
+    Estimates time and size of an export by writing a stratified random sample of individuals,
+    families and places with the writer's own record methods into a null output
+
+    Objects of each kind are divided into strata by the number of events, children or enclosing
+    places, which the time and size of a record mostly depend on, and each stratum is sampled in
+    proportion to its size. Totals are extrapolated stratum by stratum, with 95 % confidence
+    intervals from the variance within the strata. Fetching an object from the database is
+    counted in the time of its record, as it is in an export.
+
+    Places are not GEDCOM records, their PLAC structures are written in events. Places are sampled
+    for the cost of one PLAC structure, which is already included in the totals of individuals
+    and families. Header, sources, repositories, notes and media objects are not estimated.
+
+    Time of the profiled phases is estimated by splitting the estimated time by the shares of the
+    phases in a second, profiled pass over the same sample, so that the estimated time is free of
+    profiling overhead.
+    """
+
+    KINDS = ("person", "family", "place")
+    Z = 1.96  # 95 % confidence
+
+    _iterators = dict(person="iter_people", family="iter_families", place="iter_places")
+
+    def __init__(self, writer, sample_size=1000, seed=None):
+        """
+        :param writer:      GedcomWriterWithOptions with the options to estimate. Its incremental
+                            export, record index and anomaly log are not used.
+        :param sample_size: Number of objects sampled of each kind
+        :param seed:        Seed of the random sample, the same seed gives the same sample
+        """
+        self.writer = writer
+        self.sample_size = sample_size
+        self.random = random.Random(seed)
+        self.fixed_time = 0.0  # building the person index
+        self.results = dict()  # kind -> dict of count, sampled, time, time_variance, size, size_variance
+        self.phases = dict()  # phase -> estimated seconds
+
+    def estimate(self, kinds=KINDS, phases=True):
+        """
+        Samples and writes the objects, returns the results by kind
+
+        :param kinds:   Object types to sample
+        :param phases:  Estimate also the time of the profiled phases
+        """
+        writer = self.writer
+        writer.incremental_export = None
+        writer.record_index = None
+        writer.anomaly_log = None
+        output = getattr(writer, "gedcom_file", None)
+        writer.gedcom_file = _NullOutput()
+        try:
+            start = time.perf_counter()
+            writer._get_person_index()
+            self.fixed_time = time.perf_counter() - start
+
+            samples = dict()
+            for kind in kinds:
+                count, strata, samples[kind] = self._draw_sample(kind)
+                measured = self._measure(kind, samples[kind], strata)
+                total_time, time_variance = self._extrapolate(measured, 0)
+                total_size, size_variance = self._extrapolate(measured, 1)
+                self.results[kind] = dict(count=count, sampled=len(samples[kind]),
+                                          time=total_time, time_variance=time_variance,
+                                          size=total_size, size_variance=size_variance)
+
+            if phases and writer.export_profile is None:
+                writer.export_profile = GedcomExportProfile()
+                writer.export_profile.install(writer)
+            for kind in ("person", "family") if phases else ():
+                if kind not in samples:
+                    continue
+                self._estimate_phases(kind, samples[kind], self.results[kind]["time"])
+        finally:
+            writer.gedcom_file = output
+        return self.results
+
+    def _draw_sample(self, kind):
+        """
+        Returns the number of objects, their strata as stratum -> number of objects, and a shuffled
+        list of sampled (stratum, handle)
+        """
+        handles = dict()
+        for obj in getattr(self.writer.dbase, self._iterators[kind])():
+            handles.setdefault(self._get_stratum(kind, obj), []).append(obj.get_handle())
+        count = sum(len(stratum_handles) for stratum_handles in handles.values())
+        strata = dict()
+        sample = []
+        for stratum, stratum_handles in handles.items():
+            size = max(2, int(round(self.sample_size * len(stratum_handles) / count)))
+            strata[stratum] = len(stratum_handles)
+            sample.extend((stratum, handle)
+                          for handle in self.random.sample(stratum_handles, min(size, len(stratum_handles))))
+        self.random.shuffle(sample)  # strata mixed, so that warming caches do not favour any
+        return count, strata, sample
+
+    @staticmethod
+    def _get_stratum(kind, obj):
+        if kind == "person":
+            return len(obj.get_event_ref_list()).bit_length()
+        if kind == "family":
+            return len(obj.get_event_ref_list()).bit_length(), len(obj.get_child_ref_list()).bit_length()
+        return len(obj.get_placeref_list()), bool(obj.get_latitude() and obj.get_longitude())
+
+    def _write(self, kind, handle):
+        writer = self.writer
+        if kind == "person":
+            writer._person(writer.dbase.get_person_from_handle(handle))
+        elif kind == "family":
+            writer._write_family(writer.dbase.get_family_from_handle(handle))
         else:
-            birth_sv = None
-
-        death_ref = person.get_death_ref()
-        if death_ref is not None:
-            death = self.db.get_event_from_handle(death_ref.ref)
-            death_sv = death.get_date_object().get_sort_value()
-            if death_sv == 0:
-                death_sv = None
+            writer._place(writer.dbase.get_place_from_handle(handle), None, 2)
+
+    def _measure(self, kind, sample, strata):
+        """
+        Writes the sample, returns stratum -> (number of objects, [(seconds, bytes)])
+        """
+        output = self.writer.gedcom_file
+        measured = dict((stratum, (count, [])) for stratum, count in strata.items())
+        for stratum, handle in sample:
+            position = output.tell()
+            start = time.perf_counter()
+            self._write(kind, handle)
+            measured[stratum][1].append((time.perf_counter() - start, output.tell() - position))
+        return measured
+
+    @staticmethod
+    def _extrapolate(measured, index):
+        """
+        Returns stratified estimate of the total and its variance, with finite population correction
+        """
+        total = 0.0
+        variance = 0.0
+        for count, values in measured.values():
+            n = len(values)
+            mean = sum(value[index] for value in values) / n
+            total += count * mean
+            if 1 < n < count:
+                sample_variance = sum((value[index] - mean) ** 2 for value in values) / (n - 1)
+                variance += count * count * (1 - n / count) * sample_variance / n
+        return total, variance
+
+    def _estimate_phases(self, kind, sample, estimated_time):
+        profile = self.writer.export_profile
+        before = profile.get_stats()["phases"]
+        profile.start()
+        for stratum, handle in sample:
+            self._write(kind, handle)
+        profile.stop()
+        after = profile.get_stats()["phases"]
+        seconds = dict((phase, after[phase]["self"] - before[phase]["self"]) for phase in after)
+        sampled = sum(seconds.values())
+        for phase, phase_seconds in seconds.items():
+            share = phase_seconds / sampled if sampled > 0 else 0.0
+            self.phases[phase] = self.phases.get(phase, 0.0) + share * estimated_time
+
+    def _format_interval(self, value, variance, scale, unit):
+        return "%10.1f %s \u00b1 %.1f %s" % (value / scale, unit, self.Z * math.sqrt(variance) / scale, unit)
+
+    def format_report(self):
+        """
+        Returns estimated time and size of individuals and families, cost of a PLAC structure and
+        estimated time of the phases
+        """
+        lines = ["Export estimate, 95 % confidence intervals:"]
+        total = dict(time=self.fixed_time, time_variance=0.0, size=0.0, size_variance=0.0)
+        for kind, label in (("person", "Individuals"), ("family", "Families")):
+            result = self.results[kind]
+            for key in total:
+                total[key] += result[key]
+            lines.append("  %-12s %8d of %8d %s %s" % (label, result["sampled"], result["count"],
+                         self._format_interval(result["time"], result["time_variance"], 1, "s"),
+                         self._format_interval(result["size"], result["size_variance"], 1048576, "MB")))
+        lines.append("  %-12s %20s %s %s" % ("Total", "",
+                     self._format_interval(total["time"], total["time_variance"], 1, "s"),
+                     self._format_interval(total["size"], total["size_variance"], 1048576, "MB")))
+        place = self.results["place"]
+        if place["count"]:
+            lines.append("  %-12s %8d of %8d %s %10.0f bytes per PLAC structure" % (
+                         "Places", place["sampled"], place["count"],
+                         self._format_interval(place["time"] / place["count"],
+                                               place["time_variance"] / place["count"] ** 2, 0.001, "ms"),
+                         place["size"] / place["count"]))
+        lines.append("  %-20s %10.1f s" % ("Person index", self.fixed_time))
+        for phase, seconds in sorted(self.phases.items(), key=lambda x: x[1], reverse=True):
+            lines.append("  %-20s %10.1f s" % (phase, seconds))
+        return "\n".join(lines)
+
+    def print_report(self):
+        print(self.format_report())
+
+
+class _NullOutput():
+    """
+    Output file discarding the text, counting its size in UTF-8 bytes
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text.encode("utf-8"))
+
+    def tell(self):
+        return self.size
+
+
+#-------------------------------------------------------------------------
+#
+# ShardedExport
+#
+#-------------------------------------------------------------------------
+
+class ShardedExport():
+    """
+    Writes an export as several GEDCOM files, shards, each with its own header and trailer and the
+    sources, repositories, notes and media objects referenced by its individuals and families.
+
+    Individuals and families are divided into shards either by count, in gramps ID order with
+    each family in the shard of its father, mother or first child, or by branch, keeping people
+    connected by families in the same shard and packing the branches into shards of about the
+    same number of records. Links between shards are kept, so shards divided by count refer to
+    individuals and families in other shards, which appear when the shards are imported or
+    combined. The number of shards can be estimated from a size limit with ExportEstimator.
+
+    Shards are written concurrently by shallow copies of the writer, sharing its database
+    snapshot and person index, but with caches of their own. The snapshot must hold all tables, so the threads
+    read objects from memory, and the objects of each shard are collected before the threads
+    are started. A manifest next to the output file lists the files
+    and the gramps IDs of the objects in each.
+    """
+
+    MODES = ("count", "branch")
+
+    _size_sample = 200  # objects of each kind sampled when estimating the number of shards
+    _size_fill = 0.9  # room left in a shard for the variation of sizes
+
+    def __init__(self, shards=4, shard_by="count", size_limit=None, workers=4):
+        """
+        :param shards:      Number of shards
+        :param shard_by:    'count' or 'branch'
+        :param size_limit:  Approximate maximum size of a shard in bytes. If given, the number of
+                            shards is estimated from it.
+        :param workers:     Number of shards written at the same time
+        """
+        if shard_by not in self.MODES:
+            raise ValueError("Unknown shard mode: %s" % shard_by)
+        self.shards = max(1, shards or 1)
+        self.shard_by = shard_by
+        self.size_limit = size_limit
+        self.workers = max(1, workers)
+        self.elapsed = 0.0
+        self.manifest = None
+
+    @staticmethod
+    def get_shard_filename(filename, number):
+        root, ext = os.path.splitext(filename)
+        return "%s.%03d%s" % (root, number, ext or ".ged")
+
+    @staticmethod
+    def get_manifest_filename(filename):
+        return filename + ".shards.json"
+
+    def write(self, writer, filename):
+        """
+        Writes the shards and the manifest instead of the file
+
+        :param writer:      GedcomWriterWithOptions with the options of the export
+        :param filename:    Name of the export, the shards are named after it
+        :return:            True if written
+        """
+        start = time.perf_counter()
+        writer._get_person_index()  # built here to be shared by the shard writers
+        shards = self._get_shard_count(writer)
+        if self.shard_by == "branch":
+            assignment = self._assign_by_branch(writer.dbase, shards)
         else:
-            death_sv = None
-        return birth_sv, death_sv
-
-    def get_event_type_sort_modifier(self, event_ref):
-        event = self.db.get_event_from_handle(event_ref.ref)
-        event_type = event.get_type()
-        val = 0
-        if event_type == EventType.BIRTH:
-            val = -1
-        if event_type == EventType.DEATH:
-            val = 1
-        if event_type == EventType.CAUSE_DEATH:
-            val = 2
-        if event_type == EventType.CREMATION:
-            val = 3
-        if event_type == EventType.BURIAL:
-            val = 4
-        return val
-
-
-    def has_individuals_without_birthdate(self, a_list):
-        for cref in a_list:
-            birth_ref = self.dbase.get_person_from_handle(cref.ref).get_birth_ref()
-            if birth_ref is None:
-                    return True
-        return False
+            assignment = self._assign_by_count(writer.dbase, shards)
+        assignment = [item for item in assignment if item[0] or item[1]] or [([], [])]
+        databases = [_ShardDatabase(writer.dbase, person_handles, family_handles)
+                     for person_handles, family_handles in assignment]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self._write_shard, writer, self.get_shard_filename(filename, number + 1),
+                                       database)
+                       for number, database in enumerate(databases)]
+            entries = [future.result() for future in futures]
+
+        self.manifest = dict(version=__version__, shard_by=self.shard_by, shards=entries)
+        with open(self.get_manifest_filename(filename), "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=1, sort_keys=True)
+        self.elapsed = time.perf_counter() - start
+        return True
+
+    def _get_shard_count(self, writer):
+        if not self.size_limit:
+            return self.shards
+        # the estimator changes the writer it is given
+        estimator = ExportEstimator(copy.copy(writer), sample_size=self._size_sample)
+        results = estimator.estimate(kinds=("person", "family"), phases=False)
+        size = results["person"]["size"] + results["family"]["size"]
+        return max(1, int(math.ceil(size / (self.size_limit * self._size_fill))))
+
+    @staticmethod
+    def _assign_by_count(database, shards):
+        """
+        Returns a list of (person handles, family handles) for each shard
+        """
+        assignment = [([], []) for number in range(shards)]
+        persons = sorted((person.get_gramps_id(), person.get_handle()) for person in database.iter_people())
+        shard_of = dict()
+        for index, (gramps_id, handle) in enumerate(persons):
+            shard = index * shards // len(persons)
+            shard_of[handle] = shard
+            assignment[shard][0].append(handle)
+        families = sorted(database.iter_families(), key=lambda family: family.get_gramps_id())
+        for index, family in enumerate(families):
+            members = [family.get_father_handle(), family.get_mother_handle()]
+            members.extend(child_ref.ref for child_ref in family.get_child_ref_list())
+            shard = next((shard_of[handle] for handle in members if handle in shard_of),
+                         index * shards // len(families))
+            assignment[shard][1].append(family.get_handle())
+        return assignment
+
+    @staticmethod
+    def _assign_by_branch(database, shards):
+        """
+        Returns a list of (person handles, family handles) for each shard, the largest branches
+        placed first, each in the shard with the fewest records
+        """
+        parent = dict((handle, handle) for handle in database.iter_person_handles())
+
+        def find(handle):
+            while parent[handle] != handle:
+                parent[handle] = parent[parent[handle]]
+                handle = parent[handle]
+            return handle
+
+        family_members = []
+        for family in database.iter_families():
+            members = [family.get_father_handle(), family.get_mother_handle()]
+            members.extend(child_ref.ref for child_ref in family.get_child_ref_list())
+            members = [handle for handle in members if handle in parent]
+            family_members.append((family.get_handle(), members))
+            for handle in members[1:]:
+                parent[find(handle)] = find(members[0])
+
+        branches = dict()  # root -> (person handles, family handles)
+        for handle in parent:
+            branches.setdefault(find(handle), ([], []))[0].append(handle)
+        for family_handle, members in family_members:
+            root = find(members[0]) if members else family_handle
+            branches.setdefault(root, ([], []))[1].append(family_handle)
+
+        assignment = [([], []) for number in range(shards)]
+        sizes = [(0, number) for number in range(shards)]
+        for person_handles, family_handles in sorted(branches.values(), key=lambda x: len(x[0]) + len(x[1]),
+                                                     reverse=True):
+            size, shard = heapq.heappop(sizes)
+            assignment[shard][0].extend(person_handles)
+            assignment[shard][1].extend(family_handles)
+            heapq.heappush(sizes, (size + len(person_handles) + len(family_handles), shard))
+        return assignment
+
+    def _write_shard(self, writer, filename, database):
+        shard_writer = copy.copy(writer)
+        shard_writer.dbase = database
+        shard_writer.db = database
+        shard_writer.sharded_export = None
+        # The caches of the writer are not shared by the threads. The person index is, but it is built
+        # before the threads start and only read by them. The parser locks its cache of compiled formats.
+        shard_writer._new_caches()
+        shard_writer.update = self._update  # progress of the user interface is not updated from threads
+        from gramps.plugins.export import exportgedcom
+        if not exportgedcom.GedcomWriter.write_gedcom_file(shard_writer, filename):
+            raise IOError("Shard not written: %s" % filename)
+        return dict(file=os.path.basename(filename), size=os.path.getsize(filename), records=database.get_gramps_ids())
+
+    @staticmethod
+    def _update():
+        pass
+
+    def format_report(self):
+        lines = ["Sharded export: %d shards in %.1f ms" % (len(self.manifest["shards"]), self.elapsed * 1000)]
+        for entry in self.manifest["shards"]:
+            lines.append("  %-30s %12d bytes %8d individuals %8d families" % (
+                entry["file"], entry["size"], len(entry["records"].get("person", ())),
+                len(entry["records"].get("family", ()))))
+        return "\n".join(lines)
+
+    def print_report(self):
+        print(self.format_report())
+
+
+class _ShardDatabase():
+    """
+    Passes everything through to the database, but lists only the individuals and families of a
+    shard and the objects referenced by them. Objects of other shards can still be fetched, so
+    links to them are written.
+    """
+
+    # object type, database methods listing handles, iterating handles, iterating objects and counting objects
+    TABLES = (("person", "get_person_handles", "iter_person_handles", "iter_people", "get_number_of_people"),
+              ("family", "get_family_handles", "iter_family_handles", "iter_families", "get_number_of_families"),
+              ("source", "get_source_handles", "iter_source_handles", "iter_sources", "get_number_of_sources"),
+              ("repository", "get_repository_handles", "iter_repository_handles", "iter_repositories",
+               "get_number_of_repositories"),
+              ("note", "get_note_handles", "iter_note_handles", "iter_notes", "get_number_of_notes"),
+              ("media", "get_media_handles", "iter_media_handles", "iter_media", "get_number_of_media"),
+              ("object", "get_media_object_handles", "iter_media_object_handles", "iter_media_objects",
+               "get_number_of_media_objects"))  # media in Gramps 4.2
+
+    # referenced objects followed when collecting the objects of a shard, individuals and families are not
+    _followed = dict(Event="event", Place="place", Citation="citation", Source="source", Repository="repository",
+                     Note="note", Media="media", MediaObject="object")
+
+    def __init__(self, database, person_handles, family_handles):
+        self.database = database
+        self.handles = dict(person=person_handles, family=family_handles)  # object type -> list of handles
+        self._collect_referenced()
+        self._methods = dict()
+        for kind, get_handles_method, iter_handles_method, iter_method, count_method in self.TABLES:
+            if hasattr(database, "get_%s_from_handle" % kind):
+                handles = self.handles.get(kind, [])
+                fetch = getattr(database, "get_%s_from_handle" % kind)
+                self._methods[get_handles_method] = lambda *args, handles=handles, **kwargs: list(handles)
+                self._methods[iter_handles_method] = lambda handles=handles: iter(list(handles))
+                self._methods[iter_method] = lambda handles=handles, fetch=fetch: (fetch(handle) for handle in handles)
+                self._methods[count_method] = handles.__len__
+
+    def _collect_referenced(self):
+        seen = set()
+        stack = [self.database.get_person_from_handle(handle) for handle in self.handles["person"]]
+        stack.extend(self.database.get_family_from_handle(handle) for handle in self.handles["family"])
+        while stack:
+            obj = stack.pop()
+            if obj is None:
+                continue
+            for class_name, handle in obj.get_referenced_handles_recursively():
+                kind = self._followed.get(class_name)
+                if kind is None or (kind, handle) in seen:
+                    continue
+                seen.add((kind, handle))
+                referenced = getattr(self.database, "get_%s_from_handle" % kind)(handle)
+                if referenced is not None:
+                    self.handles.setdefault(kind, []).append(handle)
+                    stack.append(referenced)
+
+    def get_gramps_ids(self):
+        """
+        Returns object type -> sorted gramps IDs of the objects listed in the shard
+        """
+        gramps_ids = dict()
+        for kind, get_handles_method, iter_handles_method, iter_method, count_method in self.TABLES:
+            if self.handles.get(kind):
+                fetch = getattr(self.database, "get_%s_from_handle" % kind)
+                gramps_ids[kind] = sorted(fetch(handle).get_gramps_id() for handle in self.handles[kind])
+        return gramps_ids
+
+    def __getattr__(self, name):
+        method = self.__dict__.get("_methods", {}).get(name)
+        if method is None:
+            return getattr(self.database, name)
+        setattr(self, name, method)  # found directly next time
+        return method
+
+
+#-------------------------------------------------------------------------
+#
+# GedcomWriter Options
+#
+#-------------------------------------------------------------------------
+
+class GedcomWriterOptions():
+    """
+    Options of GedcomWriterWithOptions without GUI. Used when exporting from command line, and
+    as a base for GedcomWriterOptionBox.
+
+    """
+
+    _option_defaults = (("sort_children", 1),
+                        ("sort_events", 1),
+                        ("reversed_places", 1),
+                        ("get_coordinates", 1),
+                        ("export_only_useful_pe_addresses", 1),
+                        ("extended_pe_addresses", 1),
+                        ("avoid_repetition_in_places", 1),
+                        ("include_tng_place_levels", 1),
+                        ("omit_borough_from_address", 1),
+                        ("move_patronymics", 1),
+                        ("materialize_filters", 0))
+    _option_names = frozenset(name for name, value in _option_defaults)
+
+    def __init__(self, private=True, address_format=None, profile=False, incremental=False, record_index=False,
+                 snapshot=False, snapshot_memory_limit=None, pipeline=False, anomaly_log=None,
+                 anomaly_log_rate=1000, shards=0, shard_by="count", shard_size=None, shard_workers=4, **options):
+        """
+        :param private:         Don't export records marked private
+        :param address_format:  A list of custom address format strings, None for defaults
+        :param profile:         Collect an export profile, reported next to the output file, and timings
+                                of address format strings
+        :param incremental:     Reuse unchanged records of the previous export to the same file
+        :param record_index:    Write an index of record byte ranges next to the output file
+        :param snapshot:        Load the main tables in memory for the export
+        :param snapshot_memory_limit:   Memory limit of the snapshot in megabytes, None for no limit
+        :param pipeline:        Fetch, write and output individuals and families in overlapping stages,
+                                with the main tables loaded in memory
+        :param anomaly_log:     File name for logging sorting anomalies (CSV, or JSON lines if .jsonl)
+        :param anomaly_log_rate:    Maximum rows per second in the anomaly log
+        :param shards:          Number of files to write the export in, 0 for a single file. Shards are
+                                written with all tables loaded in memory.
+        :param shard_by:        Divide records into shards by 'count' or by 'branch'
+        :param shard_size:      Approximate maximum size of a shard in megabytes, instead of a number of shards
+        :param shard_workers:   Number of shards written at the same time
+        :param options:         Values for options in _option_defaults
+        """
+        self._set_option_defaults()
+        self.private = private
+        self.profile = profile
+        self.incremental = incremental
+        self.record_index = record_index
+        self.snapshot = snapshot
+        self.snapshot_memory_limit = snapshot_memory_limit
+        self.pipeline = pipeline
+        self.anomaly_log = anomaly_log
+        self.anomaly_log_rate = anomaly_log_rate
+        self.shards = shards
+        self.shard_by = shard_by
+        self.shard_size = shard_size
+        self.shard_workers = shard_workers
+        for name, value in options.items():
+            if name not in self._option_names:
+                raise TypeError("Unknown option: %s" % name)
+            setattr(self, name, value)
+        if address_format is not None:
+            self.set_address_format(address_format)
+
+    def _set_option_defaults(self):
+        for name, value in self._option_defaults:
+            setattr(self, name, value)
+        self.address_format = None  # compiled custom address formats, None for defaults
+        self.address_format_errors = []
+        self.profile = False  # not available in GUI
+        self.incremental = False  # not available in GUI
+        self.record_index = False  # not available in GUI
+        self.snapshot = False  # not available in GUI
+        self.snapshot_memory_limit = None
+        self.pipeline = False  # not available in GUI
+        self.anomaly_log = None  # not available in GUI
+        self.anomaly_log_rate = 1000
+        self.shards = 0  # not available in GUI
+        self.shard_by = "count"
+        self.shard_size = None
+        self.shard_workers = 4
+
+    def parse_options(self):
+        """
+        Options are given in the constructor, nothing to parse.
+        """
+        pass
+
+    def get_filtered_database(self, database, progress=None, user=None):
+        """
+        Returns the database to be exported, private records filtered out if wanted.
+        """
+        if self.private:
+            from gramps.gen.proxy import PrivateProxyDb
+            database = PrivateProxyDb(database)
+        return database
+
+    def set_address_format(self, address_format):
+        """
+        Validates and compiles custom address formats. Errors are stored in address_format_errors,
+        and the export is not started if there are any.
+
+        :param address_format:  A list of format strings in order ADR1, ADR2, CITY, STAE, CTRY, POST
+        :return:
+        """
+        parser = FormatStringParser(PlaceComponents.KEYS)
+        labels = self._get_address_format_labels()
+        self.address_format_errors = []
+        if len(address_format) != len(labels):
+            self.address_format_errors.append(_("Expected %(expected)d address formats, got %(count)d")
+                                              % dict(expected=len(labels), count=len(address_format)))
+            self.address_format = None
+            return
+        for label, format_string in zip(labels, address_format):
+            for error in parser.validate(format_string):
+                self.address_format_errors.append("%s: %s" % (label, error))
+        self.address_format = [parser.compile(format_string) for format_string in address_format]
+
+    @staticmethod
+    def _get_address_format_labels():
+        return [_("Address line 1"), _("Address line 2"), _("City"), _("State"), _("Country"), _("Postal code")]
+
+
+def _import_plugin_module(name):
+    """
+    Imports a module of this plugin. Gramps takes the plugin directory out of sys.path after
+    loading the plugin, so the module is loaded from the directory of this file.
+    """
+    module = sys.modules.get(name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(
+            name, os.path.join(os.path.dirname(os.path.abspath(__file__)), name + ".py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[name]
+            raise
+    return module
+
+
+def export_data(database, filename, user, option_box=None):
+    """
+    External interface used to register with the plugin system.
+    """
+    ret = False
+    if option_box and option_box.address_format_errors:
+        user.notify_error(_("Invalid address format"), "\n".join(option_box.address_format_errors))
+        return ret
+    try:
+        writer_class = _import_plugin_module("GedcomOptionsWriter").GedcomWriterWithOptions
+        ged_write = writer_class(database, user, option_box)
+        ret = ged_write.write_gedcom_file(filename)
+    except IOError as msg:
+        msg2 = _("Could not create %s") % filename
+        user.notify_error(msg2, msg)
+    except DatabaseError as msg:
+        user.notify_db_error(_("Export failed"), msg)
+    return ret
+
+
+def estimate_export(database, user, option_box=None, sample_size=1000, seed=None):
+    """
+    Estimates time and size of export_data() with the options from a sample, without writing
+    anything. Returns the ExportEstimator, or None if the options are not valid.
+    """
+    if option_box and option_box.address_format_errors:
+        user.notify_error(_("Invalid address format"), "\n".join(option_box.address_format_errors))
+        return None
+    try:
+        writer_class = _import_plugin_module("GedcomOptionsWriter").GedcomWriterWithOptions
+        estimator = ExportEstimator(writer_class(database, user, option_box), sample_size, seed)
+        estimator.estimate()
+    except DatabaseError as msg:
+        user.notify_db_error(_("Export failed"), msg)
+        return None
+    return estimator
+
 
-    def __get_person_print_name(self, person):
-        name = person.get_primary_name()
-        firstname = name.get_first_name().strip()
-        surname = name.get_surname().replace('/', ' ')
-        pname = '%s %s' % (firstname, surname)
-        return pname
+def _open_family_tree(name, force_unlock=False):
+    """
+    Opens a family tree for command line export. Returns None, telling why, if the tree does not
+    exist, is locked by another session and force_unlock is not set, or Gramps is older than 5.0.
+    """
+    try:
+        from gramps.gen.db.utils import lookup_family_tree, open_database
+    except ImportError:
+        print("Exporting from command line needs Gramps 5.0 or later", file=sys.stderr)
+        return None
 
-    def __get_family_print_name(self, family):
-        father_handle = family.get_father_handle()
-        mother_handle = family.get_mother_handle()
+    found = lookup_family_tree(name)
+    if found is None:
+        print("Family tree not found: %s" % name, file=sys.stderr)
+        return None
+    path, locked, locked_by, backend = found
+    if locked and not force_unlock:
+        print("Family tree %s is locked by %s, close it first or use --force-unlock" % (name, locked_by),
+              file=sys.stderr)
+        return None
+    return open_database(name, force_unlock=force_unlock)
+
+
+def main(argv=None):
+    """
+    Command line interface for exporting without Gramps GUI:
 
-        if father_handle is not None:
-            father = self.db.get_person_from_handle(father_handle)
-            fstr = self.__get_person_print_name(father)
-        else:
-            fstr = "   "
-        if mother_handle is not None:
-            mother = self.db.get_person_from_handle(mother_handle)
-            mstr = self.__get_person_print_name(mother)
+        python GedcomOptions.py [options] DATABASE OUTPUT.ged
+    """
+    import argparse
+    from gramps.cli.user import User
+
+    parser = argparse.ArgumentParser(description="GEDCOM export with extra options")
+    parser.add_argument("database", help="name of the Gramps family tree")
+    parser.add_argument("filename", help="GEDCOM file to write")
+    parser.add_argument("--include-private", action="store_true", help="export also records marked private")
+    parser.add_argument("--address-format", nargs=6, metavar="FORMAT",
+                        help="custom address formats for ADR1, ADR2, CITY, STAE, CTRY and POST")
+    for name, value in GedcomWriterOptions._option_defaults:
+        if value:
+            parser.add_argument("--no-" + name.replace("_", "-"), dest=name, action="store_false", default=value)
         else:
-            mstr = "  "
-        return fstr + " / " + mstr
-
-    def __print_debug_flags(self, need_sorting, unsortables, exceed, evaluate_fail):
-        if need_sorting is True:
-            print("Sorting needed  ", end="")
-        if unsortables is True:
-            print("Unsortables  ", end="")
-        if exceed is True:
-            print("Erroneous values  ", end="")
-        if need_sorting and unsortables and evaluate_fail:
-            print("Unsortable evaluation failed  ", end="")
-        print("")
+            parser.add_argument("--" + name.replace("_", "-"), dest=name, action="store_true", default=value)
+    parser.add_argument("--incremental", action="store_true",
+                        help="reuse unchanged person and family records of the previous export to the same file")
+    parser.add_argument("--index", action="store_true",
+                        help="write an index of record byte offsets next to the output file")
+    parser.add_argument("--snapshot", nargs="?", type=int, const=0, metavar="MB",
+                        help="load people, families, events and places in memory, optionally limited to MB megabytes")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="fetch, format and write individuals and families in overlapping stages, "
+                             "loading the main tables in memory as with --snapshot")
+    parser.add_argument("--anomaly-log", metavar="FILE",
+                        help="log events and children not in date order to FILE (CSV, or JSON lines if .jsonl)")
+    parser.add_argument("--anomaly-log-rate", type=int, default=1000, metavar="ROWS",
+                        help="maximum rows per second in the anomaly log")
+    parser.add_argument("--shards", type=int, default=0, metavar="N",
+                        help="write the export in N files, loading all tables in memory")
+    parser.add_argument("--shard-by", choices=ShardedExport.MODES, default="count",
+                        help="divide records into shards by count or by connected branches")
+    parser.add_argument("--shard-size", type=int, metavar="MB",
+                        help="write shards of about MB megabytes at most, number of shards estimated")
+    parser.add_argument("--shard-workers", type=int, default=4, metavar="N", help="write N shards at the same time")
+    parser.add_argument("--profile", action="store_true",
+                        help="print an export profile and timings of address formats, and write the export "
+                             "profile as JSON next to the output file")
+    parser.add_argument("--estimate", nargs="?", type=int, const=1000, metavar="N",
+                        help="estimate export time and size from a sample of N objects of each kind, "
+                             "without writing the file")
+    parser.add_argument("--seed", type=int, help="seed of the estimate sample")
+    parser.add_argument("--force-unlock", action="store_true",
+                        help="open the family tree even if it is locked by another session")
+    parser.add_argument("--import-time", action="store_true", help="print the time taken to import this module")
+    args = parser.parse_args(argv)
+
+    if args.import_time:
+        print("Module imported in %.1f ms" % (_import_time * 1000))
+
+    # reports and warnings of the export are logged, and printed when exporting from command line
+    if not LOG.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        LOG.addHandler(handler)
+        LOG.setLevel(logging.INFO)
+        LOG.propagate = False
+
+    options = GedcomWriterOptions(private=not args.include_private,
+                                  address_format=args.address_format,
+                                  profile=args.profile,
+                                  incremental=args.incremental,
+                                  record_index=args.index,
+                                  snapshot=args.snapshot is not None,
+                                  snapshot_memory_limit=args.snapshot or None,
+                                  pipeline=args.pipeline,
+                                  anomaly_log=args.anomaly_log,
+                                  anomaly_log_rate=args.anomaly_log_rate,
+                                  shards=args.shards,
+                                  shard_by=args.shard_by,
+                                  shard_size=args.shard_size,
+                                  shard_workers=args.shard_workers,
+                                  **dict((name, int(getattr(args, name)))
+                                         for name, value in GedcomWriterOptions._option_defaults))
+    database = _open_family_tree(args.database, args.force_unlock)
+    if database is None:
+        return 1
+    try:
+        if args.estimate is not None:
+            estimator = estimate_export(database, User(), options, args.estimate, args.seed)
+            if estimator is None:
+                return 1
+            estimator.print_report()
+            return 0
+        ret = export_data(database, args.filename, User(), options)
+    finally:
+        database.close()
+    return 0 if ret else 1
 
 
-#-------------------------------------------------------------------------
+# ===================================================================================================================
 #
-# GedcomWriter Options
+# PLACE TITLE FORMATTER
 #
-#-------------------------------------------------------------------------
+# ===================================================================================================================
 
-class GedcomWriterOptionBox(WriterOptionBox):
+class PlaceTitleFormatter():
     """
-    Create a VBox with the option widgets and define methods to retrieve
-    the options.
+    Transforms displayed place titles in one pass: the title is split into components once, the
+    enabled transforms are applied to the tuple of components, and the result is joined once.
+    Results are cached by title, so a formatter should be created for each set of options.
+
+    Transforms are applied in order:
+        avoid_repetition    Remove place names that are repeated in other names of the title
+        reverse             Reverse the order of place names
+        replace_cr          Replace carriage returns with spaces
 
+    When neither avoid_repetition nor reverse is used, the title is not split at all.
     """
-    def __init__(self, person, dbstate, uistate):
-        """
-        Initialize the local options.
-        """
-        super(GedcomWriterOptionBox, self).__init__(person, dbstate, uistate)
-        self.sort_children = 1
-        self.sort_children_check = None
-        self.sort_events = 1
-        self.sort_events_check = None
-        self.reversed_places = 1
-        self.reversed_places_check = None
-        self.get_coordinates = 1
-        self.get_coordinates_check = None
-        self.export_only_useful_pe_addresses = 1
-        self.export_only_useful_pe_addresses_check = None
-        self.extended_pe_addresses = 1
-        self.extended_pe_addresses_check = None
-        self.avoid_repetition_in_places = 1
-        self.avoid_repetition_in_places_check = None
-        self.include_tng_place_levels = 1
-        self.include_tng_place_levels_check = None
-        self.omit_borough_from_address = 1
-        self.omit_borough_from_address_check = None
-        self.move_patronymics = 1
-        self.move_patronymics_check = None
-
-    def get_option_box(self):
-        option_box = super(GedcomWriterOptionBox, self).get_option_box()
-
-        # Make options:
-        self.sort_children_check = \
-            Gtk.CheckButton(_("Smart sort children"))
-        self.sort_events_check = \
-            Gtk.CheckButton(_("Smart sort events"))
-        self.reversed_places_check = \
-            Gtk.CheckButton(_("Reverse place names"))
-        #self.reversed_places_check.set_help(_("Use reverse order in place titles"))
-        self.avoid_repetition_in_places_check = \
-            Gtk.CheckButton(_("Avoid repetition in place names"))
-        self.extended_pe_addresses_check = \
-            Gtk.CheckButton(_("Extended addresses"))
-        self.export_only_useful_pe_addresses_check = \
-            Gtk.CheckButton(_("Omit addresses without info in addition to place name"))
-        self.omit_borough_from_address_check = \
-            Gtk.CheckButton(_("Omit neighborhood from addresses"))
-        self.get_coordinates_check = \
-            Gtk.CheckButton(_("Inherit missing coordinates from higher in place hierarchy"))
-        self.include_tng_place_levels_check = \
-            Gtk.CheckButton(_("Include TNG specific place tags"))
-        self.move_patronymics_check = \
-            Gtk.CheckButton(_("Matro- and patronymics as part of first names"))
-        #self.move_patronymics_check.set_help(_("Moves matro-/patronymics from surnames to the end of first names"))
-
-        # Set defaults:
-        self.sort_children_check.set_active(1)
-        self.sort_events_check.set_active(1)
-        self.reversed_places_check.set_active(1)
-        self.get_coordinates_check.set_active(1)
-        self.export_only_useful_pe_addresses_check.set_active(1)
-        self.extended_pe_addresses_check.set_active(1)
-        self.avoid_repetition_in_places_check.set_active(1)
-        self.include_tng_place_levels_check.set_active(1)
-        self.omit_borough_from_address_check.set_active(1)
-        self.move_patronymics_check.set_active(1)
-
-        # Add to gui:
-        option_box.pack_start(self.sort_children_check, False, False, 0)
-        option_box.pack_start(self.sort_events_check, False, False, 0)
-        option_box.pack_start(self.move_patronymics_check, False, False, 0)
-        option_box.pack_start(self.reversed_places_check, False, False, 0)
-        option_box.pack_start(self.export_only_useful_pe_addresses_check, False, False, 0)
-        option_box.pack_start(self.extended_pe_addresses_check, False, False, 0)
-        option_box.pack_start(self.omit_borough_from_address_check, False, False, 0)
-        option_box.pack_start(self.avoid_repetition_in_places_check, False, False, 0)
-        option_box.pack_start(self.get_coordinates_check, False, False, 0)
-        option_box.pack_start(self.include_tng_place_levels_check, False, False, 0)
-
-        # Return option box:
-        return option_box
 
-    def parse_options(self):
+    def __init__(self, avoid_repetition=False, reverse=False, replace_cr=True, cache_size=100000):
+        self.avoid_repetition = bool(avoid_repetition)
+        self.reverse = bool(reverse)
+        self.replace_cr = bool(replace_cr)
+        self._cache_size = cache_size
+        self._cache = dict()
+
+    def format(self, place_title):
         """
-        Get the options and store locally.
-        """
-        super(GedcomWriterOptionBox, self).parse_options()
-        if self.reversed_places_check:
-            self.reversed_places = self.reversed_places_check.get_active()
-        if self.get_coordinates_check:
-            self.get_coordinates = self.get_coordinates_check.get_active()
-        if self.export_only_useful_pe_addresses_check:
-            self.export_only_useful_pe_addresses = self.export_only_useful_pe_addresses_check.get_active()
-        if self.extended_pe_addresses_check:
-            self.extended_pe_addresses = self.extended_pe_addresses_check.get_active()
-        if self.avoid_repetition_in_places_check:
-            self.avoid_repetition_in_places = self.avoid_repetition_in_places_check.get_active()
-        if self.include_tng_place_levels_check:
-            self.include_tng_place_levels = self.include_tng_place_levels_check.get_active()
-        if self.omit_borough_from_address_check:
-            self.omit_borough_from_address = self.omit_borough_from_address_check.get_active()
-        if self.move_patronymics_check:
-            self.move_patronymics = self.move_patronymics_check.get_active()
+        Returns the transformed place title
 
+        :param place_title: Place title as displayed, e.g. by place_displayer.display()
+        :return:
+        """
+        result = self._cache.get(place_title)
+        if result is None:
+            result = self._format(place_title)
+            if len(self._cache) >= self._cache_size:
+                self._cache.clear()
+            self._cache[place_title] = result
+        return result
 
-def export_data(database, filename, user, option_box=None):
-    """
-    External interface used to register with the plugin system.
-    """
-    ret = False
-    try:
-        ged_write = GedcomWriterWithOptions(database, user, option_box)
-        ret = ged_write.write_gedcom_file(filename)
-    except IOError as msg:
-        msg2 = _("Could not create %s") % filename
-        user.notify_error(msg2, msg)
-    except DatabaseError as msg:
-        user.notify_db_error(_("Export failed"), msg)
-    return ret
+    def _format(self, place_title):
+        if self.avoid_repetition or self.reverse:
+            components = self.split_title(place_title)
+            if self.avoid_repetition:
+                components = self.remove_repetitive_places(components)
+            if self.reverse:
+                components = components[::-1]
+            result = ", ".join(components)
+        else:
+            result = place_title
+        if self.replace_cr:
+            result = result.replace('\r', ' ')
+        return result
+
+    @staticmethod
+    def split_title(place_title):
+        """
+        Splits a place title into a tuple of stripped and interned place names
+        """
+        return tuple(sys.intern(component.strip()) for component in place_title.split(","))
+
+    @staticmethod
+    def remove_repetitive_places(components):
+        """
+        Returns a tuple of place names without the names that are repeated in other names
+        """
+        items_to_remove = PlaceTitleFormatter.get_repetitive_places(components)
+        if not items_to_remove:
+            return components
+        return tuple(component for component in components if component not in items_to_remove)
+
+    @staticmethod
+    def get_repetitive_places(components):
+        """
+        Returns a set of place names that are contained in other names of the list. A name is
+        contained in another, if its words appear in the other name in the same order and
+        without anything in between. A name that appears more than once is contained in itself.
+
+        Names are handled in their order in the list, and names that have already been found to be
+        repetitive don't cause other names to be removed.
+
+        :param components:  A list of stripped place names
+        :return:            A set of names to be removed
+        """
+        first_index = dict()  # name -> index of its first appearance
+        second_index = dict()  # name -> index of its second appearance
+        for index, name in enumerate(components):
+            if name not in first_index:
+                first_index[name] = index
+            elif name not in second_index:
+                second_index[name] = index
+
+        if len(components) < 2:
+            return set()
+
+        # index every run of consecutive words of every name
+        words = dict((name, tuple(name.split(" "))) for name in first_index)
+        containing_names = dict()  # word run -> names including it
+        for name, name_words in words.items():
+            word_count = len(name_words)
+            for start in range(word_count):
+                for end in range(start + 1, word_count + 1):
+                    containing_names.setdefault(name_words[start:end], set()).add(name)
+
+        contained_names = dict()  # name -> other names included in it
+        for name in first_index:
+            for container in containing_names[words[name]]:
+                if container != name:
+                    contained_names.setdefault(container, []).append(name)
+
+        items_to_remove = set()
+        for name in first_index:  # in order of first appearance
+            if name in items_to_remove:
+                continue
+            # when the name appears twice, the second appearance removes the name itself, and
+            # names appearing after that are not checked any more
+            cutoff = second_index.get(name, len(components))
+            for contained in contained_names.get(name, ()):
+                if first_index[contained] < cutoff:
+                    items_to_remove.add(contained)
+            if name in second_index:
+                items_to_remove.add(name)
+        return items_to_remove
 
 
 # ===================================================================================================================
@@ -1051,6 +2054,22 @@ class FuzzySort():
             self.__debug_print_sv_list(sorted_list)
         return sorted_list
 
+    def evaluated(self, decorated_list, max_deviation=None, low_value=None, high_value=None):
+        """
+        Returns a new list with the missing sort values evaluated, in the original order.
+        Same as fuzzysorted() but leaves the sorting to the caller.
+        """
+        if high_value is None:
+            high_value = self.high_value
+        if low_value is None:
+            low_value = self.low_value
+        if max_deviation is None:
+            max_deviation = self.max_deviation
+
+        if len(decorated_list) == 0:
+            return list(decorated_list)
+        return self.__evaluate_missing_sort_values(decorated_list, max_deviation, low_value, high_value)
+
     def get_info(self, decorated_list, max_deviation=None, low_value=None, high_value=None):
         if high_value is None:
             high_value = self.high_value
@@ -1148,8 +2167,8 @@ class FuzzySort():
             i += 1
         last_index = i  # need to be sent to dropping algorithm
 
-        indexed_list, break_index = self.__drop_values_exceeding_max_deviation(indexed_list, max_deviation, tuple_index=0, break_index=break_index)
-        indexed_list, break_index = self.__drop_values_out_of_range(indexed_list, low_value, high_value, tuple_index=0, break_index=break_index)
+        indexed_list, break_index = self.__trim_values(indexed_list, max_deviation, low_value, high_value,
+                                                       tuple_index=0, break_index=break_index)
 
         indexed_list_1 = indexed_list[:break_index]
         indexed_list_2 = indexed_list[break_index:]
@@ -1693,30 +2712,93 @@ class FuzzySort():
                 l.append(item)
         return l
 
-    def __drop_values_exceeding_max_deviation(self, a_list, max_deviation, tuple_index=0, break_index=0):
+    def __trim_values(self, a_list, max_deviation=None, low_value=None, high_value=None, tuple_index=0,
+                      break_index=0):
+        """
+        Drops values until the sortable values left are within max_deviation * 2 of each other, and
+        then values below low_value and above high_value. Break index is decreased for every value
+        dropped before it.
+
+        Deviation is trimmed from the highest end, unless the lowest value is further from the midpoint,
+        dropping the first of equal values first. Uses a sorted view of the values with a pointer at
+        both ends, and a Fenwick tree counting dropped positions to get the index each dropped value
+        had in the list at that moment.
+
+        :return: tuple (list of the values left, adjusted break index)
+        """
         if max_deviation is None:
             max_deviation = self.max_deviation
-        max = self.__get_max_tuple(a_list, tuple_index)
-        min = self.__get_min_tuple(a_list, tuple_index)
-        max_value = self.extract_value(max, tuple_index)
-        min_value = self.extract_value(min, tuple_index)
-        if max is None or min is None:
-            return a_list, break_index
-        range = self.extract_value(max, tuple_index) - self.extract_value(min, tuple_index)
-        if range <= max_deviation * 2:
-            return a_list, break_index
-        else:
-            midpoint = self.__mid_between_min_max(a_list, tuple_index)
-            if midpoint - min_value > max_value - midpoint:
-                item_to_be_removed = min
+        n = len(a_list)
+        values = [self.extract_value(item, tuple_index) for item in a_list]
+
+        # sortable values grouped by value in ascending order, positions ascending in each group
+        groups = []
+        for position in sorted((i for i in range(n) if self.__is_sortable(values[i])), key=lambda i: (values[i], i)):
+            if groups and groups[-1][0] == values[position]:
+                groups[-1][1].append(position)
             else:
-                item_to_be_removed = max
-            remove_index = self.__remove_from_list(a_list, item_to_be_removed)
-            if remove_index is not None:
-                if remove_index < break_index:
-                    break_index -= 1
-        a_list, break_index = self.__drop_values_exceeding_max_deviation(a_list, max_deviation, tuple_index, break_index)
-        return a_list, break_index
+                groups.append((values[position], [position]))
+        next_in_group = [0] * len(groups)
+
+        dropped = bytearray(n)
+        dropped_tree = [0] * (n + 1)  # Fenwick tree of dropped positions
+        lo = 0
+        hi = len(groups) - 1
+        while True:
+            while lo < len(groups) and next_in_group[lo] == len(groups[lo][1]):
+                lo += 1
+            while hi >= 0 and next_in_group[hi] == len(groups[hi][1]):
+                hi -= 1
+            if lo > hi:
+                break
+            min_value = groups[lo][0]
+            max_value = groups[hi][0]
+            if max_value - min_value <= max_deviation * 2:
+                break
+            midpoint = (min_value + max_value) / 2
+            group = lo if midpoint - min_value > max_value - midpoint else hi
+            position = groups[group][1][next_in_group[group]]
+            next_in_group[group] += 1
+
+            # index of the value in the list left so far
+            index = position
+            i = position
+            while i > 0:
+                index -= dropped_tree[i]
+                i -= i & -i
+            if index < break_index:
+                break_index -= 1
+            dropped[position] = 1
+            i = position + 1
+            while i <= n:
+                dropped_tree[i] += 1
+                i += i & -i
+
+        # range limits are applied one after another, like dropping values below and then above them
+        if low_value is not None:
+            index = 0
+            for position in range(n):
+                if dropped[position]:
+                    continue
+                value = values[position]
+                if value is not None and value < low_value:
+                    dropped[position] = 1
+                    if index < break_index:
+                        break_index -= 1
+                index += 1
+        if high_value is not None:
+            index = 0
+            for position in range(n):
+                if dropped[position]:
+                    continue
+                value = values[position]
+                if value is not None and value > high_value:
+                    dropped[position] = 1
+                    if index < break_index:
+                        break_index -= 1
+                index += 1
+
+        return [item for item, is_dropped in zip(a_list, dropped) if not is_dropped], break_index
 
     def has_values_exceeding_max_deviation(self, a_list, max_deviation, tuple_index=0):
         if max_deviation is None:
@@ -1731,37 +2813,6 @@ class FuzzySort():
         else:
             return True
 
-    def __drop_values_out_of_range(self, a_list, low_value=None, high_value=None, tuple_index=0, break_index=0):
-        temp_list = []
-        i = 0
-        for item in a_list:
-            value = self.extract_value(item, tuple_index)
-            if value is not None and low_value is not None:
-                if value >= low_value:
-                    temp_list.append(item)
-                else:
-                    # dropped out
-                    if i < break_index:
-                        break_index -= 1
-            else:
-                temp_list.append(item)
-            i += 1
-        i = 0
-        new_list = []
-        for item in temp_list:
-            value = self.extract_value(item, tuple_index)
-            if value is not None and high_value is not None:
-                if value <= high_value:
-                    new_list.append(item)
-                else:
-                    # dropped out
-                    if i < break_index:
-                        break_index -= 1
-            else:
-                new_list.append(item)
-            i += 1
-        return new_list, break_index
-
     def has_values_out_of_range(self, a_list, low_value=None, high_value=None, tuple_index=0):
         for item in a_list:
             value = self.extract_value(item, tuple_index)
@@ -1938,6 +2989,20 @@ class Case():
     SENTENCECASENUMSKIP = 5
     TITLECASESPACEREQUIRED = 6
 
+    # [^\W_] matches exactly the characters for which str.isalnum() is true
+    _alnum_re = re.compile(r'[^\W_]')
+    # first character of every word: not preceded by an alphanumeric character
+    _titlecase_re = re.compile(r'(?<![^\W_]).', re.DOTALL)
+    # first character of every word: not preceded by anything else than a space
+    _titlecase_space_re = re.compile(r'(?<![^ ]).', re.DOTALL)
+
+    # detected cases by formatted key spelling, e.g. "City" -> TITLECASE
+    _detected_cases = dict()
+
+    @staticmethod
+    def _upper_match(match):
+        return match.group().upper()
+
     @staticmethod
     def convert_case(string, case):
         """
@@ -1956,22 +3021,13 @@ class Case():
         elif case == Case.SENTENCECASE or case == Case.SENTENCECASENUMSKIP:
             pos = Case.find_first_alphanum(string) if case == Case.SENTENCECASE else Case.find_first_alpha(string)
             if pos >= 0:
-                before = string[:pos] if pos > 0 else ""
-                after = string[pos + 1:] if len(string) > pos + 1 else ""
-                return before + string[pos].upper() + after
+                return string[:pos] + string[pos].upper() + string[pos + 1:]
             else:
                 return string
-        elif case == Case.TITLECASE or case == Case.TITLECASESPACEREQUIRED:
-            prev_c = " "
-            new_string = ""
-            for c in string:
-                if not prev_c.isalnum() and case == Case.TITLECASE \
-                        or prev_c == " " and case == Case.TITLECASESPACEREQUIRED:
-                    new_string = new_string + c.upper()
-                else:
-                    new_string = new_string + c
-                prev_c = c
-            return new_string
+        elif case == Case.TITLECASE:
+            return Case._titlecase_re.sub(Case._upper_match, string)
+        elif case == Case.TITLECASESPACEREQUIRED:
+            return Case._titlecase_space_re.sub(Case._upper_match, string)
         else:
             return string
 
@@ -1983,28 +3039,31 @@ class Case():
 
     @staticmethod
     def find_first_alphanum(string):
-        index = 0
         if not string:
             return -1
-        for c in string:
-            if c.isalnum():
-                return index
-            index += 1
-        return -1
+        match = Case._alnum_re.search(string)
+        return match.start() if match else -1
 
     @staticmethod
     def find_first_alpha(string):
-        index = 0
         if not string:
             return -1
-        for c in string:
-            if c.isalpha():
-                return index
-            index += 1
-        return -1
+        return next((index for index, c in enumerate(string) if c.isalpha()), -1)
 
     @staticmethod
     def get_case(string):
+        """
+        Detects the case of a string. Results are cached, because the same key spellings
+        are classified over and over again when parsing.
+        """
+        case = Case._detected_cases.get(string)
+        if case is None:
+            case = Case._detect_case(string)
+            Case._detected_cases[string] = case
+        return case
+
+    @staticmethod
+    def _detect_case(string):
         cases = [Case.LOWERCASE, Case.UPPERCASE, Case.TITLECASE, Case.TITLECASESPACEREQUIRED,
                  Case.SENTENCECASE, Case.SENTENCECASENUMSKIP]
         for case in cases:
@@ -2082,7 +3141,14 @@ class FormatStringElement():
 
 class FormatStringParser():
     """
+    Parses format strings like "[%CODE ]+-[%town, %city]" by replacing keys with values given in a dictionary
+
+    The key list is set when the parser is created, and is not changed by parsing. All the state of
+    a single parse lives in its own call frames, so one parser can be shared between threads and
+    between several exports.
 
+    If created with profile=True, call counts and timings are collected by format string into
+    parser.profile (see FormatStringParserProfile). Without profiling nothing is measured.
     """
 
     # -----------------------------------------------------------------------------------------------------
@@ -2090,7 +3156,11 @@ class FormatStringParser():
     #
     # -----------------------------------------------------------------------------------------------------
 
-    _all_keys = []
+    _all_keys = ()
+    _key_set = frozenset()
+
+    _compiled_cache_size = 256
+    profile = None
 
     _key_prefix = "%"
     _enc_any_start = '['
@@ -2100,6 +3170,7 @@ class FormatStringParser():
     _enc_always_start = '{'
     _enc_always_end = '}'
     _escape_char = "\\"
+    _unescape_re = re.compile(re.escape(_escape_char) + "(?!" + re.escape(_escape_char) + ")")
     _optional_operator = '|'
     _bind_right_operator = '-+'
     _bind_left_operator = '+-'
@@ -2110,6 +3181,19 @@ class FormatStringParser():
     _sentencecase_numskip_operator = "$1"
     _titlecasenumskip_operator = "$2"
 
+    _enclosing_start_modes = {_enc_any_start: ParseMode.IFANY,
+                              _enc_all_start: ParseMode.IFALL,
+                              _enc_always_start: ParseMode.ALWAYS}
+    _enclosing_end_modes = {_enc_any_end: ParseMode.IFANY,
+                            _enc_all_end: ParseMode.IFALL,
+                            _enc_always_end: ParseMode.ALWAYS}
+
+    _NODE_ELEMENTS = 0
+    _NODE_ENCLOSURE = 1
+
+    # a key prefix followed by a word, e.g. "%city"
+    _key_candidate_re = re.compile(re.escape(_key_prefix) + r"([^\W\d_]+)")
+
     case_operators = dict(
         uppercase="$u",
         lowercase="$l",
@@ -2117,92 +3201,216 @@ class FormatStringParser():
         # an unfinished idea...
     )
 
-    def __init__(self, key_list=None):
+    def __init__(self, key_list=None, profile=False):
         if not key_list:
-            self._all_keys = []
+            self._all_keys = ()
+            self._key_set = frozenset()
         else:
             self.set_keys(key_list)
+        self._compiled_cache = dict()
+        self._compiled_cache_lock = threading.Lock()  # the parser may be shared between threads
+        if profile:
+            self.profile = FormatStringParserProfile()
+            self.profile.install(self)
 
     def set_keys(self, key_list):
         """
+        Sets the keys recognized in format strings. The keys are copied, so the parser won't
+        see later changes made to the list or dictionary given.
 
-        :param key_list:
+        :param key_list:    A list of keys, or a dictionary of which keys are used
         :return:
         """
-        self._all_keys = []
-        if type(key_list) is list:
-            self._all_keys = key_list
+        if type(key_list) is list or type(key_list) is tuple:
+            all_keys = tuple(key_list)
         elif type(key_list) is dict:
-            for key, value in key_list.items():
-                self._all_keys.append(key)
+            all_keys = tuple(key_list.keys())
         else:
             raise TypeError("Incorrect key list type")
+        self._key_set = frozenset(all_keys)
+        self._all_keys = all_keys
+        self._compiled_cache = dict()
 
-    def append_keys(self, key_list):
+    def _get_keys_for_values(self, values):
         """
+        Returns the keys to be recognized when parsing with the given values. Keys in the values that
+        are not in the key list are recognized too, but only for that parse.
 
-        :param key_list:
-        :return:
+        :param values:  The dictionary of values to be parsed, or an object that can be read like one
+                        (get, keys, iteration). If keys() returns the key tuple of the parser, there are
+                        no extra keys to check.
+        :return:        A tuple of keys
         """
-        if type(key_list) is list:
-            self._all_keys.append(key_list)
-        elif type(key_list) is dict:
-            for key, value in key_list.items():
-                if not self._has_item(key, self._all_keys):
-                    self._all_keys.append(key)
+        all_keys = self._all_keys
+        if values.keys() is all_keys:
+            return all_keys
+        key_set = self._key_set
+        extra_keys = tuple(key for key in values if key not in key_set)
+        if extra_keys:
+            return all_keys + extra_keys
+        return all_keys
 
-                    # -----------------------------------------------------------------------------------------------------
-                    #   PARSE
-                    #
-                    # -----------------------------------------------------------------------------------------------------
+    # -----------------------------------------------------------------------------------------------------
+    #   PARSE
+    #
+    # -----------------------------------------------------------------------------------------------------
 
     def parse(self, values, format_string):
         """
         The main method to get work done. Call it from outside class.
 
         :param values:          The dictionary including all keywords to be replaced in the format string
-        :param format_string:   The format string to be parsed
+        :param format_string:   The format string to be parsed, or a format string compiled with compile()
         :return:                Parsed string
         """
 
-        self.append_keys(values)
-        parsed_list = self._recurse_enclosures_and_parse(values, format_string)
+        parsed_list = self._run(self._get_compiled(values, format_string).root, values)
 
         # collect remaining elements
         parsed_list = self._collect(parsed_list)
 
-        if len(parsed_list) > 0:
-            passed_keys = parsed_list[0].parsed_values
-            # print(passed_keys)
-
         return self._make_string_from_list(parsed_list)
 
     def get_parsed_keys(self, values, format_string):
 
-        self.append_keys(values)
-        parsed_list = self._recurse_enclosures_and_parse(values, format_string)
+        parsed_list = self._run(self._get_compiled(values, format_string).root, values)
         parsed_list = self._collect(parsed_list)
 
         if len(parsed_list) > 0:
-            passed_keys = parsed_list[0].parsed_values
-            return passed_keys
+            return dict(parsed_list[0].parsed_values)
 
         return dict()
 
-    def _recurse_enclosures_and_parse(self, values, format_string, mode=ParseMode.IFANY, case=Case.NONE):
+    # -----------------------------------------------------------------------------------------------------
+    #   COMPILE / VALIDATE
+    #
+    # -----------------------------------------------------------------------------------------------------
+
+    def compile(self, format_string):
         """
-        Recurses format string's enclosed parts, and parses them into tuple list.
-        Returns tuple list of elements of partial format string when going through recursion
-        Finally returns tuple list that is suppressed to single item including the full parsed string
+        Compiles a format string, so that it can be parsed any number of times without tokenizing
+        and matching its enclosings again. Compiled format strings can be given to parse() and
+        get_parsed_keys() instead of plain format strings.
+
+        :param format_string:   The format string, or an already compiled format string
+        :return:                CompiledFormatString
+        """
+        if isinstance(format_string, CompiledFormatString):
+            return format_string
+        return self._compile(format_string, self._all_keys)
+
+    def validate(self, format_string):
+        """
+        Checks a format string for unmatched enclosings, unknown keys and dangling operators
+
+        :param format_string:   The format string
+        :return:                A list of error messages, empty if the format string is ok
+        """
+        errors = []
+        enclosing_ends = self._scan_enclosures(format_string)[1]
+        levels = dict()
+        for index, c in enumerate(format_string):
+            escaped = index > 0 and format_string[index - 1] == self._escape_char
+            mode = self._enclosing_start_modes.get(c)
+            if mode is not None and not escaped:
+                levels[mode] = levels.get(mode, 0) + 1
+                if enclosing_ends[index][0] < 0:
+                    errors.append(_("Unmatched '%(char)s' at position %(pos)d") % dict(char=c, pos=index + 1))
+            mode = self._enclosing_end_modes.get(c)
+            if mode is not None and not escaped:
+                if levels.get(mode, 0) > 0:
+                    levels[mode] -= 1
+                else:
+                    errors.append(_("Unmatched '%(char)s' at position %(pos)d") % dict(char=c, pos=index + 1))
+
+        for match in self._key_candidate_re.finditer(format_string):
+            if match.start() > 0 and format_string[match.start() - 1] == self._escape_char:
+                continue
+            word = match.group(1).lower()
+            if not any(word.startswith(key.lower()) for key in self._all_keys):
+                errors.append(_("Unknown key '%(key)s' at position %(pos)d")
+                              % dict(key=match.group(), pos=match.start() + 1))
+
+        if not errors:
+            compiled = self._compile(format_string, self._all_keys)
+            self._check_operators(compiled.root, errors, top_level=True)
+
+        return errors
+
+    def _check_operators(self, node, errors, top_level=False):
+        """
+        Adds an error for each optional or binding operator that has nothing on its both sides to
+        operate on. Returns a list of element specs that the node produces for its enclosing list.
+        """
+        if node[0] == self._NODE_ELEMENTS:
+            element_specs = list(node[1])
+        else:
+            self._check_operators(node[2], errors, top_level=True)
+            element_specs = self._check_operators(node[1], errors) \
+                + [("", ElementType.PARSED, Case.NONE, None)] \
+                + self._check_operators(node[4], errors)
+        if top_level:
+            last = len(element_specs) - 1
+            for index, spec in enumerate(element_specs):
+                if spec[1] == ElementType.OPTIONOPERATOR or spec[1] == ElementType.BINDOPERATOR:
+                    if index == 0 or index == last:
+                        errors.append(_("Dangling operator '%s'") % spec[0])
+        return element_specs
+
+    def _get_compiled(self, values, format_string):
+        """
+        Returns the format string compiled with keys that are needed for the values. Format strings
+        compiled with the key list of the parser are cached.
+
+        :param values:          The dictionary of values to be parsed
+        :param format_string:   The format string, or an already compiled format string
+        :return:                CompiledFormatString
+        """
+        if isinstance(format_string, CompiledFormatString):
+            return format_string
+        keys = self._get_keys_for_values(values)
+        if keys is not self._all_keys:
+            return self._compile(format_string, keys)
+        compiled = self._compiled_cache.get(format_string)
+        if compiled is None:
+            compiled = self._compile(format_string, keys)
+            with self._compiled_cache_lock:
+                if len(self._compiled_cache) >= self._compiled_cache_size:
+                    self._compiled_cache.clear()
+                self._compiled_cache[format_string] = compiled
+        return compiled
+
+    def _compile(self, format_string, keys):
+        enclosures = self._scan_enclosures(format_string)
+        root = self._compile_range(format_string, enclosures, keys, 0, len(format_string))
+        return CompiledFormatString(format_string, root)
+
+    def _compile_range(self, format_string, enclosures, keys, start, end, mode=ParseMode.IFANY, case=Case.NONE):
+        """
+        Recurses format string's enclosed parts, and splits them into a tree of nodes.
+        Enclosings are matched once for the whole format string, and the recursion works on index
+        ranges of it instead of copied substrings
+
+        Node is either
+            (_NODE_ELEMENTS, tuple of element specs, case) ...for a part without enclosings
+                or
+            (_NODE_ENCLOSURE, before node, middle node, enclosed mode, after node)
+
+        Element specs are tuples (key or text, element type, case, formatted key)
 
-        :param values:
         :param format_string:
+        :param enclosures:  The result of _scan_enclosures for the whole format string
+        :param keys:        Keys to be recognized
+        :param start:       Start index of the range
+        :param end:         End index of the range (exclusive)
         :param mode:
-        :return:
+        :return:            Node
         """
+        next_start, enclosing_ends = enclosures
+
         new_case = Case.NONE
-        if format_string:
-            c = format_string[0:2]
+        if end - start >= 2:
+            c = format_string[start:start + 2]
             if c == self._uppercase_operator:
                 new_case = Case.UPPERCASE
             elif c == self._sentencecase_operator:
@@ -2216,7 +3424,7 @@ class FormatStringParser():
             elif c == self._lowercase_operator:
                 new_case = Case.LOWERCASE
             if new_case != Case.NONE:
-                format_string = format_string[2:]
+                start += 2
                 case = new_case
 
         if case == Case.SENTENCECASENUMSKIP or case == Case.SENTENCECASE:
@@ -2225,46 +3433,47 @@ class FormatStringParser():
         else:
             sentence_case = case
 
-        enclosing_start = self._find_enclosing_start(format_string)
-        if enclosing_start:
-            start_pos = enclosing_start[0]
-
-            if start_pos >= 0:
-                enclosing_end = self._find_enclosing_end(format_string, enclosing_start)
-                if enclosing_end:
-                    end_pos = enclosing_end[0]
-                    enclosed_mode = enclosing_end[1]
-                    # Divide in parts. Middle is part that is enclosed with brackets, 'before' and 'after' are around it
-                    before = format_string[:start_pos] if start_pos > 0 else ""
-                    middle = format_string[start_pos + 1:end_pos] if end_pos - start_pos >= 2 else ""
-                    after = format_string[end_pos + 1:] if end_pos < len(format_string) - 1 else ""
-
-                    # print("//" + before + "//" + middle + "//" + after + "//")
-                    recursion = self._recurse_enclosures_and_parse(values, before, mode, sentence_case) \
-                                + self._collect(self._recurse_enclosures_and_parse(values, middle, enclosed_mode, case),
-                                                enclosed_mode) \
-                                + self._recurse_enclosures_and_parse(values, after, mode, case)
-
-                    return recursion
-
-        new_list = self._split_and_parse(values, format_string, sentence_case)
-
-        return new_list
-
-    def _split_and_parse(self, values, format_string, case=Case.NONE):
+        start_pos = next_start[start] if start < end else -1
+        if 0 <= start_pos < end and end - start_pos > 2:
+            end_pos, enclosed_mode = enclosing_ends[start_pos]
+            if 0 <= end_pos < end:
+                # Divide in parts. Middle is part that is enclosed with brackets, 'before' and 'after' are around it
+                return (self._NODE_ENCLOSURE,
+                        self._compile_range(format_string, enclosures, keys, start, start_pos, mode, sentence_case),
+                        self._compile_range(format_string, enclosures, keys, start_pos + 1, end_pos,
+                                            enclosed_mode, case),
+                        enclosed_mode,
+                        self._compile_range(format_string, enclosures, keys, end_pos + 1, end, mode, case))
+
+        element_specs = tuple((element.key if element.type == ElementType.KEY else element.value,
+                               element.type, element.case, element.formatted_key)
+                              for element in self._split_format_string(format_string[start:end], sentence_case, keys))
+        return self._NODE_ELEMENTS, element_specs, sentence_case
+
+    def _run(self, node, values):
         """
-        Splits format string into tuple list, and then parses keys included in it
+        Parses a compiled node into a tuple list. Returns tuple list of elements of partial format
+        string when going through recursion
 
-
-        :param values:          Values to be parsed in key/value dictionary
-        :param format_string:   The format string to be parsed
-        :return:                The format string splitted into elements in a list containing tuples
+        :param node:    A node made by _compile_range
+        :param values:  Values to be parsed in key/value dictionary
+        :return:
         """
-        element_list = self._split_format_string(format_string, case)
-        self._parse_keys(element_list, values, case)
-        return element_list
-
-    def _split_format_string(self, format_string, case=Case.NONE):
+        if node[0] == self._NODE_ELEMENTS:
+            element_list = []
+            for contents, element_type, case, formatted_key in node[1]:
+                element = FormatStringElement(contents, element_type, case)
+                if formatted_key is not None:
+                    element.formatted_key = formatted_key
+                element_list.append(element)
+            self._parse_keys(element_list, values, node[2])
+            return element_list
+
+        return self._run(node[1], values) \
+            + self._collect(self._run(node[2], values), node[3]) \
+            + self._run(node[4], values)
+
+    def _split_format_string(self, format_string, case=Case.NONE, keys=None):
         """
         Splits format string into list of elements
 
@@ -2285,7 +3494,7 @@ class FormatStringParser():
         any_key_found = False
         if remainder:
             while remainder:
-                next_key = self._get_next_key(remainder)
+                next_key = self._get_next_key(remainder, keys)
                 if next_key:
                     actual_key = next_key[0]
                     formatted_key = next_key[1]
@@ -2355,7 +3564,7 @@ class FormatStringParser():
 
         return
 
-    def _get_next_key(self, format_string):
+    def _get_next_key(self, format_string, keys=None):
         """
         Searches for the first key in a format string
 
@@ -2366,8 +3575,11 @@ class FormatStringParser():
         If no key is found, the method returns None
 
         :param format_string:   The format string
+        :param keys:            Keys to look for, defaults to the key list of the parser
         :return:                A tuple of the next key and its formatted version
         """
+        if keys is None:
+            keys = self._all_keys
         any_found = False
         lowest_index = -1
         found_formatted_key = ""
@@ -2375,7 +3587,7 @@ class FormatStringParser():
         check_string = format_string.lower()
 
         if format_string:
-            for key in self._all_keys:
+            for key in keys:
                 check_key = self._key_prefix + key.lower()
                 found_pos = check_string.find(check_key, 0)
                 if found_pos >= 0 and (found_pos < lowest_index or not any_found):
@@ -2581,21 +3793,10 @@ class FormatStringParser():
             return ""
 
     def _handle_escape_char(self, string):
-        index = 0
-        new_string = []
-        while index < len(string):
-            if string[index] == self._escape_char:
-                if index < len(string) - 1:
-                    if string[index + 1] != self._escape_char:
-                        pass
-                    else:
-                        new_string.append(string[index])
-                else:
-                    pass
-            else:
-                new_string.append(string[index])
-            index += 1
-        return "".join(new_string)
+        """
+        Removes escape chars. An escape char is kept only when it is followed by another one
+        """
+        return self._unescape_re.sub("", string)
 
     def _number_of_empty_parsed_item(self, element_list):
         """
@@ -2622,79 +3823,53 @@ class FormatStringParser():
                 counter += 1
         return counter
 
-    def _find_enclosing_start(self, format_string, start_pos=0):
-        """
-
-        :param format_string:
-        :param start_pos:
-        :return:
+    def _scan_enclosures(self, format_string):
         """
-        index = start_pos
-        found_enclosing = None
-        for c in format_string[start_pos:]:
-            if c == self._enc_any_start:
-                found_enclosing = index, ParseMode.IFANY
-            elif c == self._enc_all_start:
-                found_enclosing = index, ParseMode.IFALL
-            elif c == self._enc_always_start:
-                found_enclosing = index, ParseMode.ALWAYS
-            if found_enclosing:
-                if index > start_pos:
-                    if format_string[index - 1] == self._escape_char:
-                        found_enclosing = None  # omit found enclosing if it's followed by escape char
-                    else:
-                        break
-                else:
-                    break
+        Matches all enclosings of the format string in a single pass
 
-            index += 1
-
-        return found_enclosing
-
-    def _find_enclosing_end(self, format_string, enclosing_start):
-        """
+        Enclosing start chars preceded by the escape char are not considered as starts. Enclosing ends
+        are matched with the same kind of start only, and an escaped end char closes the enclosing when
+        there are no nested starts left open (escaped ends don't close nested ones).
 
         :param format_string:
-        :param enclosing_start:
-        :return:
+        :return:    A tuple of two items. A list telling index of the next enclosing start at or after
+                    each index (-1 if there are none), and a dictionary of enclosing start indexes
+                    mapped to tuples of (enclosing end index or -1, parse mode)
         """
-        start_pos = enclosing_start[0] + 1
-        found_enclosing_end = None
-
-        if len(format_string) - start_pos > 1:
-
-            mode = enclosing_start[1]
-            if mode == ParseMode.IFALL:
-                ec_end_char = self._enc_all_end
-                ec_start_char = self._enc_all_start
-            elif mode == ParseMode.ALWAYS:
-                ec_end_char = self._enc_always_end
-                ec_start_char = self._enc_always_start
-            else:
-                ec_end_char = self._enc_any_end
-                ec_start_char = self._enc_any_start
-
-            index = start_pos
-            level = 0
-            for c in format_string[start_pos:]:
-                if c == ec_end_char:
-                    if level == 0 and c == ec_end_char:
-                        found_enclosing_end = index, mode
-                        break
-                    else:
-                        level -= 1
-                        if index > start_pos:
-                            if format_string[index - 1] == self._escape_char:
-                                level += 1  # was escape, step back
-                elif c == ec_start_char:
-                    level += 1
-                    if index > start_pos:
-                        if format_string[index - 1] == self._escape_char:
-                            level -= 1  # was escape, step back
-
-                index += 1
-
-        return found_enclosing_end
+        length = len(format_string)
+        next_start = [-1] * (length + 1)
+        enclosing_ends = dict()
+        levels = dict()  # mode -> level of nesting
+        waiting = dict()  # (mode, level) -> start index waiting for its end char
+        escape_char = self._escape_char
+
+        for index, c in enumerate(format_string):
+            escaped = index > 0 and format_string[index - 1] == escape_char
+            mode = self._enclosing_start_modes.get(c)
+            if mode is not None:
+                if escaped:
+                    continue
+                level = levels.get(mode, 0)
+                waiting[mode, level] = index
+                enclosing_ends[index] = (-1, mode)
+                levels[mode] = level + 1
+                continue
+            mode = self._enclosing_end_modes.get(c)
+            if mode is not None:
+                level = levels.get(mode, 0)
+                start_pos = waiting.pop((mode, level - 1), None)
+                if start_pos is not None:
+                    enclosing_ends[start_pos] = (index, mode)
+                if not escaped:
+                    levels[mode] = level - 1
+
+        following = -1
+        for index in range(length - 1, -1, -1):
+            if index in enclosing_ends:
+                following = index
+            next_start[index] = following
+
+        return next_start, enclosing_ends
 
     def _is_enclosing_start_char(self, c):
         """
@@ -2717,4 +3892,288 @@ class FormatStringParser():
     @staticmethod
     def _print_elements(element_list):
         for element in element_list:
-            element.print_element()
\ No newline at end of file
+            element.print_element()
+
+
+# =====================================================================================================
+#
+#   COMPILED FORMAT STRING
+#
+# =====================================================================================================
+
+class CompiledFormatString():
+    """
+    A format string compiled by FormatStringParser.compile(). Immutable, and can be shared
+    between threads and parsers.
+    """
+
+    def __init__(self, format_string, root):
+        self.format_string = format_string
+        self.root = root
+
+    def __str__(self):
+        return self.format_string
+
+    def __repr__(self):
+        return "CompiledFormatString(%r)" % self.format_string
+
+
+# =====================================================================================================
+#
+#   FORMAT STRING PARSER PROFILE
+#
+# =====================================================================================================
+
+class FormatStringParserProfile():
+    """
+    Collects call counts and cumulative timings of a FormatStringParser by format string
+
+    The profile is installed by wrapping methods of a single parser instance, so parsers that are
+    not profiled run the plain methods. Phases are timed inclusively, e.g. collect includes the time
+    spent in handling operators.
+    """
+
+    PHASES = ("tokenize", "keys", "operators", "collect")
+
+    # parser method -> phase
+    _timed_methods = (("_scan_enclosures", "tokenize"),
+                      ("_split_format_string", "tokenize"),
+                      ("_parse_keys", "keys"),
+                      ("_fix_separators", "operators"),
+                      ("_handle_operators", "operators"),
+                      ("_collect", "collect"))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = dict()
+
+    def install(self, parser):
+        """
+        Wraps the methods of the parser instance to collect statistics into this profile
+
+        :param parser:  A FormatStringParser
+        :return:
+        """
+        for name in ("parse", "get_parsed_keys"):
+            setattr(parser, name, self._wrap_entry(getattr(parser, name)))
+        for name, phase in self._timed_methods:
+            setattr(parser, name, self._wrap_phase(getattr(parser, name), phase))
+
+    def _wrap_entry(self, method):
+        def wrapper(values, format_string):
+            self._local.format_string = str(format_string)
+            start = time.perf_counter()
+            try:
+                return method(values, format_string)
+            finally:
+                self._add(self._local.format_string, "total", time.perf_counter() - start, "calls")
+                self._local.format_string = None
+        return wrapper
+
+    def _wrap_phase(self, method, phase):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._add(getattr(self._local, "format_string", None), phase, time.perf_counter() - start)
+        return wrapper
+
+    def _add(self, format_string, phase, seconds, counter=None):
+        with self._lock:
+            stats = self._stats.get(format_string)
+            if stats is None:
+                stats = dict(calls=0, total=0.0)
+                for name in self.PHASES:
+                    stats[name] = 0.0
+                self._stats[format_string] = stats
+            if phase:
+                stats[phase] += seconds
+            if counter:
+                stats[counter] += 1
+
+    def get_stats(self):
+        """
+        Returns collected statistics as a dictionary of format strings mapped to dictionaries with
+        keys 'calls', 'total' and the phases. Times are in seconds.
+        """
+        result = dict()
+        with self._lock:
+            for format_string, stats in self._stats.items():
+                if format_string is None:
+                    continue
+                item = dict(calls=stats["calls"], total=stats["total"])
+                for name in self.PHASES:
+                    item[name] = stats[name]
+                result[format_string] = item
+        return result
+
+    def format_report(self):
+        """
+        Returns statistics as a table, the most expensive format strings first
+        """
+        lines = ["%-50s %8s %9s" % ("Format string", "Calls", "Total ms")
+                 + "".join(" %9s" % name for name in self.PHASES)]
+        stats = sorted(self.get_stats().items(), key=lambda x: x[1]["total"], reverse=True)
+        for format_string, item in stats:
+            lines.append("%-50s %8d %9.1f" % ('"' + format_string + '"', item["calls"], item["total"] * 1000)
+                         + "".join(" %9.1f" % (item[name] * 1000) for name in self.PHASES))
+        return "\n".join(lines)
+
+    def print_report(self):
+        print(self.format_report())
+
+
+
+class GedcomExportProfile():
+    """
+    Collects call counts, cumulative and self timings and database fetch counts of the main
+    phases of a GedcomWriterWithOptions export
+
+    Installed by wrapping methods of a single writer instance and by replacing its database with
+    a counting proxy, so exports without profiling run the plain methods. Cumulative time of a
+    phase counts only the outermost call if the phase is entered recursively; self time excludes
+    the time spent in other profiled phases called from it. Database fetches are counted for the
+    innermost phase running; time and fetches outside the phases go to 'other'.
+    """
+
+    PHASES = ("_place", "_remaining_events", "_family_events", "_family_child_list",
+              "_person_name", "_writeln")
+    OTHER = "other"
+
+    def __init__(self):
+        self._stack = []  # [phase, start time, time in child phases]
+        self._depth = dict()
+        self._stats = dict()
+        for phase in self.PHASES + (self.OTHER,):
+            self._stats[phase] = dict(calls=0, cumulative=0.0, self=0.0, fetches=dict())
+        self._started = None
+        self._elapsed = 0.0
+
+    def install(self, writer):
+        """
+        Wraps the methods and the database of the writer to collect statistics into this profile
+
+        :param writer:  A GedcomWriterWithOptions
+        :return:
+        """
+        for phase in self.PHASES:
+            setattr(writer, phase, self._wrap_phase(getattr(writer, phase), phase))
+        writer.dbase = _FetchCountingDatabase(writer.dbase, self)
+        writer.db = writer.dbase
+
+    def start(self):
+        self._started = time.perf_counter()
+
+    def stop(self):
+        if self._started is not None:
+            self._elapsed += time.perf_counter() - self._started
+            self._started = None
+
+    def _wrap_phase(self, method, phase):
+        stack = self._stack
+        depth = self._depth
+        stats = self._stats[phase]
+
+        def wrapper(*args, **kwargs):
+            depth[phase] = depth.get(phase, 0) + 1
+            frame = [phase, time.perf_counter(), 0.0]
+            stack.append(frame)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - frame[1]
+                stack.pop()
+                depth[phase] -= 1
+                stats["calls"] += 1
+                stats["self"] += elapsed - frame[2]
+                if not depth[phase]:
+                    stats["cumulative"] += elapsed
+                if stack:
+                    stack[-1][2] += elapsed
+        return wrapper
+
+    def count_fetch(self, method_name):
+        phase = self._stack[-1][0] if self._stack else self.OTHER
+        fetches = self._stats[phase]["fetches"]
+        fetches[method_name] = fetches.get(method_name, 0) + 1
+
+    def get_stats(self):
+        """
+        Returns collected statistics as a dictionary with the total export time in seconds
+        ('elapsed') and the phases ('phases') mapped to dictionaries with keys 'calls', 'cumulative',
+        'self' (seconds), 'fetches' (total count) and 'fetches_by_method'.
+        """
+        phases = dict()
+        for phase in self.PHASES + (self.OTHER,):
+            stats = self._stats[phase]
+            phases[phase] = dict(calls=stats["calls"], cumulative=stats["cumulative"], self=stats["self"],
+                                 fetches=sum(stats["fetches"].values()),
+                                 fetches_by_method=dict(stats["fetches"]))
+        # time outside the profiled phases
+        other = phases[self.OTHER]
+        other["self"] = max(0.0, self._elapsed - sum(phases[phase]["self"] for phase in self.PHASES))
+        other["cumulative"] = other["self"]
+        return dict(elapsed=self._elapsed, phases=phases)
+
+    def format_report(self):
+        """
+        Returns statistics as a table, the phases with the most self time first
+        """
+        stats = self.get_stats()
+        lines = ["%-20s %10s %14s %14s %10s" % ("Phase", "Calls", "Cumulative ms", "Self ms", "Fetches")]
+        for phase, item in sorted(stats["phases"].items(), key=lambda x: x[1]["self"], reverse=True):
+            lines.append("%-20s %10d %14.1f %14.1f %10d" % (phase, item["calls"], item["cumulative"] * 1000,
+                                                           item["self"] * 1000, item["fetches"]))
+        lines.append("%-20s %10s %14.1f" % ("Export total", "", stats["elapsed"] * 1000))
+        return "\n".join(lines)
+
+    def print_report(self):
+        print(self.format_report())
+
+    def write_json(self, filename):
+        """
+        Writes statistics returned by get_stats() as JSON to the file
+        """
+        with open(filename, "w") as json_file:
+            json.dump(self.get_stats(), json_file, indent=2, sort_keys=True)
+
+
+class _FetchCountingDatabase():
+    """
+    Passes everything through to the database, counting calls of get_*_from_handle methods
+    in a GedcomExportProfile
+    """
+
+    def __init__(self, database, profile):
+        self._database = database
+        self._profile = profile
+        self._wrapped = dict()
+
+    def __getattr__(self, name):
+        attr = getattr(self._database, name)
+        if not (name.startswith("get_") and name.endswith("_from_handle")):
+            return attr
+        wrapped = self._wrapped.get(name)
+        if wrapped is None:
+            count_fetch = self._profile.count_fetch
+
+            def wrapped(*args, **kwargs):
+                count_fetch(name)
+                return attr(*args, **kwargs)
+            self._wrapped[name] = wrapped
+        return wrapped
+
+# The option box is needed, and GTK available, only when Gramps runs its GUI. GedcomWriterOptionBox is
+# imported from a module of its own, so that command line exports import no GUI modules.
+if "gi.repository.Gtk" in sys.modules:
+    GedcomWriterOptionBox = _import_plugin_module("GedcomOptionsGui").GedcomWriterOptionBox
+
+# time taken to import this module, for keeping an eye on startup time of command line exports
+_import_time = time.perf_counter() - _import_started
+
+if __name__ == "__main__":
+    # modules of this plugin import GedcomOptions, which is this module when run as a script
+    sys.modules.setdefault("GedcomOptions", sys.modules[__name__])
+    sys.exit(main())
@@ -0,0 +1,173 @@
+# *-* coding: utf-8 *-*
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2012       Doug Blank <doug.blank@gmail.com>
+# Copyright (C) 2012       Bastien Jacquet
+# Copyright (C) 2015-2017  Kati Haapamaki <kati.haapamaki@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""
+GedcomWriterOptionBox, the options of GedcomOptions in the export assistant of Gramps.
+
+This module needs GTK, and is imported by GedcomOptions only when Gramps runs its GUI.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from gi.repository import Gtk
+
+from gramps.gen.const import GRAMPS_LOCALE as glocale
+from gramps.gui.plug.export import WriterOptionBox
+
+from GedcomOptions import GedcomWriterOptions
+from GedcomOptionsWriter import GedcomWriterWithOptions
+
+try:
+    _trans = glocale.get_addon_translator(__file__)
+except ValueError:
+    _trans = glocale.translation
+_ = _trans.gettext
+
+
+#-------------------------------------------------------------------------
+#
+# GedcomWriterOptionBox
+#
+#-------------------------------------------------------------------------
+
+class GedcomWriterOptionBox(WriterOptionBox, GedcomWriterOptions):
+    """
+    Create a VBox with the option widgets and define methods to retrieve
+    the options.
+
+    """
+    def __init__(self, person, dbstate, uistate, **kwargs):
+        """
+        Initialize the local options.
+        """
+        super(GedcomWriterOptionBox, self).__init__(person, dbstate, uistate, **kwargs)
+        self._set_option_defaults()
+        self.sort_children_check = None
+        self.sort_events_check = None
+        self.reversed_places_check = None
+        self.get_coordinates_check = None
+        self.export_only_useful_pe_addresses_check = None
+        self.extended_pe_addresses_check = None
+        self.avoid_repetition_in_places_check = None
+        self.include_tng_place_levels_check = None
+        self.omit_borough_from_address_check = None
+        self.move_patronymics_check = None
+        self.materialize_filters_check = None
+        self.address_format_entries = None
+
+    def get_option_box(self):
+        option_box = super(GedcomWriterOptionBox, self).get_option_box()
+
+        # Make options:
+        self.sort_children_check = \
+            Gtk.CheckButton(_("Smart sort children"))
+        self.sort_events_check = \
+            Gtk.CheckButton(_("Smart sort events"))
+        self.reversed_places_check = \
+            Gtk.CheckButton(_("Reverse place names"))
+        #self.reversed_places_check.set_help(_("Use reverse order in place titles"))
+        self.avoid_repetition_in_places_check = \
+            Gtk.CheckButton(_("Avoid repetition in place names"))
+        self.extended_pe_addresses_check = \
+            Gtk.CheckButton(_("Extended addresses"))
+        self.export_only_useful_pe_addresses_check = \
+            Gtk.CheckButton(_("Omit addresses without info in addition to place name"))
+        self.omit_borough_from_address_check = \
+            Gtk.CheckButton(_("Omit neighborhood from addresses"))
+        self.get_coordinates_check = \
+            Gtk.CheckButton(_("Inherit missing coordinates from higher in place hierarchy"))
+        self.include_tng_place_levels_check = \
+            Gtk.CheckButton(_("Include TNG specific place tags"))
+        self.move_patronymics_check = \
+            Gtk.CheckButton(_("Matro- and patronymics as part of first names"))
+        #self.move_patronymics_check.set_help(_("Moves matro-/patronymics from surnames to the end of first names"))
+        self.materialize_filters_check = \
+            Gtk.CheckButton(_("Apply filters to the whole database before export (uses more memory)"))
+
+        # Set defaults:
+        self.sort_children_check.set_active(1)
+        self.sort_events_check.set_active(1)
+        self.reversed_places_check.set_active(1)
+        self.get_coordinates_check.set_active(1)
+        self.export_only_useful_pe_addresses_check.set_active(1)
+        self.extended_pe_addresses_check.set_active(1)
+        self.avoid_repetition_in_places_check.set_active(1)
+        self.include_tng_place_levels_check.set_active(1)
+        self.omit_borough_from_address_check.set_active(1)
+        self.move_patronymics_check.set_active(1)
+        self.materialize_filters_check.set_active(0)
+
+        # Add to gui:
+        option_box.pack_start(self.sort_children_check, False, False, 0)
+        option_box.pack_start(self.sort_events_check, False, False, 0)
+        option_box.pack_start(self.move_patronymics_check, False, False, 0)
+        option_box.pack_start(self.reversed_places_check, False, False, 0)
+        option_box.pack_start(self.export_only_useful_pe_addresses_check, False, False, 0)
+        option_box.pack_start(self.extended_pe_addresses_check, False, False, 0)
+        option_box.pack_start(self.omit_borough_from_address_check, False, False, 0)
+        option_box.pack_start(self.avoid_repetition_in_places_check, False, False, 0)
+        option_box.pack_start(self.get_coordinates_check, False, False, 0)
+        option_box.pack_start(self.include_tng_place_levels_check, False, False, 0)
+        option_box.pack_start(self.materialize_filters_check, False, False, 0)
+
+        # Address formats used with extended addresses:
+        option_box.pack_start(Gtk.Label(_("Extended address formats:"), xalign=0), False, False, 0)
+        address_format_grid = Gtk.Grid(column_spacing=6, row_spacing=2)
+        self.address_format_entries = []
+        for row, label in enumerate(self._get_address_format_labels()):
+            entry = Gtk.Entry()
+            entry.set_text(GedcomWriterWithOptions._address_format[row])
+            entry.set_hexpand(True)
+            address_format_grid.attach(Gtk.Label(label, xalign=0), 0, row, 1, 1)
+            address_format_grid.attach(entry, 1, row, 1, 1)
+            self.address_format_entries.append(entry)
+        option_box.pack_start(address_format_grid, False, False, 0)
+
+        # Return option box:
+        return option_box
+
+    def parse_options(self):
+        """
+        Get the options and store locally.
+        """
+        super(GedcomWriterOptionBox, self).parse_options()
+        if self.reversed_places_check:
+            self.reversed_places = self.reversed_places_check.get_active()
+        if self.get_coordinates_check:
+            self.get_coordinates = self.get_coordinates_check.get_active()
+        if self.export_only_useful_pe_addresses_check:
+            self.export_only_useful_pe_addresses = self.export_only_useful_pe_addresses_check.get_active()
+        if self.extended_pe_addresses_check:
+            self.extended_pe_addresses = self.extended_pe_addresses_check.get_active()
+        if self.avoid_repetition_in_places_check:
+            self.avoid_repetition_in_places = self.avoid_repetition_in_places_check.get_active()
+        if self.include_tng_place_levels_check:
+            self.include_tng_place_levels = self.include_tng_place_levels_check.get_active()
+        if self.omit_borough_from_address_check:
+            self.omit_borough_from_address = self.omit_borough_from_address_check.get_active()
+        if self.move_patronymics_check:
+            self.move_patronymics = self.move_patronymics_check.get_active()
+        if self.materialize_filters_check:
+            self.materialize_filters = self.materialize_filters_check.get_active()
+        if self.address_format_entries:
+            self.set_address_format([entry.get_text() for entry in self.address_format_entries])
@@ -0,0 +1,975 @@
+# *-* coding: utf-8 *-*
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2012       Doug Blank <doug.blank@gmail.com>
+# Copyright (C) 2012       Bastien Jacquet
+# Copyright (C) 2015-2017  Kati Haapamaki <kati.haapamaki@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""
+GedcomWriterWithOptions, the GEDCOM writer of GedcomOptions.
+
+The GEDCOM writer of Gramps imports GUI modules, so this module is imported only when an export
+is written, not when GedcomOptions is loaded.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+
+from gramps.plugins.export import exportgedcom
+from gramps.gen.lib import EventType, NameOriginType, NameType, PlaceType
+from gramps.gen.utils.place import conv_lat_lon
+from gramps.gen.utils.location import get_main_location
+from gramps.gen.display.place import displayer as place_displayer
+from gramps.gen.lib.date import Today
+import inspect
+import io
+import logging
+import os
+import time
+
+from GedcomOptions import (__version__, AnomalyLog, DatabaseSnapshot, ExportPipeline, FormatStringParser,
+                           FuzzySort, GedcomExportProfile, GedcomWriterOptions, IncrementalExport, PersonIndex,
+                           PlaceComponents, PlaceTitleFormatter, RecordIndex, ShardedExport)
+
+LOG = logging.getLogger(".GedcomOptions")
+
+
+#------------------------------------------------------------
+#
+# GedcomWriterWithOptions
+#
+#------------------------------------------------------------
+
+class GedcomWriterWithOptions(exportgedcom.GedcomWriter):
+    """
+    GedcomWriter with Extra Options
+    """
+
+    _address_format = ["%street, %custom, %unknown, %building, %department, %farm, %neighborhood",
+                       "%hamlet, %village, %borough, %locality",
+                       "[%CODE ]+-[%town, %city, %municipality], %parish",
+                       "%district, %region, %province, %county, %state",
+                       "%country",
+                       ""]
+
+    _def_address_format = ["%street",
+                           "%locality",
+                           "%city",
+                           "%state",
+                           "%country",
+                           "%code"]
+
+    _place_keys = list(PlaceComponents.KEYS)
+    _place_types = PlaceComponents.PLACE_TYPES
+
+    # 'accuracy' of coordinates will be determined by place types which are grouped as:
+    _address1_level_place_types = [PlaceType.STREET, PlaceType.DEPARTMENT, PlaceType.BUILDING,
+                                   PlaceType.FARM, PlaceType.NEIGHBORHOOD, PlaceType.HAMLET]
+    _address2_level_place_types = [PlaceType.VILLAGE, PlaceType.BOROUGH, PlaceType.LOCALITY]
+    _city_level_place_types = [PlaceType.TOWN, PlaceType.MUNICIPALITY, PlaceType.CITY, PlaceType.PARISH]
+    _county_level_place_types = [PlaceType.DISTRICT, PlaceType.COUNTY, PlaceType.REGION]
+    _state_level_place_types = [PlaceType.STATE]
+    _country_level_place_types = [PlaceType.COUNTRY]
+    _unknown_level_place_types = [PlaceType.UNKNOWN, PlaceType.CUSTOM]  # will be interpreted with highest accuracy
+
+    # place type -> (TNG place level, zoom level). States and countries have always been exported
+    # with the default levels, so they are not in the table.
+    _tng_place_levels = dict([(place_type, (1, 13)) for place_type in _unknown_level_place_types]
+                             + [(place_type, (1, 13)) for place_type in _address1_level_place_types]
+                             + [(place_type, (2, 11)) for place_type in _address2_level_place_types]
+                             + [(place_type, (3, 9)) for place_type in _city_level_place_types]
+                             + [(place_type, (4, 7)) for place_type in _county_level_place_types])
+    _default_tng_place_level = (6, 9)
+
+    # if @ signs are doubled in values, and in values with @# escapes, found out from GedcomWriter on first use
+    _double_at_signs = None
+    _double_escaped_at_signs = None
+
+    # Gramps 4.2 passes the handle of the family to _family, Gramps 5 only the family
+    _family_takes_handle = "family_handle" in inspect.signature(exportgedcom.GedcomWriter._family).parameters
+
+    _days_in_month = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+    # flags used in place info (see _get_place_info)
+    _place_key_flags = tuple((key, 1 << index) for index, key in enumerate(_place_keys))
+    _place_key_flag = dict(_place_key_flags)
+    _all_place_key_flags = (1 << len(_place_keys)) - 1
+    _extra_info_flag = 1 << len(_place_keys)
+
+    #parser = FormatStringParser()
+
+    def __init__(self, database, user, option_box=None):
+        super(GedcomWriterWithOptions, self).__init__(database, user, option_box)
+        if option_box:
+            self.sort_children = option_box.sort_children
+            self.sort_events = option_box.sort_events
+            self.reversed_places = option_box.reversed_places
+            self.get_coordinates = option_box.get_coordinates
+            self.export_only_useful_pe_addresses = option_box.export_only_useful_pe_addresses
+            self.extended_pe_addresses = option_box.extended_pe_addresses
+            self.avoid_repetition_in_places = option_box.avoid_repetition_in_places
+            self.include_tng_place_levels = option_box.include_tng_place_levels
+            self.omit_borough_from_address = option_box.omit_borough_from_address
+            self.move_patronymics = option_box.move_patronymics
+            self.materialize_filters = option_box.materialize_filters
+        else:
+            self.sort_children = 0
+            self.sort_events = 0
+            self.reversed_places = 0
+            self.get_coordinates = 0
+            self.export_only_useful_pe_addresses = 0
+            self.extended_pe_addresses = 0
+            self.avoid_repetition_in_places = 0
+            self.include_tng_place_levels = 0
+            self.omit_borough_from_address = 0
+            self.move_patronymics = 0
+            self.materialize_filters = 0
+
+        # Snapshot of the main tables, or of all tables to materialize the filters of the option box.
+        # Pipelined export reads individuals and families from another thread, which needs a snapshot,
+        # and shards are written by threads sharing a snapshot of all tables.
+        self.snapshot = None
+        sharded = option_box and (option_box.shards or option_box.shard_size)
+        if option_box and (option_box.snapshot or option_box.pipeline or sharded or self.materialize_filters):
+            memory_limit = option_box.snapshot_memory_limit
+            if self.materialize_filters or sharded:
+                tables = DatabaseSnapshot.ALL_TABLES
+            else:
+                tables = DatabaseSnapshot.MAIN_TABLES
+            self.snapshot = DatabaseSnapshot(self.dbase, tables=tables,
+                                             memory_limit=memory_limit * 1048576 if memory_limit else None)
+            self.dbase = self.snapshot
+
+        self.db = self.dbase  # some methods copied from other plugins use this. just avoiding renaming.
+        self._new_caches()
+        self._person_index = None
+        self._family_gramps_id = None  # family being written, for anomaly log
+
+        # Timings of address format strings are collected with the export profile
+        self.parser = FormatStringParser(PlaceComponents.KEYS, profile=bool(option_box and option_box.profile))
+
+        # Address formats are compiled only once. Custom formats given in options are already compiled.
+        address_format = self._address_format
+        if option_box and option_box.address_format:
+            address_format = option_box.address_format
+        self.address_format = [self.parser.compile(format_string) for format_string in address_format]
+        self.def_address_format = [self.parser.compile(format_string) for format_string in self._def_address_format]
+
+        # Export profiling is installed by wrapping methods, costing nothing when not used
+        self.export_profile = None
+        if option_box and option_box.profile:
+            self.export_profile = GedcomExportProfile()
+            self.export_profile.install(self)
+
+        # Incremental export reuses unchanged person and family records of the previous export
+        self.incremental_export = None
+        if option_box and option_box.incremental:
+            settings = dict(version=__version__,
+                            private=bool(option_box.private),
+                            options=[[name, int(getattr(self, name))]
+                                     for name, value in GedcomWriterOptions._option_defaults],
+                            address_format=[str(format_string) for format_string in self.address_format])
+            self.incremental_export = IncrementalExport(settings)
+            self.incremental_export.install(self)
+
+        # Sorting anomalies are logged only if asked, otherwise they are not even evaluated
+        self.anomaly_log = None
+        if option_box and option_box.anomaly_log:
+            self.anomaly_log = AnomalyLog(option_box.anomaly_log, max_rate=option_box.anomaly_log_rate)
+
+        # Byte ranges of level 0 records, collected while writing
+        self.record_index = None
+        if option_box and option_box.record_index:
+            self.record_index = RecordIndex()
+
+        # Pipelined writing of individuals and families. Incremental export and record index need
+        # output positions of records, which are not known when records are written to blocks.
+        self.export_pipeline = None
+        if option_box and option_box.pipeline:
+            if self.incremental_export is not None or self.record_index is not None:
+                LOG.warning("Pipelined export is not used with incremental export or record index")
+            elif not self.snapshot.is_complete("person", "family"):
+                LOG.warning("Pipelined export is not used when individuals and families do not fit in the snapshot")
+            else:
+                self.export_pipeline = ExportPipeline()
+
+        # Shards are written by copies of this writer, which cannot use the methods wrapped by a profile
+        # or write into the single output of incremental export and record index
+        self.sharded_export = None
+        if sharded:
+            if self.export_profile is not None or self.incremental_export is not None or self.record_index is not None:
+                LOG.warning("Sharded export is not used with profile, incremental export or record index")
+            elif not self.snapshot.is_complete():
+                LOG.warning("Sharded export is not used when the family tree does not fit in the snapshot")
+            else:
+                if self.export_pipeline is not None:
+                    LOG.warning("Pipelined export is not used with sharded export")
+                    self.export_pipeline = None
+                self.sharded_export = ShardedExport(option_box.shards, option_box.shard_by,
+                                                    option_box.shard_size * 1048576 if option_box.shard_size else None,
+                                                    option_box.shard_workers)
+        print("Gedcom Options " + __version__ + " loaded")
+
+    def write_gedcom_file(self, filename):
+        start = time.perf_counter()
+        if self.export_profile is not None:
+            self.export_profile.start()
+        if self.anomaly_log is not None:
+            self.anomaly_log.open()
+        try:
+            if self.sharded_export is not None:
+                ret = self.sharded_export.write(self, filename)
+            elif self.incremental_export is None:
+                ret = super(GedcomWriterWithOptions, self).write_gedcom_file(filename)
+            else:
+                self.incremental_export.begin(filename)
+                ret = False
+                try:
+                    ret = super(GedcomWriterWithOptions, self).write_gedcom_file(filename)
+                finally:
+                    self.incremental_export.finish(filename, ret)
+        finally:
+            if self.anomaly_log is not None:
+                self.anomaly_log.close()
+        if self.record_index is not None and ret:
+            self.record_index.finish(os.path.getsize(filename))
+            self.record_index.write(RecordIndex.get_index_filename(filename))
+        if self.parser.profile is not None:
+            LOG.info(self.parser.profile.format_report())
+        if self.snapshot is not None:
+            LOG.info(self.snapshot.format_report())
+            LOG.info("Export written in %.1f ms", (time.perf_counter() - start) * 1000)
+        if self.export_pipeline is not None:
+            LOG.info(self.export_pipeline.format_report())
+        if self.sharded_export is not None:
+            LOG.info(self.sharded_export.format_report())
+        if self.export_profile is not None:
+            self.export_profile.stop()
+            LOG.info(self.export_profile.format_report())
+            self.export_profile.write_json(filename + ".profile.json")
+        return ret
+
+    def _new_caches(self):
+        """
+        Gives the writer empty caches of its own. Shard writers, copies of the writer writing in
+        threads of their own, get their own caches with this.
+        """
+        self.place_title_formatter = PlaceTitleFormatter(avoid_repetition=self.avoid_repetition_in_places,
+                                                         reverse=self.reversed_places,
+                                                         replace_cr=True)
+        self._place_info_cache = dict()  # (title, place names) -> flags
+        self._tng_place_level_cache = dict()  # place handle -> (place level, zoom level)
+
+    def _writeln(self, level, token, textlines="", limit=72):
+        """
+        Write a line of text to the output file in the form of:
+
+            LEVEL TOKEN text
+
+        Newlines in the text are written as CONT lines, and lines longer than the limit are continued
+        in CONC lines, broken with exportgedcom.breakup() like GedcomWriter does. All lines of the
+        value are written at once.
+        """
+        assert token
+        if level == 0 and self.record_index is not None:
+            self.record_index.start_record(token, self.gedcom_file.tell())
+        if not textlines:
+            self.gedcom_file.write("%d %s\n" % (level, token))
+            return
+        if "\r" in textlines:
+            textlines = textlines.replace('\n\r', '\n').replace('\r', '\n')
+        if self._double_at_signs is None:
+            GedcomWriterWithOptions._double_escaped_at_signs = self._base_doubles_at_signs("@#DJULIAN@ 1700")
+            GedcomWriterWithOptions._double_at_signs = self._base_doubles_at_signs("a@b")
+        if (self._double_at_signs and "@" in textlines and not textlines.startswith('@')  # avoid xrefs
+                and (self._double_escaped_at_signs or "@#" not in textlines)):  # and escapes
+            textlines = textlines.replace('@', '@@')
+        if "\n" not in textlines and (not limit or len(textlines) <= limit):
+            self.gedcom_file.write("%d %s %s\n" % (level, token, textlines))
+            return
+
+        lines = []
+        token_level = level
+        prefix = "\n%d CONC " % (level + 1)
+        for text in textlines.split('\n'):
+            if limit and len(text) > limit:
+                text = prefix.join(exportgedcom.breakup(text, limit))
+            lines.append("%d %s %s\n" % (token_level, token, text))
+            token_level = level + 1
+            token = "CONT"
+        self.gedcom_file.write("".join(lines))
+
+    @staticmethod
+    def _base_doubles_at_signs(value):
+        """
+        Returns True if GedcomWriter of this Gramps version doubles @ signs in the value (Gramps 5 does,
+        except in values with @# escapes)
+        """
+        class Probe():
+            gedcom_file = io.StringIO()
+        exportgedcom.GedcomWriter._writeln(Probe(), 1, "NOTE", value)
+        return "@@" in Probe.gedcom_file.getvalue()
+
+    def _individuals(self):
+        if self.export_pipeline is None:
+            return super(GedcomWriterWithOptions, self)._individuals()
+        self.export_pipeline.write_records(self, "person", self.dbase.iter_people,
+                                           lambda person, handle: self._person(person))
+
+    def _families(self):
+        if self.export_pipeline is None:
+            return super(GedcomWriterWithOptions, self)._families()
+        self.export_pipeline.write_records(self, "family", self.dbase.iter_families,
+                                           lambda family, handle: self._write_family(family))
+
+    def _person(self, person):
+        if self.incremental_export is None or person is None:
+            return super(GedcomWriterWithOptions, self)._person(person)
+        self.incremental_export.write_record(self, "person", person,
+                                             super(GedcomWriterWithOptions, self)._person, person)
+
+    def _family(self, family, *args):
+        self._family_gramps_id = family.get_gramps_id() if family is not None else None
+        if self.incremental_export is None or family is None:
+            return super(GedcomWriterWithOptions, self)._family(family, *args)
+        self.incremental_export.write_record(self, "family", family,
+                                             super(GedcomWriterWithOptions, self)._family, family, *args)
+
+    def _write_family(self, family):
+        """
+        Writes the record of the family with the arguments _family takes in this Gramps version
+        """
+        if self._family_takes_handle:
+            self._family(family, family.get_handle())
+        else:
+            self._family(family)
+
+    def _person_name(self, name, attr_nick):
+        """
+        n NAME <NAME_PERSONAL> {1:1}
+        +1 NPFX <NAME_PIECE_PREFIX> {0:1}
+        +1 GIVN <NAME_PIECE_GIVEN> {0:1}
+        +1 NICK <NAME_PIECE_NICKNAME> {0:1}
+        +1 SPFX <NAME_PIECE_SURNAME_PREFIX {0:1}
+        +1 SURN <NAME_PIECE_SURNAME> {0:1}
+        +1 NSFX <NAME_PIECE_SUFFIX> {0:1}
+        +1 <<SOURCE_CITATION>> {0:M}
+        +1 <<NOTE_STRUCTURE>> {0:M}
+        """
+
+        if not self.move_patronymics:
+            super(GedcomWriterWithOptions, self)._person_name(name, attr_nick)
+        else:
+            firstname = name.get_first_name().strip()
+            surns = []
+            surprefs = []
+
+            for surn in name.get_surname_list():
+                if surn.get_origintype() == NameOriginType.PATRONYMIC \
+                        or surn.get_origintype() == NameOriginType.MATRONYMIC:
+                    firstname = firstname + " " + surn.get_surname().replace('/', '?')
+                else:
+                    surns.append(surn.get_surname().replace('/', '?'))
+
+                    if surn.get_connector():
+                        # we store connector with the surname
+                        surns[-1] = surns[-1] + ' ' + surn.get_connector()
+                    surprefs.append(surn.get_prefix().replace('/', '?'))
+            surname = ', '.join(surns)
+            surprefix = ', '.join(surprefs)
+            suffix = name.get_suffix()
+            title = name.get_title()
+            nick = name.get_nick_name().strip()
+            call = name.get_call_name().strip()
+            if call.strip() != '':
+                if nick != '' and nick.lower() != call.lower():
+                    nick = call + ', ' + nick
+                else:
+                    nick = call
+            if nick == '':
+                nick = attr_nick
+
+            #gedcom name
+            gedcom_surname = name.get_surname().replace('/', '?')
+            if suffix == "":
+                gedcom_name = '%s /%s/' % (firstname, gedcom_surname)
+            else:
+                gedcom_name = '%s /%s/ %s' % (firstname, gedcom_surname, suffix)
+
+            self._writeln(1, 'NAME', gedcom_name)
+            if int(name.get_type()) == NameType.BIRTH:
+                pass
+            elif int(name.get_type()) == NameType.MARRIED:
+                self._writeln(2, 'TYPE', 'married')
+            elif int(name.get_type()) == NameType.AKA:
+                self._writeln(2, 'TYPE', 'aka')
+            else:
+                self._writeln(2, 'TYPE', name.get_type().xml_str())
+
+            if firstname:
+                self._writeln(2, 'GIVN', firstname)
+            if surprefix:
+                self._writeln(2, 'SPFX', surprefix)
+            if surname:
+                self._writeln(2, 'SURN', surname)
+            if name.get_suffix():
+                self._writeln(2, 'NSFX', suffix)
+            if name.get_title():
+                self._writeln(2, 'NPFX', title)
+            if nick:
+                self._writeln(2, 'NICK', nick)
+
+            self._source_references(name.get_citation_list(), 2)
+        self._note_references(name.get_note_list(), 2)
+
+    def _person_event_ref(self, key, event_ref):
+        """
+        Write out the BIRTH and DEATH events for the person.
+        """
+        if event_ref:
+            event = self.dbase.get_event_from_handle(event_ref.ref)
+            ## if event_has_subordinate_data(event, event_ref):
+            self._writeln(1, key)
+            ## else:
+            ##    self._writeln(1, key, 'Y')
+            if event.get_description().strip() != "":
+                self._writeln(2, 'TYPE', event.get_description())
+            self._dump_event_stats(event, event_ref)
+
+    def _place(self, place, dateobj, level):
+        """
+        PLACE_STRUCTURE:=
+            n PLAC <PLACE_NAME> {1:1}
+            +1 FORM <PLACE_HIERARCHY> {0:1}
+            +1 FONE <PLACE_PHONETIC_VARIATION> {0:M}  # not used
+            +2 TYPE <PHONETIC_TYPE> {1:1}
+            +1 ROMN <PLACE_ROMANIZED_VARIATION> {0:M} # not used
+            +2 TYPE <ROMANIZED_TYPE> {1:1}
+            +1 MAP {0:1}
+            +2 LATI <PLACE_LATITUDE> {1:1}
+            +2 LONG <PLACE_LONGITUDE> {1:1}
+            +1 <<NOTE_STRUCTURE>> {0:M}
+
+        ADDRESS STRUCTURE;=
+            n ADDR <ADDR1>
+            +1 ADR1 <ADDR1>
+            +1 ADR2 <ADDR2>
+            +1 CITY <CITY>
+            +1 STAE <STATE>
+            +1 POST <POSTAL CODE>
+            +1 CTRY <COUNTRY>
+
+        Where
+            ADDR1 = street, unknown, custom, department, building, farm, neighborhood
+            ADDR2 = hamlet, village, borough, locality
+            CITY = municipality, town, city, parish
+            STATE = district, province, region, county, state
+            COUNTRY = country
+        """
+
+        if place is None:
+            return
+
+        place_name = place_displayer.display(self.dbase, place, dateobj) #changed since 4.1
+        title = self.place_title_formatter.format(place_name)
+
+        self._writeln(level, "PLAC", title, limit=120)
+        longitude = place.get_longitude()
+        latitude = place.get_latitude()
+
+        # Get missing coordinates from place tree
+
+        max_place_level_difference = 4  # max diff to inherit coordinates to enclosed place
+
+        place_level, zoom_level = self._tng_place_level(place)
+
+        ### Inherit coordinates
+        if self.get_coordinates:
+
+            test_tng_place_level = place_level
+            inherited_place = None
+
+            place_level_diff = 999
+
+            if self.get_coordinates and not longitude and not latitude:
+                place_list = self.get_place_list(place, dateobj)
+                if len(place_list) > 1:
+                    for place_above in place_list:
+                        if place is not place_above:
+                            title_above = place_displayer.display(self.dbase, place_above, dateobj).replace('\r', ' ')
+                            test_longitude = place_above.get_longitude()
+                            test_latitude = place_above.get_latitude()
+                            if test_latitude and test_longitude:
+                                test_tng_place_level = self._tng_place_level(place_above)[0]
+                                test_place_level_diff = test_tng_place_level - place_level
+
+                                # negative differences means the place is even more accurate
+                                # (how to treat this?)
+                                if test_place_level_diff < 0:
+                                    test_place_level_diff = 0
+
+                                if test_place_level_diff < place_level_diff \
+                                        and test_place_level_diff <=  max_place_level_difference \
+                                        or title == title_above:
+                                    longitude = test_longitude
+                                    latitude = test_latitude
+                                    inherited_place = place_above
+                                    place_level_diff = test_place_level_diff
+                    if inherited_place:
+                        place_level, zoom_level = self._tng_place_level(inherited_place)
+
+        if longitude and latitude:
+            (latitude, longitude) = conv_lat_lon(latitude, longitude, "GEDCOM")
+        if longitude and latitude:
+            self._writeln(level+1, "MAP")
+            self._writeln(level+2, 'LATI', latitude)
+            self._writeln(level+2, 'LONG', longitude)
+            if self.include_tng_place_levels:
+                self._writeln(level+2, 'PLEV', '%d' % place_level)
+                self._writeln(level+2, 'ZOOM', '%d' % zoom_level)
+
+        # The Gedcom standard shows that an optional address structure can
+        # be written out in the event detail.
+        # http://homepages.rootsweb.com/~pmcbride/gedcom/55gcch2.htm#EVENT_DETAIL
+        placetree = self.generate_place_dictionary(place, dateobj)
+
+        # Check if there is any piece of information in places that is not in place's title, and if is,
+        # will add address data in gedcom. Also omitted borough and repetitive places are looked up here.
+        place_info = self._get_place_info(title, placetree)
+
+        if not self.export_only_useful_pe_addresses or place_info & self._extra_info_flag:
+
+            # Omit borough and repetitive places
+            placetree = placetree.omit(place_info & self._all_place_key_flags)
+
+            # Generate Address field from all the place types given
+            if self.extended_pe_addresses:
+                address_format = self.address_format
+            else:
+                address_format = self.def_address_format
+
+            address1 = self.parser.parse(placetree, address_format[0])
+            address2 = self.parser.parse(placetree, address_format[1])
+            city = self.parser.parse(placetree, address_format[2])
+            state = self.parser.parse(placetree, address_format[3])
+            country = self.parser.parse(placetree, address_format[4])
+            postal_code = self.parser.parse(placetree, address_format[5])
+
+            # Write Address For the Place
+            if address1 or address2 or state or postal_code:
+                self._writeln(level, "ADDR", address1)
+                if address1:
+                    self._writeln(level + 1, 'ADR1', address1)
+                if address2:
+                    self._writeln(level + 1, 'ADR2', address2)
+                if city:
+                    self._writeln(level + 1, 'CITY', city)
+                if state:
+                    self._writeln(level + 1, 'STAE', state)
+                if postal_code:
+                    self._writeln(level + 1, 'POST', postal_code)
+                if country:
+                    self._writeln(level + 1, 'CTRY', country)
+
+        self._note_references(place.get_note_list(), level+1)
+
+    def generate_place_dictionary(self, place, dateobj):
+        """
+        Returns names of the places in the place tree by place key as PlaceComponents
+        """
+        #db = self.dbstate.get_database() -- for addresspreview
+        db = self.dbase
+        location = get_main_location(db, place, dateobj)
+        return PlaceComponents.from_location(location, place.get_code())
+
+    def remove_repetitive_places_from_string(self, place_title):
+        """
+        Removes place names that are repeated in other place names of the title, e.g.
+        "Kirkkonummi kk, Kirkkonummi, Finland" -> "Kirkkonummi kk, Finland"
+        """
+        components = PlaceTitleFormatter.split_title(place_title)
+        return ", ".join(PlaceTitleFormatter.remove_repetitive_places(components))
+
+    def reverse_order_places(self, place_title):
+        return ", ".join(reversed(PlaceTitleFormatter.split_title(place_title)))
+
+    def _get_place_info(self, place_title, place_dictionary):
+        """
+        Returns flags telling if there is extra info in place tree compared to the title
+        (_extra_info_flag), and which place keys should be omitted from the address
+        (flags in _place_key_flags).
+
+        The result depends only on the title and the names in the place tree, so it is cached by the
+        title and the tuple of place names. Events at different places, or at different dates, share
+        an entry whenever their titles and names are the same.
+
+        :param place_title:         Place title as written in PLAC
+        :param place_dictionary:    PlaceComponents
+        """
+        cache_key = (place_title, place_dictionary.values())
+        place_info = self._place_info_cache.get(cache_key)
+        if place_info is None:
+            place_info = 0
+            if self._is_extra_info_in_place_names(place_title, place_dictionary):
+                place_info |= self._extra_info_flag
+
+            # Don't show borough, when street and city is present (more like modern address)
+            if self.omit_borough_from_address and place_dictionary['street'] \
+                    and (place_dictionary['city'] or place_dictionary['town']):
+                place_dictionary = place_dictionary.omit(self._place_key_flag['borough'])
+                place_info |= self._place_key_flag['borough']
+
+            if self.extended_pe_addresses and self.avoid_repetition_in_places:
+                for key in self._get_repetitive_place_keys(place_dictionary, self.address_format):
+                    place_info |= self._place_key_flag[key]
+
+            self._place_info_cache[cache_key] = place_info
+        return place_info
+
+    def _get_repetitive_place_keys(self, place_dictionary, address_format):
+        """
+        Returns a list of keys of which values are included in other values used in the address
+        """
+        keys = dict()
+        keys_to_remove = []
+
+        for address_line in address_format:
+            keys.update(self.parser.get_parsed_keys(place_dictionary, address_line))
+
+        for key, value in keys.items():
+            if value and key not in keys_to_remove:
+                test = " " + value + " "
+                for check_key, check_value in keys.items():
+                    if key != check_key and check_value:
+                        if " " + check_value + " " in test:
+                            keys_to_remove.append(check_key)
+                            keys[check_key] = ""
+
+        return keys_to_remove
+
+    def _is_extra_info_in_place_names(self, place_title, place_dictionary):
+        """
+        Returns true if there is anything in place tree that does not exist in place title
+        """
+        if not place_title:
+            return False
+        place_names = set(place_dictionary.values())
+        place_names.discard("")
+        for place_name in place_names:
+            if place_name not in place_title:
+                return True
+        return False
+
+    def get_place_list(self, place, date=None):
+        """
+        Returns a list of all places in a place tree
+        """
+
+        if date is None:
+            date = Today()
+        visited = [place.handle]
+        lines = [place]
+        while True:
+            handle = None
+            for placeref in place.get_placeref_list():
+                ref_date = placeref.get_date_object()
+                if ref_date.is_empty() or date.match(ref_date):
+                    handle = placeref.ref
+            if handle is None or handle in visited:
+                break
+            place = self.dbase.get_place_from_handle(handle)
+            if place is None:
+                break
+            visited.append(handle)
+            lines.append(place)
+        return lines
+
+    def _tng_place_level(self, place):
+        """
+        Returns TNG place level and zoom level of the place. Results are cached by place handle.
+        """
+        handle = place.get_handle()
+        levels = self._tng_place_level_cache.get(handle)
+        if levels is None:
+            levels = self._tng_place_levels.get(int(place.get_type()), self._default_tng_place_level)
+            self._tng_place_level_cache[handle] = levels
+        return levels
+
+    #---------------
+    # Sort Children
+    # --------------
+
+    # SORT CHILDREN
+    def _family_child_list(self, child_ref_list):
+        """
+        Override of standard ExportGeccom plugin version
+        Write the child XREF values to the GEDCOM file.
+        """
+        if len(child_ref_list) == 0:
+            return
+
+        #child_list = [
+        #    self.dbase.get_person_from_handle(cref.ref).get_gramps_id()
+        #    for cref in child_ref_list]
+
+        # Sort children
+
+        if self.sort_children:
+            child_sort_list = self.decorate_by_birth(child_ref_list)
+            sorter = FuzzySort(unsortables_last=True, max_deviation=20 * 365)
+            if self.anomaly_log is not None:
+                self._log_sorting_anomalies("children", self._family_gramps_id, sorter, child_sort_list)
+
+            child_sort_list = sorter.fuzzysorted(child_sort_list)
+            child_ref_list = sorter.unpack(child_sort_list, 0)
+
+        # Write to gedcom
+        person_index = self._get_person_index()
+        for cref in child_ref_list:
+            if cref.ref in person_index:
+                gid = person_index.get_gramps_id(cref.ref)
+            else:
+                gid = self.dbase.get_person_from_handle(cref.ref).get_gramps_id()
+            if gid is None:
+                continue
+            self._writeln(1, 'CHIL', '@%s@' % gid)
+
+    def _get_person_index(self):
+        """
+        Returns PersonIndex of the exported database. Built when needed for the first time.
+        """
+        if self._person_index is None:
+            # Persons and births read from the index would be missed in the dependencies of
+            # incrementally exported records, so the database is used instead.
+            self._person_index = PersonIndex(self.dbase if self.incremental_export is None else None)
+        return self._person_index
+
+    #---------------
+    # Sort Events
+    # --------------
+
+    # SORT PERSON EVENTS
+    def _remaining_events(self, person):
+        """
+        Output all events associated with the person that are not BIRTH or
+        DEATH events.
+
+        Because all we have are event references, we have to
+        extract the real event to discover the event type.
+
+        """
+        global adop_written
+        # adop_written is only shared between this function and
+        # _process_person_event. This is rather ugly code, but it is difficult
+        # to support an Adoption event without an Adopted relationship from the
+        # parent(s), an Adopted relationship from the parent(s) without an
+        # event, and both an event and a relationship. All these need to be
+        # supported without duplicating the output of the ADOP GEDCOM tag. See
+        # bug report 2370.
+        adop_written = False
+
+        event_ref_list = person.get_event_ref_list()
+
+        if self.sort_events:
+            birth_sv, death_sv = self.get_birth_and_death_sort_values(person)
+            if birth_sv is not None:
+                birth_sv -= 200  # 200 days earlier, because of date mofifier logic (between and eg.)
+            if death_sv is not None:
+                death_sv += 200  # 200 days later for funerals and such
+            sorter = FuzzySort(unsortables_last=False, max_deviation=50*365)
+
+            # Decorate once: ((type modifier, event_ref, event), date sort value).
+            # Birth first and death based events last, then fuzzy sorted by date within them.
+            event_sort_list = sorted(self.decorate_by_event_type_and_date(event_ref_list),
+                                     key=lambda x: x[0][0])
+            if self.anomaly_log is not None:
+                self._log_sorting_anomalies("events", person.get_gramps_id(), sorter, event_sort_list,
+                                            low_value=birth_sv, high_value=death_sv)
+
+            # Main sorting, the type modifier takes precedence over the evaluated date
+            event_sort_list = sorter.evaluated(event_sort_list,
+                                               low_value=birth_sv,
+                                               high_value=death_sv)
+            event_sort_list.sort(key=lambda x: (x[0][0], x[1]))
+            event_list = [(event_ref, event) for (modifier, event_ref, event), sort_value in event_sort_list]
+        else:
+            event_list = [(event_ref, self.dbase.get_event_from_handle(event_ref.ref))
+                          for event_ref in event_ref_list]
+
+        for event_ref, event in event_list:
+            if not event: continue
+            self._process_person_event(person, event, event_ref)
+        if not adop_written:
+            self._adoption_records(person, adop_written)
+
+    # SORT FAMILY EVENTS
+    def _family_events(self, family):
+        """
+        Output the events associated with the family.
+
+        Because all we have are event references, we have to extract the real
+        event to discover the event type.
+
+        """
+        event_ref_list = family.get_event_ref_list()
+
+        if self.sort_events:
+            sorter = FuzzySort(unsortables_last=False, max_deviation=35)
+            event_sort_list = self.decorate_by_date(event_ref_list)
+            event_sort_list = sorter.fuzzysorted(event_sort_list)
+            event_ref_list = sorter.unpack(event_sort_list, 0)
+
+        for event_ref in event_ref_list:  ## orginally: family.get_event_ref_list():
+            event = self.dbase.get_event_from_handle(event_ref.ref)
+            if event is None:
+                continue
+            self._process_family_event(event, event_ref)
+            self._dump_event_stats(event, event_ref)
+
+    def decorate_by_birth(self, child_ref_list):
+        person_index = self._get_person_index()
+        child_sort_list = []
+        for cref in child_ref_list:
+            if cref.ref in person_index:
+                val = person_index.get_birth_sort_value(cref.ref)
+                child_sort_list.append((cref, val if val != 0 else None))
+                continue
+            birth_ref = self.db.get_person_from_handle(cref.ref).get_birth_ref()
+            if birth_ref is not None:
+                event = self.db.get_event_from_handle(birth_ref.ref)
+                val = event.get_date_object().get_sort_value()
+                if val == 0:
+                    val = None
+            else:
+                val = None
+            child_sort_list.append((cref, val))
+        return child_sort_list
+
+    def decorate_by_date(self, event_ref_list):
+        event_sort_list = []
+        for event_ref in event_ref_list:
+            if event_ref is not None:
+                event = self.db.get_event_from_handle(event_ref.ref)
+                val = event.get_date_object().get_sort_value()
+                if val == 0:
+                    val = None
+            else:
+                val = None
+            event_sort_list.append((event_ref, val))
+        return event_sort_list
+
+    def decorate_by_event_type_and_date(self, event_ref_list):
+        """
+        Decorates event references as ((type sort modifier, event_ref, event), date sort value)
+        loading every event only once.
+        """
+        event_sort_list = []
+        for event_ref in event_ref_list:
+            event = self.db.get_event_from_handle(event_ref.ref)
+            if event is not None:
+                modifier = self._get_event_type_sort_modifier(event.get_type())
+                val = event.get_date_object().get_sort_value()
+                if val == 0:
+                    val = None
+            else:
+                modifier = 0
+                val = None
+            event_sort_list.append(((modifier, event_ref, event), val))
+        return event_sort_list
+
+    def decorate_by_event_type(self, event_ref_list):
+        event_sort_list = []
+        for event_ref in event_ref_list:
+            if event_ref is not None:
+                val = self.get_event_type_sort_modifier(event_ref)
+            else:
+                val = 0
+            event_sort_list.append((event_ref, val))
+        return event_sort_list
+
+    def get_birth_and_death_sort_values(self, person):
+        birth_ref = person.get_birth_ref()
+        if birth_ref is not None:
+            birth = self.db.get_event_from_handle(birth_ref.ref)
+            birth_sv = birth.get_date_object().get_sort_value()
+            if birth_sv == 0:
+                birth_sv = None
+        else:
+            birth_sv = None
+
+        death_ref = person.get_death_ref()
+        if death_ref is not None:
+            death = self.db.get_event_from_handle(death_ref.ref)
+            death_sv = death.get_date_object().get_sort_value()
+            if death_sv == 0:
+                death_sv = None
+        else:
+            death_sv = None
+        return birth_sv, death_sv
+
+    def get_event_type_sort_modifier(self, event_ref):
+        event = self.db.get_event_from_handle(event_ref.ref)
+        return self._get_event_type_sort_modifier(event.get_type())
+
+    @staticmethod
+    def _get_event_type_sort_modifier(event_type):
+        val = 0
+        if event_type == EventType.BIRTH:
+            val = -1
+        if event_type == EventType.DEATH:
+            val = 1
+        if event_type == EventType.CAUSE_DEATH:
+            val = 2
+        if event_type == EventType.CREMATION:
+            val = 3
+        if event_type == EventType.BURIAL:
+            val = 4
+        return val
+
+
+    def has_individuals_without_birthdate(self, a_list):
+        person_index = self._get_person_index()
+        for cref in a_list:
+            if cref.ref in person_index:
+                if not person_index.has_birth(cref.ref):
+                    return True
+                continue
+            birth_ref = self.dbase.get_person_from_handle(cref.ref).get_birth_ref()
+            if birth_ref is None:
+                    return True
+        return False
+
+    def _log_sorting_anomalies(self, record, gramps_id, sorter, decorated_list, low_value=None, high_value=None):
+        """
+        Adds a row to the anomaly log if the list is not in order or has values out of bounds
+        """
+        trend, quality, unsortables, exceed1, exceed2, eval_fail = \
+            sorter.get_info(decorated_list, low_value=low_value, high_value=high_value)
+        need_sorting = trend < 1
+        if not (need_sorting or exceed1 or exceed2):
+            return
+        flags = []
+        if need_sorting:
+            flags.append("need_sorting")
+        if unsortables:
+            flags.append("unsortables")
+        if exceed1 or exceed2:
+            flags.append("erroneous_values")
+        if need_sorting and unsortables and eval_fail:
+            flags.append("evaluation_failed")
+        self.anomaly_log.add(record, gramps_id, flags, quality, trend)
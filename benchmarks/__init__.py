@@ -0,0 +1,4 @@
+"""
+Benchmarks of GedcomOptions, not loaded by the plugin. Run from the directory of GedcomOptions.py,
+e.g. python -m benchmarks.export_benchmark --help
+"""
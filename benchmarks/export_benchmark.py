@@ -0,0 +1,231 @@
+# *-* coding: utf-8 *-*
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""
+End-to-end export benchmarks of GedcomOptions. Run from the directory of GedcomOptions.py:
+
+    python -m benchmarks.export_benchmark [--people 10000] [--seed 0] [--golden FILE] TREE OUT.ged
+
+A synthetic family tree is generated with the name TREE if there is no such tree. Each option set
+is exported to OUT.ged in a process of its own. The startup time of the module without GTK is
+measured as in benchmarks.startup, and the results are printed and written to
+OUT.ged.benchmark.json.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import GedcomOptions
+from GedcomOptions import GedcomWriterOptions, ShardedExport
+
+
+#-------------------------------------------------------------------------
+#
+# ExportBenchmark
+#
+#-------------------------------------------------------------------------
+
+class ExportBenchmark():
+    """
+    Runs command line exports of a family tree with sets of options, each in a process of its own,
+    and records wall time, peak memory and size of the output with a checksum of its records.
+
+    Checksums are compared with golden checksums by the number of people in the tree and the
+    option set, so changes in the output are noticed while optimizing. The header and the CHAN
+    structures are left out of the checksum, as they contain the time of the export and the commit
+    times of the objects, which differ each time the synthetic tree is generated.
+    """
+
+    SCALES = (10000, 100000, 1000000)
+
+    def __init__(self, database_name, filename, option_sets=None, golden_filename=None):
+        """
+        :param database_name:   Name of the family tree
+        :param filename:        GEDCOM file written by each run
+        :param option_sets:     List of (name, command line options), None for get_option_sets()
+        :param golden_filename: JSON file of golden checksums, missing checksums are added to it
+        """
+        self.database_name = database_name
+        self.filename = filename
+        self.option_sets = option_sets if option_sets is not None else self.get_option_sets()
+        self.golden_filename = golden_filename
+        self.results = []
+
+    @staticmethod
+    def get_option_sets():
+        """
+        Returns the default option sets as a list of (name, command line options)
+        """
+        plain = ["--no-" + name.replace("_", "-") for name, value in GedcomWriterOptions._option_defaults if value]
+        return [("defaults", []),
+                ("plain", plain),
+                ("unsorted", ["--no-sort-children", "--no-sort-events"]),
+                ("snapshot", ["--snapshot"]),
+                ("pipeline", ["--pipeline"]),
+                ("materialized", ["--materialize-filters"]),
+                ("shards", ["--shards", "4"])]
+
+    def run(self, scale):
+        """
+        Runs the exports, returns True if all succeeded with the golden checksums
+
+        :param scale:   Number of people in the tree, the key of golden checksums
+        """
+        golden = dict()
+        if self.golden_filename and os.path.exists(self.golden_filename):
+            with open(self.golden_filename) as golden_file:
+                golden = json.load(golden_file)
+        checksums = golden.setdefault(str(scale), dict())
+        ok = True
+        for name, arguments in self.option_sets:
+            result = self._run_export(arguments)
+            result["options"] = name
+            result["scale"] = scale
+            if result["checksum"] is None:
+                result["golden"] = "failed"
+            elif name not in checksums:
+                checksums[name] = result["checksum"]
+                result["golden"] = "new"
+            else:
+                result["golden"] = "ok" if checksums[name] == result["checksum"] else "CHANGED"
+            ok = ok and result["golden"] in ("ok", "new")
+            self.results.append(result)
+        if self.golden_filename:
+            with open(self.golden_filename, "w") as golden_file:
+                json.dump(golden, golden_file, indent=2, sort_keys=True)
+        return ok
+
+    def _run_export(self, arguments):
+        command = [sys.executable, os.path.abspath(GedcomOptions.__file__), self.database_name, self.filename] + arguments
+        manifest_filename = ShardedExport.get_manifest_filename(self.filename)
+        for filename in (self.filename, manifest_filename):
+            if os.path.exists(filename):
+                os.remove(filename)  # output of the previous run
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        peak_rss = None
+        if hasattr(os, "wait4"):
+            pid, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            # kilobytes in Linux, bytes in macOS
+            peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        else:
+            process.wait()
+        seconds = time.perf_counter() - start
+        filenames = self._get_output_filenames() if process.returncode == 0 else []
+        return dict(seconds=seconds, peak_rss=peak_rss, returncode=process.returncode,
+                    size=sum(os.path.getsize(filename) for filename in filenames),
+                    checksum=self.get_checksum(filenames) if filenames else None)
+
+    def _get_output_filenames(self):
+        manifest_filename = ShardedExport.get_manifest_filename(self.filename)
+        if not os.path.exists(manifest_filename):
+            return [self.filename] if os.path.exists(self.filename) else []
+        with open(manifest_filename) as manifest_file:
+            manifest = json.load(manifest_file)
+        directory = os.path.dirname(self.filename)
+        return [os.path.join(directory, entry["file"]) for entry in manifest["shards"]]
+
+    @staticmethod
+    def get_checksum(filenames):
+        """
+        Returns SHA-1 of the lines of the files, leaving out the headers and
+        the CHAN structures, which carry the commit times of the tree
+        """
+        checksum = hashlib.sha1()
+        for filename in filenames:
+            with open(filename, "rb") as gedcom_file:
+                in_header = False
+                change_level = None
+                for line in gedcom_file:
+                    fields = line.lstrip(b"\xef\xbb\xbf").split(None, 2)
+                    if not fields or not fields[0].isdigit():
+                        continue
+                    level = int(fields[0])
+                    if level == 0:
+                        in_header = fields[1:2] == [b"HEAD"]
+                    if change_level is not None and level > change_level:
+                        continue
+                    change_level = level if fields[1:2] == [b"CHAN"] else None
+                    if not in_header and change_level is None:
+                        checksum.update(line)
+        return checksum.hexdigest()
+
+    def format_report(self):
+        lines = ["%-20s %10s %10s %12s %12s  %-8s %s" % ("Options", "People", "Seconds", "Peak RSS MB",
+                                                         "Size MB", "Golden", "Checksum")]
+        for result in self.results:
+            peak_rss = "%12.1f" % (result["peak_rss"] / 1048576.0) if result["peak_rss"] is not None else "%12s" % "-"
+            lines.append("%-20s %10d %10.1f %s %12.1f  %-8s %s" % (
+                result["options"], result["scale"], result["seconds"], peak_rss, result["size"] / 1048576.0,
+                result["golden"], result["checksum"] or ""))
+        return "\n".join(lines)
+
+    def print_report(self):
+        print(self.format_report())
+
+    def write_json(self, filename, startup=None):
+        with open(filename, "w") as json_file:
+            json.dump(dict(exports=self.results, startup=startup), json_file, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    from gramps.gen.db.utils import lookup_family_tree
+    from benchmarks.startup import StartupBenchmark
+    from benchmarks.synthetic import SyntheticDatabase
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of GEDCOM exports with extra options")
+    parser.add_argument("database", help="name of the Gramps family tree, generated if it does not exist")
+    parser.add_argument("filename", help="GEDCOM file written by each export")
+    parser.add_argument("--people", type=int, default=ExportBenchmark.SCALES[0],
+                        help="number of people in a generated tree (e.g. %s)"
+                             % " / ".join(str(scale) for scale in ExportBenchmark.SCALES))
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated tree")
+    parser.add_argument("--golden", metavar="FILE",
+                        help="compare output checksums with golden checksums in FILE, adding missing ones")
+    args = parser.parse_args(argv)
+
+    if lookup_family_tree(args.database) is None:
+        database = SyntheticDatabase.create(args.database, args.people, args.seed)
+    else:
+        database = GedcomOptions._open_family_tree(args.database)
+        if database is None:
+            return 1
+    scale = database.get_number_of_people()
+    database.close()
+
+    benchmark = ExportBenchmark(args.database, args.filename, golden_filename=args.golden)
+    ok = benchmark.run(scale)
+    benchmark.print_report()
+    startup = StartupBenchmark()
+    ok = startup.run() and ok
+    startup.print_report()
+    benchmark.write_json(args.filename + ".benchmark.json", startup.get_result())
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+# *-* coding: utf-8 *-*
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Startup benchmark of GedcomOptions. Run from the directory of GedcomOptions.py:
+
+    python -m benchmarks.startup [--repeat 5]
+
+The module is imported in fresh interpreters with GTK and the GUI of Gramps unavailable, as in
+command line exports, and the import times are printed. The benchmark fails if the import fails,
+or loads GTK or the GUI of Gramps.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import GedcomOptions
+
+# Imports GedcomOptions with GTK and the GUI of Gramps blocked, so importing them at module level fails.
+# The rest of gi is left available, Gramps needs GLib without the GUI too. Exits with status 2 if GTK
+# or the GUI of Gramps were imported anyway.
+_IMPORT_CODE = """
+import importlib.abc, json, sys, time
+
+class BlockGui(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path, target=None):
+        if name == "gi.repository.Gtk" or name == "gramps.gui" or name.startswith("gramps.gui."):
+            raise ImportError("%s is blocked" % name, name=name)
+
+sys.meta_path.insert(0, BlockGui())
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import GedcomOptions
+seconds = time.perf_counter() - start
+gui_modules = sorted(name for name in sys.modules
+                     if name == "gi.repository.Gtk" or name == "gramps.gui" or name.startswith("gramps.gui."))
+print(json.dumps(dict(seconds=seconds, module_seconds=GedcomOptions._import_time, gui_modules=gui_modules)))
+sys.exit(2 if gui_modules else 0)
+"""
+
+
+class StartupBenchmark():
+    """
+    Imports GedcomOptions in processes of its own with GTK unavailable, and records the time
+    of the import and of the whole process. The import time includes Gramps modules imported
+    by GedcomOptions, the module time only the body of GedcomOptions.py.
+    """
+
+    def __init__(self, repeat=5):
+        self.repeat = repeat
+        self.runs = []
+
+    def run(self):
+        """
+        Runs the imports, returns True if all of them succeeded
+        """
+        directory = os.path.dirname(os.path.abspath(GedcomOptions.__file__))
+        command = [sys.executable, "-c", _IMPORT_CODE, directory]
+        self.runs = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            process = subprocess.Popen(command, stdout=subprocess.PIPE)
+            output = process.communicate()[0]
+            run = dict(process_seconds=time.perf_counter() - start, returncode=process.returncode)
+            lines = output.decode("utf-8").splitlines()
+            if lines and lines[-1].startswith("{"):
+                run.update(json.loads(lines[-1]))
+            self.runs.append(run)
+        return all(run["returncode"] == 0 for run in self.runs)
+
+    def get_result(self):
+        """
+        Returns the fastest of the runs, which is least disturbed by the rest of the system
+        """
+        gui_modules = sorted(set(name for run in self.runs for name in run.get("gui_modules", ())))
+        succeeded = [run for run in self.runs if run["returncode"] == 0]
+        if not succeeded:
+            return dict(failed=len(self.runs), gui_modules=gui_modules)
+        result = dict((key, min(run[key] for run in succeeded))
+                      for key in ("seconds", "module_seconds", "process_seconds"))
+        result.update(runs=len(self.runs), failed=len(self.runs) - len(succeeded), gui_modules=gui_modules)
+        return result
+
+    def format_report(self):
+        result = self.get_result()
+        if result["gui_modules"]:
+            return "Startup without GTK: GUI modules imported: %s" % ", ".join(result["gui_modules"])
+        if "seconds" not in result:
+            return "Startup without GTK: import failed in %d runs" % result["failed"]
+        return ("Startup without GTK: import %.1f ms, module %.1f ms, process %.1f ms (best of %d)"
+                % (result["seconds"] * 1000, result["module_seconds"] * 1000,
+                   result["process_seconds"] * 1000, result["runs"]))
+
+    def print_report(self):
+        print(self.format_report())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup benchmark of GedcomOptions without GTK")
+    parser.add_argument("--repeat", type=int, default=5, help="number of imports")
+    args = parser.parse_args(argv)
+
+    benchmark = StartupBenchmark(args.repeat)
+    ok = benchmark.run()
+    benchmark.print_report()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,311 @@
+# *-* coding: utf-8 *-*
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""
+Synthetic family trees for benchmarking GEDCOM exports
+"""
+
+from __future__ import print_function
+
+import random
+import time
+
+from gramps.gen.lib import (ChildRef, Date, Event, EventRef, EventRoleType, EventType, Family, FamilyRelType,
+                            Name, NameOriginType, Person, Place, PlaceName, PlaceRef, PlaceType, Surname)
+
+
+#-------------------------------------------------------------------------
+#
+# SyntheticDatabase
+#
+#-------------------------------------------------------------------------
+
+class SyntheticDatabase():
+    """
+    Generates a reproducible family tree for benchmarking exports: generations of families
+    descending from founders born around 1700, with the kind of data that keeps the export busy.
+
+        places      countries, states, counties, parishes and villages, some villages moved from
+                    one parish to another with dated place references, coordinates missing from
+                    half of the villages and some of the parishes
+        names       patronymics for people born before 1880, with a farm name for some of them,
+                    inherited surnames after that
+        events      births, baptisms, deaths, burials and marriages, some without date or place,
+                    dates partly exact and partly years, estimates and ranges
+
+    The same number of people and seed always give the same tree, with the same handles and
+    gramps IDs.
+    """
+
+    _male_names = ("Juho", "Matti", "Antti", "Heikki", "Johan", "Erkki", "Kustaa", "Jaakko", "Pekka",
+                   "Mikko", "Olli", "Tuomas", "Henrik", "Kaarle", "Lauri", "Sakari", "Aappo", "Iisakki")
+    _female_names = ("Maria", "Anna", "Liisa", "Kaisa", "Helena", "Brita", "Valpuri", "Maija", "Sofia",
+                     "Kristiina", "Margareta", "Eeva", "Susanna", "Elisabet", "Hedvig", "Karoliina")
+    _syllables = ("ko", "ski", "la", "mä", "ki", "nen", "jär", "vi", "lah", "ti", "kan", "gas", "ta",
+                  "pel", "lo", "saa", "ri", "hol", "ma", "ran", "ne", "val", "ke", "suo")
+
+    _people_per_village = 50
+    _patronymic_until = 1880  # birth year
+    _reference_year = 1700  # birth year of the founders
+    _founder_share = 20  # one couple of founders for this many people, keeping the last births before 2020
+
+    def __init__(self, persons, seed=0):
+        """
+        :param persons: Number of people to generate
+        :param seed:    Seed of the random generator
+        """
+        self.persons = persons
+        self.random = random.Random(seed)
+        self._counters = dict()
+        self._database = None
+        self._trans = None
+        self._parishes = []
+        self._villages = []
+        self._birth_years = dict()  # handle -> birth year of people not yet added
+        self._added = 0
+
+    @staticmethod
+    def create(name, persons, seed=0):
+        """
+        Creates a family tree with the name and generates the people into it. Returns the opened
+        database.
+        """
+        from gramps.cli.clidbman import CLIDbManager
+        from gramps.gen.dbstate import DbState
+        from gramps.gen.db.utils import open_database
+
+        CLIDbManager(DbState()).create_new_db_cli(name, dbid="sqlite")
+        database = open_database(name)
+        SyntheticDatabase(persons, seed).generate(database)
+        return database
+
+    def generate(self, database):
+        from gramps.gen.db import DbTxn
+
+        start = time.perf_counter()
+        self._database = database
+        with DbTxn("Synthetic database", database, batch=True) as self._trans:
+            self._add_places()
+            generation = [self._new_person(gender, self._reference_year + self.random.randint(-20, 20), None)
+                          for gender in [Person.MALE, Person.FEMALE] * max(5, self.persons // self._founder_share)]
+            while generation:
+                children = []
+                for father, mother in self._pair(generation):
+                    children.extend(self._add_family(father, mother))
+                for person in generation:
+                    self._database.add_person(person, self._trans)
+                    del self._birth_years[person.get_handle()]
+                generation = children
+        self._trans = None
+        print("Synthetic database: %d people generated in %.1f s" % (self._added, time.perf_counter() - start))
+
+    def _next_id(self, prefix):
+        number = self._counters.get(prefix, 0)
+        self._counters[prefix] = number + 1
+        return "%s%07d" % (prefix, number)
+
+    def _new_object(self, obj, prefix):
+        gramps_id = self._next_id(prefix)
+        obj.set_handle("_" + gramps_id)
+        obj.set_gramps_id(gramps_id)
+        return obj
+
+    def _place_name(self):
+        name = "".join(self.random.choice(self._syllables) for i in range(self.random.randint(2, 3)))
+        return name.capitalize()
+
+    def _add_place(self, place_type, parents, coordinates, latitude=0.0, longitude=0.0):
+        """
+        :param parents:     List of (parent place, date of the reference or None)
+        """
+        place = self._new_object(Place(), "P")
+        place_name = PlaceName()
+        place_name.set_value(self._place_name())
+        place.set_name(place_name)
+        place.set_type(PlaceType(place_type))
+        for parent, date in parents:
+            placeref = PlaceRef()
+            placeref.set_reference_handle(parent.get_handle())
+            if date is not None:
+                placeref.set_date_object(date)
+            place.add_placeref(placeref)
+        if coordinates:
+            place.set_latitude("%.4f" % latitude)
+            place.set_longitude("%.4f" % longitude)
+        self._database.add_place(place, self._trans)
+        return place
+
+    def _add_places(self):
+        village_count = max(20, self.persons // self._people_per_village)
+        parish_count = max(4, village_count // 12)
+        county_count = max(2, parish_count // 8)
+        state_count = max(2, county_count // 4)
+        rnd = self.random
+        countries = [self._add_place(PlaceType.COUNTRY, [], True, 60 + 4 * i, 25 - 10 * i) for i in range(2)]
+        states = [self._add_place(PlaceType.STATE, [(countries[i % 2], None)], True) for i in range(state_count)]
+        counties = [self._add_place(PlaceType.COUNTY, [(rnd.choice(states), None)], rnd.random() < 0.9)
+                    for i in range(county_count)]
+        self._parishes = [self._add_place(PlaceType.PARISH, [(rnd.choice(counties), None)], rnd.random() < 0.8,
+                                          rnd.uniform(59.8, 69.0), rnd.uniform(21.0, 31.0))
+                          for i in range(parish_count)]
+        for i in range(village_count):
+            parish = rnd.choice(self._parishes)
+            if rnd.random() < 0.15:
+                # moved to another parish
+                year = rnd.randint(1800, 1950)
+                parents = [(parish, self._modified_date(Date.MOD_BEFORE, year)),
+                           (rnd.choice(self._parishes), self._modified_date(Date.MOD_AFTER, year - 1))]
+            else:
+                parents = [(parish, None)]
+            self._villages.append(self._add_place(PlaceType.VILLAGE, parents, rnd.random() < 0.5,
+                                                  rnd.uniform(59.8, 69.0), rnd.uniform(21.0, 31.0)))
+
+    @staticmethod
+    def _modified_date(modifier, year):
+        date = Date()
+        date.set(modifier=modifier, value=(0, 0, year, False))
+        return date
+
+    def _date(self, year, dated=1.0):
+        """
+        Returns a date in the year or near it, or an empty date if not dated
+        """
+        date = Date()
+        value = self.random.random()
+        if self.random.random() >= dated:
+            pass
+        elif value < 0.7:
+            date.set_yr_mon_day(year, self.random.randint(1, 12), self.random.randint(1, 28))
+        elif value < 0.85:
+            date.set_yr_mon_day(year, 0, 0)
+        elif value < 0.95:
+            date.set(modifier=Date.MOD_ABOUT, value=(0, 0, year, False))
+        else:
+            date.set(modifier=Date.MOD_RANGE, value=(0, 0, year - 2, False, 0, 0, year + 2, False))
+        return date
+
+    def _add_event(self, obj, event_type, date, place, role=None):
+        event = self._new_object(Event(), "E")
+        event.set_type(EventType(event_type))
+        event.set_date_object(date)
+        if place is not None and self.random.random() < 0.9:
+            event.set_place_handle(place.get_handle())
+        self._database.add_event(event, self._trans)
+        event_ref = EventRef()
+        event_ref.set_reference_handle(event.get_handle())
+        if role is not None:
+            event_ref.set_role(EventRoleType(role))
+        obj.add_event_ref(event_ref)
+        return event_ref
+
+    def _new_person(self, gender, birth_year, father):
+        """
+        Returns a new person with name and events, not yet added to the database
+        """
+        rnd = self.random
+        person = self._new_object(Person(), "I")
+        person.set_gender(gender)
+        name = Name()
+        name.set_first_name(rnd.choice(self._male_names if gender == Person.MALE else self._female_names))
+        father_name = father.get_primary_name() if father is not None else None
+        if birth_year < self._patronymic_until:
+            if father_name is not None:
+                patronymic = Surname()
+                patronymic.set_surname(father_name.get_first_name()
+                                       + ("npoika" if gender == Person.MALE else "ntytär"))
+                patronymic.set_origintype(NameOriginType(NameOriginType.PATRONYMIC))
+                name.add_surname(patronymic)
+            if father_name is None or rnd.random() < 0.5:
+                farm = Surname()
+                farm.set_surname(self._place_name() + "la")
+                farm.set_origintype(NameOriginType(NameOriginType.LOCATION))
+                name.add_surname(farm)
+        else:
+            inherited = [father_surname for father_surname in father_name.get_surname_list()
+                         if father_surname.get_origintype() != NameOriginType.PATRONYMIC] if father_name else []
+            surname = Surname()
+            surname.set_surname(inherited[0].get_surname() if inherited else self._place_name() + "nen")
+            surname.set_origintype(NameOriginType(NameOriginType.INHERITED))
+            name.add_surname(surname)
+        name.set_primary_surname(len(name.get_surname_list()) - 1)
+        person.set_primary_name(name)
+
+        village = rnd.choice(self._villages)
+        person.set_birth_ref(self._add_event(person, EventType.BIRTH, self._date(birth_year, 0.85), village))
+        if rnd.random() < 0.6:
+            self._add_event(person, EventType.BAPTISM, self._date(birth_year, 0.9), rnd.choice(self._parishes))
+        if birth_year < 1940 and rnd.random() < 0.7:
+            death_year = birth_year + (rnd.randint(0, 5) if rnd.random() < 0.25 else rnd.randint(20, 95))
+            person.set_death_ref(self._add_event(person, EventType.DEATH, self._date(death_year, 0.8), village))
+            if rnd.random() < 0.4:
+                self._add_event(person, EventType.BURIAL, self._date(death_year, 0.7), rnd.choice(self._parishes))
+        self._birth_years[person.get_handle()] = birth_year
+        self._added += 1
+        return person
+
+    def _pair(self, generation):
+        """
+        Returns couples of the generation, marrying about three quarters of the people, with
+        spouses from outside for those without a partner in the generation
+        """
+        rnd = self.random
+        men = [person for person in generation if person.get_gender() == Person.MALE and rnd.random() < 0.75]
+        women = [person for person in generation if person.get_gender() == Person.FEMALE and rnd.random() < 0.75]
+        rnd.shuffle(women)
+        couples = list(zip(men, women))
+        for person in men[len(women):] + women[len(men):]:
+            if self._added >= self.persons:
+                break
+            gender = Person.FEMALE if person.get_gender() == Person.MALE else Person.MALE
+            spouse = self._new_person(gender, self._birth_year(person) + rnd.randint(-5, 5), None)
+            generation.append(spouse)
+            couples.append((person, spouse) if gender == Person.FEMALE else (spouse, person))
+        return couples
+
+    def _birth_year(self, person):
+        return self._birth_years[person.get_handle()]
+
+    def _add_family(self, father, mother):
+        """
+        Adds the family with its marriage, returns the children, which are not yet added
+        """
+        rnd = self.random
+        family = self._new_object(Family(), "F")
+        family.set_father_handle(father.get_handle())
+        family.set_mother_handle(mother.get_handle())
+        family.set_relationship(FamilyRelType(FamilyRelType.MARRIED))
+        father.add_family_handle(family.get_handle())
+        mother.add_family_handle(family.get_handle())
+        mother_born = self._birth_year(mother)
+        if rnd.random() < 0.8:
+            self._add_event(family, EventType.MARRIAGE, self._date(mother_born + rnd.randint(18, 30), 0.75),
+                            rnd.choice(self._parishes), EventRoleType.FAMILY)
+        children = []
+        for i in range(rnd.choice((0, 1, 1, 2, 2, 3, 3, 3, 4, 4, 5, 6, 7, 8))):
+            if self._added >= self.persons:
+                break
+            child = self._new_person(rnd.choice((Person.MALE, Person.FEMALE)), mother_born + rnd.randint(18, 44),
+                                     father)
+            child.add_parent_family_handle(family.get_handle())
+            child_ref = ChildRef()
+            child_ref.set_reference_handle(child.get_handle())
+            family.add_child_ref(child_ref)
+            children.append(child)
+        self._database.add_family(family, self._trans)
+        return children
@@ -0,0 +1,132 @@
+# *-* coding: utf-8 *-*
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+"""
+Micro-benchmark of GedcomWriterWithOptions._writeln against exportgedcom.GedcomWriter._writeln.
+Run from the directory of GedcomOptions.py:
+
+    python -m benchmarks.writeln [--repeat 5]
+
+Short, long, multi-line and escaped values, and values with non-ASCII characters at the line length
+limit, are written to memory, and the best times of both writers are printed. The outputs of the writers are compared, so a difference fails the benchmark.
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import sys
+import time
+
+from gramps.plugins.export import exportgedcom
+
+from GedcomOptionsWriter import GedcomWriterWithOptions
+
+# name, values and the number of times they are written
+CASES = (
+    ("short", "Helsinki, Uusimaa, Finland", 100000),
+    ("long", "Pitkä paikan nimi ja paljon muuta tekstiä " * 20, 10000),
+    ("multi-line", "Ensimmäinen rivi\nToinen rivi, joka on hieman pidempi " * 30, 10000),
+    # non-ASCII characters around the line length limit
+    ("non-ASCII", ("x" * 70 + "äöå ÄÖÅ ") * 10, 10000),
+    # a date with a calendar escape, its @ signs are not doubled
+    ("escape", "ABT @#DJULIAN@ 1 JAN 1700, noted by someone@example.org", 100000),
+)
+
+
+class WritelnBenchmark():
+    """
+    Times _writeln of both writers on the same values. The writers are created without
+    a database, as _writeln only needs the output file.
+    """
+
+    def __init__(self, repeat=5, limit=72):
+        self.repeat = repeat
+        self.limit = limit
+        self.results = []
+
+    def run(self):
+        """
+        Runs the cases, returns True if the writers wrote the same output in all of them
+        """
+        self.results = []
+        ok = True
+        for name, value, count in CASES:
+            base_seconds, base_output = self._time(exportgedcom.GedcomWriter._writeln,
+                                                   self._new_base_writer(), value, count)
+            seconds, output = self._time(GedcomWriterWithOptions._writeln,
+                                         self._new_writer(), value, count)
+            same = output == base_output
+            ok = ok and same
+            self.results.append(dict(case=name, count=count, length=len(value), base_seconds=base_seconds,
+                                     seconds=seconds, same_output=same))
+        return ok
+
+    @staticmethod
+    def _new_base_writer():
+        writer = exportgedcom.GedcomWriter.__new__(exportgedcom.GedcomWriter)
+        writer.gedcom_file = io.StringIO()
+        return writer
+
+    @staticmethod
+    def _new_writer():
+        writer = GedcomWriterWithOptions.__new__(GedcomWriterWithOptions)
+        writer.gedcom_file = io.StringIO()
+        writer.record_index = None
+        return writer
+
+    def _time(self, writeln, writer, value, count):
+        best = None
+        for _ in range(self.repeat):
+            writer.gedcom_file = io.StringIO()
+            start = time.perf_counter()
+            for _ in range(count):
+                writeln(writer, 2, "NOTE", value, self.limit)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        return best, writer.gedcom_file.getvalue()
+
+    def format_report(self):
+        lines = ["%-12s %8s %8s %12s %12s %8s  %s" % ("Case", "Values", "Length", "Base ms", "Options ms",
+                                                     "Speedup", "Output")]
+        for result in self.results:
+            lines.append("%-12s %8d %8d %12.1f %12.1f %7.2fx  %s" % (
+                result["case"], result["count"], result["length"], result["base_seconds"] * 1000,
+                result["seconds"] * 1000, result["base_seconds"] / result["seconds"],
+                "same" if result["same_output"] else "DIFFERENT"))
+        return "\n".join(lines)
+
+    def print_report(self):
+        print(self.format_report())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmark of writing GEDCOM lines")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs of each case, the best is shown")
+    parser.add_argument("--limit", type=int, default=72, help="line length limit passed to _writeln")
+    args = parser.parse_args(argv)
+
+    benchmark = WritelnBenchmark(args.repeat, args.limit)
+    ok = benchmark.run()
+    benchmark.print_report()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+# GedcomOptions.py is a Gramps plugin module, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_synthetic_database(persons, seed=0):
+    """
+    Returns an in-memory Gramps database with a synthetic family tree, skips the test without Gramps 5
+    """
+    pytest.importorskip("gramps")
+    try:
+        from gramps.gen.db.utils import make_database
+    except ImportError:
+        pytest.skip("needs Gramps 5.0 or later")
+    from benchmarks.synthetic import SyntheticDatabase
+
+    database = make_database("sqlite")
+    database.load(":memory:")
+    SyntheticDatabase(persons, seed).generate(database)
+    return database
+
+
+@pytest.fixture(scope="session")
+def database():
+    """
+    Synthetic family tree shared by tests that do not change it
+    """
+    database = make_synthetic_database(300, seed=1)
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def export(tmp_path):
+    """
+    Returns export(database, name, **options), which exports the database with GedcomWriterWithOptions
+    into a file of the name in a temporary directory and returns the path and the writer
+    """
+    from gramps.cli.user import User
+    from GedcomOptions import GedcomWriterOptions
+    from GedcomOptionsWriter import GedcomWriterWithOptions
+
+    def export(database, name="export.ged", **options):
+        filename = str(tmp_path / name)
+        options.setdefault("private", False)
+        writer = GedcomWriterWithOptions(database, User(quiet=True), GedcomWriterOptions(**options))
+        assert writer.write_gedcom_file(filename)
+        return filename, writer
+    return export
+
+
+def read_records(filename):
+    """
+    Returns the level 0 records of a GEDCOM file without the header and the trailer
+    """
+    records = []
+    with open(filename, encoding="utf-8-sig") as gedcom_file:
+        for line in gedcom_file:
+            if line.startswith("0 "):
+                records.append([])
+            records[-1].append(line)
+    return ["".join(record) for record in records if record[0] not in ("0 HEAD\n", "0 TRLR\n")]
@@ -0,0 +1,51 @@
+import csv
+import json
+
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import read_records  # noqa: E402
+
+
+def test_rows_over_rate_limit_are_dropped(tmp_path):
+    from GedcomOptions import AnomalyLog
+
+    log = AnomalyLog(str(tmp_path / "anomalies.csv"), max_rate=10, buffer_size=3)
+    log.open()
+    for number in range(100):
+        log.add("events", "I%d" % number, ["late", "early"], 0.5, -1)
+    log.close()
+    assert log.logged + log.dropped == 100
+    assert 10 <= log.logged < 20
+    with open(log.filename, newline="") as log_file:
+        rows = list(csv.reader(log_file))
+    assert rows[0] == list(AnomalyLog.FIELDS)
+    assert rows[1] == ["events", "I0", "late|early", "0.5", "-1"]
+    assert len(rows) == log.logged + 1
+
+
+def test_json_lines_without_rate_limit(tmp_path):
+    from GedcomOptions import AnomalyLog
+
+    log = AnomalyLog(str(tmp_path / "anomalies.jsonl"), max_rate=None)
+    log.open()
+    for number in range(1000):
+        log.add("children", "F%d" % number, ["late"], 1.0, 0)
+    log.close()
+    assert (log.logged, log.dropped) == (1000, 0)
+    with open(log.filename) as log_file:
+        rows = [json.loads(line) for line in log_file]
+    assert len(rows) == 1000
+    assert rows[-1] == dict(record="children", gramps_id="F999", flags="late", quality=1.0, trend=0)
+
+
+def test_export_with_anomaly_log_equals_export(database, export, tmp_path):
+    reference, reference_writer = export(database, "reference.ged")
+    log_filename = str(tmp_path / "anomalies.jsonl")
+    filename, writer = export(database, anomaly_log=log_filename, anomaly_log_rate=None)
+    assert read_records(filename) == read_records(reference)
+    with open(log_filename) as log_file:
+        rows = [json.loads(line) for line in log_file]
+    assert len(rows) == writer.anomaly_log.logged > 0
+    assert set(row["record"] for row in rows) <= set(["events", "children"])
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import read_records  # noqa: E402
+
+DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Creates a family tree of synthetic people in the Gramps home directory of the process
+CREATE_TREE_CODE = """
+import contextlib, io, sys
+from gramps.cli.clidbman import CLIDbManager
+from gramps.gen.dbstate import DbState
+from gramps.gen.db.utils import open_database
+from benchmarks.synthetic import SyntheticDatabase
+
+name, persons = sys.argv[1], int(sys.argv[2])  # Gramps may change sys.argv while loading plugins
+CLIDbManager(DbState()).create_new_db_cli(name, dbid="sqlite")
+database = open_database(name)
+with contextlib.redirect_stdout(io.StringIO()):
+    SyntheticDatabase(persons, 3).generate(database)
+database.close()
+"""
+
+
+def run(tmp_path, *arguments):
+    environment = dict(os.environ, GRAMPSHOME=str(tmp_path / "home"))
+    return subprocess.run([sys.executable] + list(arguments), cwd=DIRECTORY, env=environment,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def test_import_loads_no_gui():
+    from benchmarks.startup import StartupBenchmark
+
+    benchmark = StartupBenchmark(repeat=1)
+    assert benchmark.run(), benchmark.format_report()
+
+
+def test_command_line_export(tmp_path):
+    pytest.importorskip("gramps.gen.db.utils")
+    os.mkdir(str(tmp_path / "home"))
+    process = run(tmp_path, "-c", CREATE_TREE_CODE, "Test tree", "50")
+    assert process.returncode == 0, process.stderr
+
+    filename = str(tmp_path / "export.ged")
+    process = run(tmp_path, "GedcomOptions.py", "--index", "Test tree", filename)
+    assert process.returncode == 0, process.stderr
+    records = read_records(filename)
+    assert sum(record.startswith("0 @I") for record in records) == 50
+    assert os.path.exists(filename + ".idx")
+
+    process = run(tmp_path, "GedcomOptions.py", "Missing tree", str(tmp_path / "missing.ged"))
+    assert process.returncode == 1
+    assert "Family tree not found: Missing tree" in process.stderr
@@ -0,0 +1,104 @@
+import random
+
+import pytest
+
+pytest.importorskip("gramps")
+
+from gramps.cli.user import User  # noqa: E402
+from gramps.gen.lib import Date, Event, EventRef, EventType, Person  # noqa: E402
+
+from GedcomOptions import FuzzySort, GedcomWriterOptions  # noqa: E402
+from GedcomOptionsWriter import GedcomWriterWithOptions  # noqa: E402
+
+EVENT_TYPES = (EventType.BIRTH, EventType.BAPTISM, EventType.MARRIAGE, EventType.RESIDENCE, EventType.OCCUPATION,
+               EventType.CENSUS, EventType.DEATH, EventType.CAUSE_DEATH, EventType.CREMATION, EventType.BURIAL)
+
+
+class EventDatabase():
+    """
+    Events by handle, all the writer needs for ordering person events
+    """
+
+    def __init__(self):
+        self.events = dict()
+
+    def get_event_from_handle(self, handle):
+        return self.events.get(handle)
+
+
+def add_event(database, person, event_type, year, rnd):
+    event = Event()
+    event.set_handle("E%d" % len(database.events))
+    event.set_type(EventType(event_type))
+    date = Date()
+    if year is not None:
+        date.set_yr_mon_day(year, rnd.randint(0, 12), rnd.randint(0, 28))
+    event.set_date_object(date)
+    database.events[event.get_handle()] = event
+    event_ref = EventRef()
+    event_ref.set_reference_handle(event.get_handle())
+    person.add_event_ref(event_ref)
+    return event_ref
+
+
+def make_person(database, rnd):
+    """
+    A person with events in random order, some of them undated or out of the lifespan
+    """
+    person = Person()
+    born = rnd.randint(1600, 1950)
+    for i in range(rnd.randint(0, 12)):
+        event_type = rnd.choice(EVENT_TYPES)
+        year = None if rnd.random() < 0.3 else born + rnd.randint(-10, 110)
+        event_ref = add_event(database, person, event_type, year, rnd)
+        if event_type == EventType.BIRTH and person.get_birth_ref() is None:
+            person.set_birth_ref(event_ref)
+        elif event_type == EventType.DEATH and person.get_death_ref() is None:
+            person.set_death_ref(event_ref)
+    return person
+
+
+def multi_pass_order(writer, person):
+    """
+    The ordering of _remaining_events before events were decorated once: sort by type, unpack,
+    decorate by date, fuzzy sort, unpack, decorate by type and sort again
+    """
+    event_ref_list = person.get_event_ref_list()
+    birth_sv, death_sv = writer.get_birth_and_death_sort_values(person)
+    if birth_sv is not None:
+        birth_sv -= 200
+    if death_sv is not None:
+        death_sv += 200
+    sorter = FuzzySort(unsortables_last=False, max_deviation=50*365)
+
+    event_sort_list = writer.decorate_by_event_type(event_ref_list)
+    event_sort_list2 = sorted(event_sort_list, key=lambda x: x[1])
+    event_ref_list = sorter.unpack(event_sort_list2, 0)
+
+    event_sort_list = writer.decorate_by_date(event_ref_list)
+    event_sort_list = sorter.fuzzysorted(event_sort_list, low_value=birth_sv, high_value=death_sv)
+    event_ref_list = sorter.unpack(event_sort_list, 0)
+
+    event_sort_list = writer.decorate_by_event_type(event_ref_list)
+    event_sort_list = sorted(event_sort_list, key=lambda x: x[1])
+    event_ref_list = sorter.unpack(event_sort_list, 0)
+    return [event_ref.ref for event_ref in event_ref_list]
+
+
+def single_pass_order(writer, person):
+    written = []
+    writer._process_person_event = lambda person, event, event_ref: written.append(event_ref.ref)
+    writer._adoption_records = lambda person, adop_written: None
+    writer._remaining_events(person)
+    return written
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_single_pass_event_order_equals_multi_pass(seed):
+    rnd = random.Random(seed)
+    database = EventDatabase()
+    writer = GedcomWriterWithOptions(database, User(), GedcomWriterOptions(private=False))
+    assert writer.sort_events
+    for i in range(1000):
+        person = make_person(database, rnd)
+        assert single_pass_order(writer, person) == multi_pass_order(writer, person)
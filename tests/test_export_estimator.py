@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import read_records  # noqa: E402
+
+
+def record_sizes(filename, prefix):
+    return [len(record.encode("utf-8")) for record in read_records(filename) if record.startswith(prefix)]
+
+
+def test_whole_tree_as_sample_gives_exact_size(database, export):
+    from gramps.cli.user import User
+    from GedcomOptions import GedcomWriterOptions, estimate_export
+
+    filename, writer = export(database)
+    estimator = estimate_export(database, User(quiet=True), GedcomWriterOptions(private=False), sample_size=1000)
+    for kind, prefix in (("person", "0 @I"), ("family", "0 @F")):
+        result = estimator.results[kind]
+        assert result["sampled"] == result["count"] == len(record_sizes(filename, prefix))
+        assert result["size"] == sum(record_sizes(filename, prefix))
+        assert result["size_variance"] == 0
+        assert result["time"] > 0
+    assert set(estimator.phases) and all(seconds >= 0 for seconds in estimator.phases.values())
+
+
+def test_sample_gives_size_within_confidence_interval(database, export):
+    from gramps.cli.user import User
+    from GedcomOptions import GedcomWriterOptions, estimate_export
+
+    filename, writer = export(database)
+    size = sum(record_sizes(filename, "0 @I"))
+    estimator = estimate_export(database, User(quiet=True), GedcomWriterOptions(private=False), sample_size=100,
+                                seed=1)
+    result = estimator.results["person"]
+    assert result["sampled"] < result["count"]
+    # far outside the 95 % interval, so that the test does not fail by chance
+    assert abs(result["size"] - size) <= 4 * result["size_variance"] ** 0.5
+    assert 0.7 * size < result["size"] < 1.3 * size
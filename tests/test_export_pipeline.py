@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import read_records  # noqa: E402
+
+
+def test_pipelined_export_equals_export(database, export):
+    reference, reference_writer = export(database, "reference.ged")
+    filename, writer = export(database, pipeline=True)
+    assert writer.export_pipeline is not None
+    assert writer.export_pipeline.records == database.get_number_of_people() + database.get_number_of_families()
+    assert read_records(filename) == read_records(reference)
+
+
+@pytest.mark.parametrize("options", [dict(snapshot_memory_limit=0.05), dict(record_index=True)])
+def test_export_without_pipeline_when_it_can_not_be_used(database, export, options, caplog, capsys):
+    reference, reference_writer = export(database, "reference.ged")
+    capsys.readouterr()
+    filename, writer = export(database, pipeline=True, **options)
+    assert writer.export_pipeline is None
+    assert read_records(filename) == read_records(reference)
+    # reported to the log, not to the output of a GUI export
+    assert any(record.message.startswith("Pipelined export is not used") for record in caplog.records)
+    assert "Pipelined export" not in capsys.readouterr().out
@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import read_records  # noqa: E402
+
+
+def test_profiled_export_equals_export(database, export):
+    reference, reference_writer = export(database, "reference.ged")
+    filename, writer = export(database, profile=True)
+    assert read_records(filename) == read_records(reference)
+
+    with open(filename + ".profile.json") as json_file:
+        stats = json.load(json_file)
+    phases = stats["phases"]
+    assert set(phases) == set(writer.export_profile.PHASES + (writer.export_profile.OTHER,))
+    assert phases["_person_name"]["calls"] >= database.get_number_of_people()
+    assert phases["_family_child_list"]["calls"] == database.get_number_of_families()
+    assert phases["_writeln"]["calls"] >= len(read_records(filename))
+    assert sum(phase["fetches"] for phase in phases.values()) > 0
+    assert stats["elapsed"] >= sum(phase["self"] for name, phase in phases.items() if name != "other")
+
@@ -0,0 +1,76 @@
+import concurrent.futures
+import random
+
+import pytest
+
+pytest.importorskip("gramps")
+
+from GedcomOptions import FormatStringParser  # noqa: E402
+from GedcomOptionsWriter import GedcomWriterWithOptions  # noqa: E402
+
+KEYS = GedcomWriterWithOptions._place_keys
+
+FORMATS = list(GedcomWriterWithOptions._address_format) + [
+    "[%CODE ]+-[%town, %city, %municipality], %parish",
+    "<%street %building>|%farm, %village",
+    "{%country}-+[ (%state)]",
+    "$u%city[, $l%county]",
+    "[%hamlet, ]%extra",  # %extra is not in the key list, only in some values
+]
+
+NAMES = ["Helsinki", "kotikylä", "MÄKELÄ", "Nya gatan 5", "St. Mary's", "", "Åbo", "village of X"]
+
+
+def make_values(rnd):
+    values = dict((key, rnd.choice(NAMES)) for key in rnd.sample(KEYS, rnd.randint(0, len(KEYS))))
+    if rnd.random() < 0.3:
+        values["extra"] = rnd.choice(NAMES)
+    return values
+
+
+def make_cases(count, seed=0):
+    rnd = random.Random(seed)
+    return [(make_values(rnd), rnd.choice(FORMATS)) for i in range(count)]
+
+
+def test_shared_parser_gives_single_threaded_results():
+    cases = make_cases(2000)
+    expected = [FormatStringParser(KEYS).parse(values, format_string) for values, format_string in cases]
+
+    parser = FormatStringParser(KEYS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        for run in range(5):
+            results = list(executor.map(lambda case: parser.parse(*case), cases))
+            assert results == expected
+
+
+def test_shared_compiled_formats_give_single_threaded_results():
+    cases = make_cases(2000, seed=1)
+    parser = FormatStringParser(KEYS)
+    compiled = dict((format_string, parser.compile(format_string)) for format_string in FORMATS)
+    # keys of compiled formats are resolved when compiling, so they are compared with compiled ones
+    expected = [parser.parse(values, compiled[format_string]) for values, format_string in cases]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(lambda case: parser.parse(case[0], compiled[case[1]]), cases))
+    assert results == expected
+
+
+def test_parsing_does_not_change_key_list():
+    parser = FormatStringParser(KEYS)
+    keys = tuple(KEYS)
+    parser.parse(dict(extra="x", city="y"), "%extra, %city")
+    assert parser._all_keys == keys
+    assert tuple(KEYS) == keys
+
+
+def test_profile_counts_calls_of_compiled_and_plain_formats():
+    parser = FormatStringParser(KEYS, profile=True)
+    compiled = parser.compile(FORMATS[0])
+    for values, format_string in make_cases(100, seed=2):
+        parser.parse(values, compiled)
+        parser.parse(values, FORMATS[1])
+    stats = parser.profile.get_stats()
+    assert stats[FORMATS[0]]["calls"] == stats[FORMATS[1]]["calls"] == 100
+    assert set(stats[FORMATS[0]]) == set(("calls", "total") + parser.profile.PHASES)
+    assert stats[FORMATS[0]]["total"] >= stats[FORMATS[0]]["collect"] > 0
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import make_synthetic_database, read_records  # noqa: E402
+
+
+def test_export_writes_all_records(database, export):
+    filename, writer = export(database)
+    records = read_records(filename)
+    assert sum(record.startswith("0 @I") for record in records) == database.get_number_of_people()
+    assert sum(record.startswith("0 @F") for record in records) == database.get_number_of_families()
+
+
+def test_rerun_reuses_all_records(database, export):
+    filename, writer = export(database, incremental=True)
+    first = read_records(filename)
+    filename, writer = export(database, incremental=True)
+    assert read_records(filename) == first
+    assert writer.incremental_export.written == 0
+    assert writer.incremental_export.reused == database.get_number_of_people() + database.get_number_of_families()
+
+
+def test_rerun_writes_changed_records(export):
+    from gramps.gen.db import DbTxn
+
+    database = make_synthetic_database(200, seed=2)
+    filename, writer = export(database, incremental=True)
+
+    person = database.get_person_from_gramps_id(database.get_person_gramps_ids()[0])
+    person.get_primary_name().set_first_name("Changed")
+    with DbTxn("Change a name", database) as trans:
+        # change times are in seconds, the tree was generated within this second
+        database.commit_person(person, trans, change_time=person.get_change_time() + 1)
+
+    filename, writer = export(database, incremental=True)
+    reference, reference_writer = export(database, "reference.ged")
+    assert read_records(filename) == read_records(reference)
+    # the person, and the families listing the person as a spouse or a child
+    assert 1 <= writer.incremental_export.written < 5
+    assert writer.incremental_export.reused > 0
+    database.close()
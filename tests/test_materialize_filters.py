@@ -0,0 +1,13 @@
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import read_records  # noqa: E402
+
+
+@pytest.mark.parametrize("private", [False, True])
+def test_materialized_export_equals_export(database, export, private):
+    reference, reference_writer = export(database, "reference.ged", private=private)
+    filename, writer = export(database, private=private, materialize_filters=1)
+    assert writer.snapshot.is_complete()
+    assert read_records(filename) == read_records(reference)
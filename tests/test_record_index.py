@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import read_records  # noqa: E402
+
+
+def test_records_are_found_by_xref(database, export):
+    from GedcomOptions import RecordIndexReader
+
+    filename, writer = export(database, record_index=True)
+    records = dict((record.split(" ")[1].strip("@"), record) for record in read_records(filename))
+    with RecordIndexReader(filename) as reader:
+        # the header and the trailer have no xrefs
+        assert len(reader) == len(records)
+        for xref, record in records.items():
+            assert reader.get(xref) == record
+            assert reader.get("@%s@" % xref) == record
+        xref = sorted(records)[len(records) // 2]
+        offset, length = reader.find(xref)
+        with open(filename, "rb") as gedcom_file:
+            gedcom_file.seek(offset)
+            assert gedcom_file.read(length).decode("utf-8") == records[xref]
+        assert reader.find("I9999999") is None
+        assert reader.get("X1") is None
@@ -0,0 +1,26 @@
+import os
+
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import read_records  # noqa: E402
+
+
+@pytest.mark.parametrize("shard_by", ["count", "branch"])
+def test_shards_hold_the_records_of_the_export(database, export, shard_by):
+    from GedcomOptions import ShardedExport
+
+    reference, reference_writer = export(database, "reference.ged")
+    filename, writer = export(database, shards=3, shard_by=shard_by, shard_workers=3)
+    assert not os.path.exists(filename)
+
+    records = []
+    for number, entry in enumerate(writer.sharded_export.manifest["shards"]):
+        shard_filename = ShardedExport.get_shard_filename(filename, number + 1)
+        assert entry["file"] == os.path.basename(shard_filename)
+        records.extend(record for record in read_records(shard_filename) if not record.startswith("0 @SUBM@"))
+    reference_records = read_records(reference)
+    # each shard has a submitter record of its own
+    assert sum(record.startswith("0 @SUBM@") for record in reference_records) == 1
+    assert sorted(records) == sorted(record for record in reference_records if not record.startswith("0 @SUBM@"))
@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip("gramps")
+
+from conftest import read_records  # noqa: E402
+
+
+def test_snapshot_export_equals_export(database, export):
+    reference, reference_writer = export(database, "reference.ged")
+    filename, writer = export(database, snapshot=True)
+    assert writer.snapshot.is_complete("person", "family")
+    assert writer.snapshot.hits > 0
+    assert read_records(filename) == read_records(reference)
+
+
+def test_snapshot_over_memory_limit_reads_the_rest_from_database(database, export):
+    reference, reference_writer = export(database, "reference.ged")
+    filename, writer = export(database, snapshot=True, snapshot_memory_limit=0.05)
+    assert not writer.snapshot.is_complete("person", "family")
+    assert writer.snapshot.misses > 0
+    assert read_records(filename) == read_records(reference)
@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip("gramps")
+
+
+def tng_place_level(writer, place):
+    """
+    TNG place level of the place as it was looked up before the table of levels
+    """
+    level, zoom = 6, 9
+    if place.get_type() in writer._unknown_level_place_types:
+        level, zoom = 1, 13
+    if place.get_type() in writer._address1_level_place_types:
+        level, zoom = 1, 13
+    if place.get_type() in writer._address2_level_place_types:
+        level, zoom = 2, 11
+    if place.get_type() in writer._city_level_place_types:
+        level, zoom = 3, 9
+    if place.get_type() in writer._county_level_place_types:
+        level, zoom = 4, 7
+    return level, zoom
+
+
+def test_place_levels_are_unchanged(database, export):
+    from gramps.gen.lib import Place, PlaceType
+
+    filename, writer = export(database)
+    place_types = [place_type for place_type, name, xml_name in PlaceType._DATAMAP] + ["State", "Village"]
+    for number, place_type in enumerate(place_types):
+        place = Place()
+        place.set_handle("tng%d" % number)
+        place.set_type(PlaceType(place_type))
+        assert writer._tng_place_level(place) == tng_place_level(writer, place), place_type
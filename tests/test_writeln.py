@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip("gramps")
+
+from benchmarks.writeln import CASES, WritelnBenchmark  # noqa: E402
+
+VALUES = [value for name, value, count in CASES] + [
+    "x" * 71 + "ä" + "y" * 10,  # non-ASCII character at the limit
+    "x" * 70 + " ä " + "y" * 10,
+    "ä" * 200,
+    "Date @#DGREGORIAN@ 1 JAN 1800 and @#DJULIAN@ 1700",
+    "@I1@",
+    "someone@example.org\nsomeone.else@example.org",
+    "line\r\nwith\rcarriage returns",
+]
+
+
+@pytest.mark.parametrize("value", VALUES)
+@pytest.mark.parametrize("limit", [72, 248, 0])
+def test_writeln_writes_like_gedcom_writer(value, limit):
+    from gramps.plugins.export import exportgedcom
+    from GedcomOptionsWriter import GedcomWriterWithOptions
+
+    base_writer = WritelnBenchmark._new_base_writer()
+    exportgedcom.GedcomWriter._writeln(base_writer, 2, "NOTE", value, limit)
+    writer = WritelnBenchmark._new_writer()
+    GedcomWriterWithOptions._writeln(writer, 2, "NOTE", value, limit)
+    assert writer.gedcom_file.getvalue() == base_writer.gedcom_file.getvalue()